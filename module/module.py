@@ -31,12 +31,47 @@ for mainly get graphs and links.
 import re
 import socket
 import os
+import threading
+import time
+import hashlib
+import httplib
+import urlparse
+import urllib
+import Queue
+import json
+import fnmatch
+import mmap
+import struct
+import zlib
+import logging
+import bisect
+import itertools
 
+from collections import deque, namedtuple
 from shinken.log import logger
 from string import Template
 from shinken.basemodule import BaseModule
 from datetime import datetime
 from shinken.misc.perfdata import PerfDatas
+from shinken.util import to_best_int_float
+
+try:
+    import bottle
+except ImportError:
+    try:
+        from shinken.webui import bottlewebui as bottle
+    except ImportError:
+        bottle = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 properties = {
@@ -46,6 +81,170 @@ properties = {
 
 DEBUG_PREFIX = '[Graphite UI] '
 
+# Ugly to hard-code such values. But where else should I put them ?
+FONT_SIZES = {'detail': '8', 'dashboard': '18'}
+
+# Graphs built without template: one per metric, or one per service
+GRAPH_MODES = ('metric', 'service')
+
+# Graphite relative time units, in seconds
+TIME_UNITS = (('s', 1), ('min', 60), ('h', 3600), ('d', 86400),
+              ('w', 604800), ('mon', 2592000), ('y', 31536000))
+RELATIVE_TIME = re.compile(r'^-(\d+)([a-z]+)$')
+
+
+# Steps of the quantized time ranges: (max span, step) in seconds
+QUANTIZE_STEPS = ((6 * 3600, 60), (2 * 86400, 300), (8 * 86400, 900))
+QUANTIZE_MAX_STEP = 3600
+
+# Formats of the from and until values in the URLs
+TIME_FORMATS = ('legacy', 'epoch', 'relative')
+
+# Consolidation of the graph targets, and the Graphite functions to use
+CONSOLIDATIONS = ('none', 'consolidateBy', 'summarize')
+CONSOLIDATION_FUNCTIONS = {'avg': 'average', 'sum': 'sum', 'min': 'min',
+                           'max': 'max'}
+# summarize() intervals: (Graphite interval, seconds). Graphs with less
+# than SUMMARIZE_MIN_STEP seconds per pixel are not summarized.
+SUMMARIZE_STEPS = (('1min', 60), ('5min', 300), ('10min', 600),
+                   ('15min', 900), ('30min', 1800), ('1h', 3600),
+                   ('3h', 10800), ('6h', 21600), ('12h', 43200),
+                   ('1d', 86400), ('7d', 604800))
+SUMMARIZE_MIN_STEP = 60
+# Functions wrapping a whole target, the consolidation goes inside them
+OUTER_FUNCTIONS = ('secondYAxis', 'aliasByNode', 'scale')
+
+# One graph URL of a .graph template
+TEMPLATE_LINE = re.compile(r'[^\n]+')
+
+# Points of each Graphite backend on the consistent hash ring
+BACKEND_REPLICAS = 100
+
+# Points per bucket above which downsample uses numpy: below, its calls
+# per bucket cost more than the pure python loop
+DOWNSAMPLE_NUMPY_BUCKET = 100
+
+# Host overview graphs of the metric units: (graph, scale to the graph
+# unit), and the order of the graphs
+OVERVIEW_UNITS = {
+    '%': ('percent', 1),
+    'B': ('bytes', 1),
+    'KB': ('bytes', 1024),
+    'kB': ('bytes', 1024),
+    'MB': ('bytes', 1024 ** 2),
+    'GB': ('bytes', 1024 ** 3),
+    'TB': ('bytes', 1024 ** 4),
+    's': ('seconds', 1),
+    'ms': ('seconds', 0.001),
+    'us': ('seconds', 0.000001),
+    'c': ('counts', 1),
+    '': ('counts', 1),
+}
+OVERVIEW_GRAPHS = ('percent', 'bytes', 'seconds', 'counts')
+
+# What the graphs become while Graphite is unhealthy
+HEALTH_MODES = ('reduce', 'placeholder')
+# Pixels per point of the reduced graphs summarize()
+HEALTH_PIXELS_PER_POINT = 4
+
+# Upper bounds of the instrumentation latency histogram, in milliseconds
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+# Default ports of the instrumentation export protocols
+EXPORT_PORTS = {'statsd': 8125, 'carbon': 2003}
+
+
+def get_quantize_step(span):
+    """Return the step to quantize a time range of span seconds"""
+    for max_span, step in QUANTIZE_STEPS:
+        if span <= max_span:
+            return step
+    return QUANTIZE_MAX_STEP
+
+
+def get_summarize_interval(span, width):
+    """Return the summarize() interval for a time span drawn on width
+    pixels: the shortest one with at most one point per pixel. None if
+    there is less than SUMMARIZE_MIN_STEP seconds per pixel."""
+    step = float(span) / max(1, width)
+    if step < SUMMARIZE_MIN_STEP:
+        return None
+    for interval, seconds in SUMMARIZE_STEPS:
+        if seconds >= step:
+            return interval
+    return SUMMARIZE_STEPS[-1][0]
+
+
+def split_outer_function(target):
+    """Return (function, wrapped target, other arguments) of a target
+    wrapped in one of OUTER_FUNCTIONS, like aliasByNode(a.b,1) gives
+    ('aliasByNode', 'a.b', ',1'), or None"""
+    name, paren, arguments = target.partition('(')
+    if not paren or name not in OUTER_FUNCTIONS or \
+            not arguments.endswith(')'):
+        return None
+    arguments = arguments[:-1]
+    depth = 0
+    for index, char in enumerate(arguments):
+        if char in '({':
+            depth += 1
+        elif char in ')}':
+            depth -= 1
+            if depth < 0:
+                return None
+        elif char == ',' and depth == 0:
+            return name, arguments[:index], arguments[index:]
+    if depth:
+        return None
+    return name, arguments, ''
+
+
+def format_graphite_span(span):
+    """Return a Graphite relative time for span seconds, like -4h"""
+    span = int(span)
+    for unit, seconds in reversed(TIME_UNITS[:4]):
+        if span >= seconds and span % seconds == 0:
+            return "-%d%s" % (span // seconds, unit)
+    return "-%ds" % span
+
+
+def parse_graphite_time(value, now=None):
+    """Return the epoch of a Graphite from/until value, or None.
+
+    Handle our own %H:%M_%Y%m%d format, epoch seconds, now and
+    relative times like -4h.
+    """
+    if now is None:
+        now = time.time()
+    if not value:
+        return None
+    if value == 'now':
+        return now
+    if value.isdigit():
+        return int(value)
+    match = RELATIVE_TIME.match(value)
+    if match:
+        for unit, seconds in TIME_UNITS:
+            if match.group(2).startswith(unit):
+                return now - int(match.group(1)) * seconds
+        return None
+    # %H:%M_%Y%m%d, parsed by hand as time.strptime is not thread safe
+    if len(value) != 14 or value[2] != ':' or value[5] != '_':
+        return None
+    try:
+        return time.mktime((int(value[6:10]), int(value[10:12]),
+                            int(value[12:14]), int(value[0:2]),
+                            int(value[3:5]), 0, 0, 0, -1))
+    except ValueError:
+        return None
+
+
+def wait_stop(event, timeout):
+    """Wait until event is set or timeout seconds, and return True if
+    it is set. Event.wait only returns it from Python 2.7."""
+    event.wait(timeout)
+    return event.is_set()
+
+
 def get_instance(plugin):
     """called by the plugin manager"""
     logger.debug("{prefix}Get an GRAPHITE UI module for plugin {name}".format(
@@ -56,6 +255,2162 @@ def get_instance(plugin):
     return instance
 
 
+# One metric of a perf_data, as used by this module
+PerfMetric = namedtuple('PerfMetric', ['name', 'value', 'uom', 'warn', 'crit'])
+
+# A perf_data field split and matched like shinken.misc.perfdata does:
+# name=value[uom][;warn[;crit[;...]]] up to the next space
+PERF_DATA_FIELD = re.compile(
+    r"\s*([^=\s][^=]*)=([\d\.\-\+eE]+)([\w\/%]*)"
+    r";?([\d\.\-\+eE:~@]+)?;?([\d\.\-\+eE:~@]+)?\S*")
+# What PerfDatas would take as the start of a field value
+PERF_DATA_VALUE = re.compile(r'=\S')
+
+
+def to_number(value):
+    """Return a perf_data number as an int or a float, or None, like
+    shinken.misc.perfdata does"""
+    if value is None:
+        return None
+    try:
+        return to_best_int_float(value)
+    except (ValueError, OverflowError):
+        return None
+
+
+def parse_perf_data_fields(perf_data):
+    """Return the (name, value, uom, warn, crit) tuples of a perf_data,
+    in the perf_data order, the last one winning for a repeated name.
+
+    It gives the same metrics as shinken.misc.perfdata.PerfDatas with one
+    pattern and no object per field. Return None for the inputs it can't
+    handle the same way: unicode strings, and fields that do not match,
+    as PerfDatas splits the following ones differently.
+    """
+    if not perf_data:
+        return []
+    if not isinstance(perf_data, str):
+        return None
+    res = []
+    positions = {}
+    end = 0
+    for match in PERF_DATA_FIELD.finditer(perf_data):
+        if match.start() != end:
+            return None
+        end = match.end()
+        name, value, uom, warn, crit = match.groups()
+        name = name.replace("'", "")
+        field = (name, to_number(value), uom, to_number(warn),
+                 to_number(crit))
+        if name in positions:
+            res[positions[name]] = field
+        else:
+            positions[name] = len(res)
+            res.append(field)
+    # Empty values at the end, like "/toto=", are ignored
+    if PERF_DATA_VALUE.search(perf_data, end):
+        return None
+    return res
+
+
+def downsample(datapoints, threshold):
+    """Reduce Graphite [value, time] datapoints to threshold points with
+    the largest-triangle-three-buckets algorithm. Null values are
+    dropped. Use numpy if available, for the long series.
+    """
+    if numpy is not None and threshold >= 3 and \
+            len(datapoints) >= DOWNSAMPLE_NUMPY_BUCKET * threshold:
+        return downsample_numpy(datapoints, threshold)
+    datapoints = [point for point in datapoints if point[0] is not None]
+    if threshold < 3 or len(datapoints) <= threshold:
+        return datapoints
+
+    count = len(datapoints)
+    every = float(count - 2) / (threshold - 2)
+    selected = 0
+    sampled = [datapoints[0]]
+    for i in xrange(threshold - 2):
+        # Average point of the next bucket
+        avg_start = int(i * every + every) + 1
+        avg_end = min(int(i * every + 2 * every) + 1, count)
+        avg_length = avg_end - avg_start
+        avg_x = sum(point[1] for point in datapoints[avg_start:avg_end])
+        avg_y = sum(point[0] for point in datapoints[avg_start:avg_end])
+        avg_x = float(avg_x) / avg_length
+        avg_y = float(avg_y) / avg_length
+
+        # The point of this bucket with the largest triangle
+        point_y, point_x = datapoints[selected]
+        max_area = -1
+        for j in xrange(int(i * every) + 1, int(i * every + every) + 1):
+            area = abs((point_x - avg_x) * (datapoints[j][0] - point_y) -
+                       (point_x - datapoints[j][1]) * (avg_y - point_y))
+            if area > max_area:
+                max_area = area
+                selected = j
+        sampled.append(datapoints[selected])
+    sampled.append(datapoints[-1])
+    return sampled
+
+
+def downsample_numpy(datapoints, threshold):
+    """numpy version of downsample.
+
+    The nulls are dropped as NaN from the arrays, and the areas of a
+    bucket computed at once, but the buckets are still walked one by one:
+    each one depends on the point selected in the previous one. For a
+    year of minutes reduced to 586 points, it takes 0.12s against 0.19s
+    for the pure python version, most of it building the arrays. With
+    less than about 70 points per bucket, it is slower.
+    """
+    values = numpy.array([point[0] for point in datapoints], dtype=float)
+    positions = numpy.flatnonzero(~numpy.isnan(values))
+    if len(positions) <= threshold:
+        return [datapoints[position] for position in positions.tolist()]
+    values = values[positions]
+    times = numpy.array([point[1] for point in datapoints],
+                        dtype=float)[positions]
+    count = len(positions)
+    every = float(count - 2) / (threshold - 2)
+    bounds = [int(i * every) + 1 for i in xrange(threshold - 1)]
+    bounds.append(count)
+    selected = 0
+    indexes = [0]
+    for i in xrange(threshold - 2):
+        avg_start = bounds[i + 1]
+        avg_end = min(int(i * every + 2 * every) + 1, count)
+        avg_x = times[avg_start:avg_end].mean()
+        avg_y = values[avg_start:avg_end].mean()
+        point_x = times[selected]
+        point_y = values[selected]
+        areas = numpy.abs(
+            (point_x - avg_x) * (values[bounds[i]:bounds[i + 1]] - point_y) -
+            (point_x - times[bounds[i]:bounds[i + 1]]) * (avg_y - point_y))
+        selected = bounds[i] + int(areas.argmax())
+        indexes.append(selected)
+    indexes.append(count - 1)
+    return [datapoints[position] for position in positions[indexes].tolist()]
+
+
+class GraphSpec(object):
+    """A Graphite render URL: the base uri and the ordered list of the
+    query parameters (targets, time range and render parameters).
+
+    It is built from our values or from a template URL, whose query
+    string is parsed once, and turned into an URL once with to_url().
+    """
+    __slots__ = ('base', 'params', 'positions')
+
+    def __init__(self, base):
+        self.base = base
+        # [key, value] lists, value is None for a parameter without '='
+        self.params = []
+        # key -> position of its first value in params
+        self.positions = {}
+
+    @classmethod
+    def from_url(cls, url):
+        """Build a GraphSpec from an URL"""
+        base, _, query = url.partition('?')
+        spec = cls(base)
+        for param in query.split('&'):
+            if param:
+                key, equal, value = param.partition('=')
+                spec.add(key, value if equal else None)
+        return spec
+
+    def add(self, key, value):
+        """Add a parameter, even if the key is already there"""
+        if key not in self.positions:
+            self.positions[key] = len(self.params)
+        self.params.append([key, value])
+
+    def set(self, key, value):
+        """Replace the value of a parameter, or add it if not present"""
+        position = self.positions.get(key)
+        if position is None:
+            self.add(key, value)
+        else:
+            self.params[position][1] = value
+
+    def get(self, key, default=None):
+        """Return the first value of a parameter"""
+        position = self.positions.get(key)
+        if position is None:
+            return default
+        return self.params[position][1]
+
+    @property
+    def targets(self):
+        """Return the list of the targets"""
+        return [value for key, value in self.params if key == 'target']
+
+    def add_target(self, target):
+        """Add a target to the graph"""
+        self.add('target', target)
+
+    def copy(self):
+        """Return a copy of the GraphSpec, to be changed separately"""
+        spec = GraphSpec(self.base)
+        spec.params = [list(param) for param in self.params]
+        spec.positions = dict(self.positions)
+        return spec
+
+    def keep_targets(self, count):
+        """Remove the targets after the first count ones"""
+        params = []
+        for param in self.params:
+            if param[0] == 'target':
+                if count <= 0:
+                    continue
+                count -= 1
+            params.append(param)
+        self.params = params
+        self.positions = {}
+        for position, param in enumerate(params):
+            self.positions.setdefault(param[0], position)
+
+    def map_targets(self, function):
+        """Replace each target by function(target)"""
+        for param in self.params:
+            if param[0] == 'target' and param[1]:
+                param[1] = function(param[1])
+
+    def set_time_range(self, since, until):
+        """Set the from and until parameters"""
+        self.set('from', since)
+        self.set('until', until)
+
+    def set_font_size(self, size):
+        """Set the fontSize parameter"""
+        self.set('fontSize', size)
+
+    def set_size(self, width, height):
+        """Set the width and height parameters"""
+        self.set('width', width)
+        self.set('height', height)
+
+    def to_url(self):
+        """Return the URL of the graph"""
+        query = []
+        for key, value in self.params:
+            if value is None:
+                query.append(key)
+            else:
+                query.append("%s=%s" % (key, value))
+        return "%s?%s" % (self.base, '&'.join(query))
+
+
+class GraphContext(object):
+    """What a get_graph_uris call shares for all its elements"""
+    __slots__ = ('source', 'fontsize', 'width', 'height',
+                 'start_date', 'end_date', 'metrics', 'consolidate',
+                 'reduced')
+
+
+class GraphPlan(object):
+    """What the graphs of an element need that only changes with the
+    configuration: its sanitized Graphite paths and its templates.
+
+    signature holds the raw values the plan was computed from, so a plan
+    is used only while they are the same. templates maps a source to its
+    template path (or None), for the templates index generation.
+    """
+    __slots__ = ('signature', 'graphite_pre', 'graphite_post', 'host_path',
+                 'elt_path', 'service', 'command', 'arg', 'templates',
+                 'generation', 'backend')
+
+
+class LRUDict(object):
+    """Dict which remembers the order its keys were set in, the oldest
+    first, for the LRU caches (collections.OrderedDict is not in Python
+    2.6).
+
+    An entry is moved to the end by popping and setting it again.
+    """
+    def __init__(self):
+        # key -> [previous link, next link, key, value]
+        self.links = {}
+        # Sentinel of the circular list of the links
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def __setitem__(self, key, value):
+        link = self.links.get(key)
+        if link is not None:
+            link[3] = value
+            return
+        last = self.root[0]
+        link = [last, self.root, key, value]
+        last[1] = self.root[0] = self.links[key] = link
+
+    def pop(self, key, default=None):
+        """Remove key and return its value, or default"""
+        link = self.links.pop(key, None)
+        if link is None:
+            return default
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        return link[3]
+
+    def popitem(self, last=True):
+        """Remove and return the (key, value) couple set last, or first
+        if last is false"""
+        if not self.links:
+            raise KeyError('dictionary is empty')
+        link = self.root[0] if last else self.root[1]
+        return link[2], self.pop(link[2])
+
+    def values(self):
+        """Return the values, the oldest first"""
+        values = []
+        link = self.root[1]
+        while link is not self.root:
+            values.append(link[3])
+            link = link[1]
+        return values
+
+    def clear(self):
+        """Remove all the entries"""
+        self.links.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+
+class TemplateCache(object):
+    """LRU cache of the parsed .graph templates, keyed by file path.
+
+    A template is read again only when the file mtime or size changed.
+    With a check_interval, the file is not even stat'ed again before
+    this delay (in seconds) is elapsed.
+    """
+    def __init__(self, max_size=256, check_interval=0):
+        self.max_size = max(1, max_size)
+        self.check_interval = check_interval
+        # path -> [mtime, size, template, last check time]
+        self.entries = LRUDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+        # os.stat calls on the template files
+        self.probes = 0
+        # Optional PlanStore of the templates content
+        self.store = None
+
+    def get(self, path):
+        """Return the Template for path, or None if it can't be read"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                # Put it back as the most recently used one
+                self.entries[path] = entry
+                if now - entry[3] < self.check_interval:
+                    self.hits += 1
+                    return entry[2]
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.forget(path)
+            return None
+        finally:
+            self.probes += 1
+
+        if entry is not None and \
+                entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+            entry[3] = now
+            with self.lock:
+                self.hits += 1
+            return entry[2]
+
+        content = None
+        if self.store is not None:
+            key = 'template:%r' % ((path, stat.st_mtime, stat.st_size),)
+            content = self.store.get(key)
+        if content is None:
+            try:
+                with open(path, 'r') as template_file:
+                    content = template_file.read()
+            except IOError:
+                self.forget(path)
+                return None
+            if self.store is not None:
+                self.store.put(key, content)
+        template = Template(content)
+
+        with self.lock:
+            self.misses += 1
+            if entry is not None:
+                self.reloads += 1
+            self.entries.pop(path, None)
+            self.entries[path] = [stat.st_mtime, stat.st_size, template, now]
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return template
+
+    def forget(self, path):
+        """Drop a path from the cache"""
+        with self.lock:
+            self.entries.pop(path, None)
+
+    def clear(self):
+        """Drop all the cached templates"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return the cache counters as a dict"""
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'evictions': self.evictions,
+                'probes': self.probes,
+            }
+
+
+class KeyedCache(object):
+    """LRU cache of values computed for the elements, like their parsed
+    perf_data or their graph plan.
+
+    Entries are keyed by the element identity and hold the source the
+    value was computed from (the perf_data, the plan signature), so an
+    entry is only used while the element source is the same.
+    """
+    def __init__(self, max_size=50000):
+        self.max_size = max(1, max_size)
+        # element key -> (source, value)
+        self.entries = LRUDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, source):
+        """Return the value computed from source for key, or None"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != source:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, source, value):
+        """Store the value computed from source for key"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (source, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all the cached values"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return the cache counters as a dict"""
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive HTTP connections to a Graphite server"""
+    def __init__(self, uri, timeout=30, max_idle=8):
+        parsed = urlparse.urlparse(uri)
+        self.uri = uri
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        """Open a new connection"""
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def request(self, path):
+        """GET path and return (status, content type, body).
+
+        A failing idle connection may have been closed by the server, so
+        the request is tried again once with a new connection.
+        """
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        retry = connection is not None
+        if connection is None:
+            connection = self.new_connection()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not retry:
+                raise
+            connection = self.new_connection()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(connection)
+                    connection = None
+            if connection is not None:
+                connection.close()
+        return (response.status,
+                response.getheader('content-type', 'image/png'),
+                body)
+
+    def close(self):
+        """Close the idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+class RenderCache(object):
+    """Cache of the Graphite renders, bounded in bytes.
+
+    Entries are kept in memory, and in a folder if cache_dir is given.
+    """
+    def __init__(self, max_size=64 * 1024 * 1024, cache_dir=None,
+                 max_dir_size=512 * 1024 * 1024):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.max_dir_size = max_dir_size
+        # key -> (expires, content type, body)
+        self.entries = LRUDict()
+        self.size = 0
+        self.dir_size = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, key):
+        """Return (content type, body, expires) for key, or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return entry[1], entry[2], entry[0]
+                self.size -= len(entry[2])
+        entry = self.get_file(key, now)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.set_memory(key, entry)
+        return entry[1], entry[2], entry[0]
+
+    def set(self, key, content_type, body, ttl):
+        """Store a render for ttl seconds"""
+        entry = (time.time() + ttl, content_type, body)
+        self.set_memory(key, entry)
+        self.set_file(key, entry)
+
+    def set_memory(self, key, entry):
+        """Private function to store an entry in memory"""
+        if len(entry[2]) > self.max_size:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[2])
+            self.entries[key] = entry
+            self.size += len(entry[2])
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+
+    def get_path(self, key):
+        """Private function to get the cache file of a key"""
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest())
+
+    def get_file(self, key, now):
+        """Private function to read an entry from the cache folder"""
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as cache_file:
+                expires, content_type = \
+                    cache_file.readline().rstrip('\n').split(' ', 1)
+                if float(expires) <= now:
+                    return None
+                return (float(expires), content_type, cache_file.read())
+        except (IOError, ValueError):
+            return None
+
+    def set_file(self, key, entry):
+        """Private function to write an entry in the cache folder, and
+        remove the oldest files if the folder is too big."""
+        if not self.cache_dir:
+            return
+        path = self.get_path(key)
+        try:
+            with open(path + '.tmp', 'wb') as cache_file:
+                cache_file.write('%f %s\n' % (entry[0], entry[1]))
+                cache_file.write(entry[2])
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), exp:
+            logger.warning("{prefix}Can't write the render cache file "
+                           "{path}: {err}".format(prefix=DEBUG_PREFIX,
+                                                  path=path, err=exp))
+            return
+
+        with self.lock:
+            if self.dir_size is not None:
+                self.dir_size += len(entry[2])
+                if self.dir_size <= self.max_dir_size:
+                    return
+            self.dir_size = self.purge_dir()
+
+    def purge_dir(self):
+        """Private function to remove the oldest cache files until the
+        folder fits in max_dir_size. Return the folder size."""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+        files.sort()
+        dir_size = sum(size for _, size, _ in files)
+        for _, size, name in files:
+            if dir_size <= self.max_dir_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                dir_size -= size
+            except OSError:
+                pass
+        return dir_size
+
+    def stats(self):
+        """Return the cache counters as a dict"""
+        with self.lock:
+            return {
+                'size': self.size,
+                'entries': len(self.entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class RenderCall(object):
+    """A render request in progress, shared by identical requests"""
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class RenderProxy(object):
+    """Caching proxy for the Graphite renders.
+
+    Identical concurrent requests wait for a single upstream request.
+    Renders are cached for one pixel of the graph time span, within
+    min_ttl and max_ttl seconds.
+    """
+    def __init__(self, uri, cache, timeout=30, min_ttl=10, max_ttl=3600):
+        self.uri = uri
+        self.path = urlparse.urlparse(uri).path or '/'
+        self.cache = cache
+        self.pool = ConnectionPool(uri, timeout)
+        self.timeout = timeout
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.upstream_requests = 0
+
+    def get_ttl(self, path):
+        """Return the cache time of a render path"""
+        spec = GraphSpec.from_url(path)
+        now = time.time()
+        since = parse_graphite_time(spec.get('from'), now)
+        until = parse_graphite_time(spec.get('until') or 'now', now)
+        try:
+            width = max(1, int(spec.get('width', 586)))
+        except ValueError:
+            width = 586
+        if since is None or until is None or until <= since:
+            return self.min_ttl
+        return int(max(self.min_ttl,
+                       min(self.max_ttl, (until - since) / width)))
+
+    def fetch(self, path, min_ttl=0):
+        """Return (status, content type, body, ttl) for a render path,
+        relative to the Graphite uri. A new render is cached for at least
+        min_ttl seconds."""
+        cached = self.cache.get(path)
+        if cached is not None:
+            return (200, cached[0], cached[1],
+                    max(0, int(cached[2] - time.time())))
+
+        with self.lock:
+            call = self.calls.get(path)
+            leader = call is None
+            if leader:
+                call = self.calls[path] = RenderCall()
+
+        if not leader:
+            if not call.event.wait(self.timeout) or call.result is None:
+                return (504, 'text/plain', 'Graphite render timeout', 0)
+            return call.result
+
+        try:
+            call.result = self.fetch_upstream(path, min_ttl)
+        finally:
+            with self.lock:
+                del self.calls[path]
+            call.event.set()
+        return call.result
+
+    def fetch_upstream(self, path, min_ttl=0):
+        """Private function to request a render to Graphite"""
+        with self.lock:
+            self.upstream_requests += 1
+        try:
+            status, content_type, body = self.pool.request(self.path + path)
+        except (httplib.HTTPException, socket.error), exp:
+            logger.warning("{prefix}Graphite render failed: {err}".format(
+                prefix=DEBUG_PREFIX, err=exp))
+            return (502, 'text/plain', 'Graphite render failed', 0)
+        ttl = 0
+        if status == 200:
+            ttl = max(min_ttl, self.get_ttl(path))
+            self.cache.set(path, content_type, body, ttl)
+        return (status, content_type, body, ttl)
+
+    def close(self):
+        """Close the upstream connections"""
+        self.pool.close()
+
+
+class GraphPrewarmer(object):
+    """Background worker requesting the dashboard graphs in advance, so
+    that Graphite (or the render proxy) has them ready when viewed.
+
+    It renders the hosts (and their services) of some hostgroups and the
+    elements recently viewed on the dashboard. Each run requests at most
+    budget URLs, with at most concurrency requests at a time.
+
+    The dashboard time ranges are quantized to step, whole minutes of at
+    least interval seconds, and a run starts at each step: the URLs of a
+    run are the ones viewed until the next run, and the render proxy
+    keeps them for step seconds.
+    """
+    def __init__(self, module, interval=300, concurrency=2, budget=100,
+                 hostgroups=None, recent_size=100, span=14400):
+        self.module = module
+        self.interval = interval
+        self.step = max(1, int(-(-interval // 60))) * 60
+        self.concurrency = max(1, concurrency)
+        self.budget = budget
+        self.hostgroups = hostgroups or []
+        self.recent_size = recent_size
+        self.span = span
+        # id(elt) -> elt, the most recently viewed last
+        self.recent = LRUDict()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.requests = 0
+        self.errors = 0
+
+    def note(self, elt):
+        """Record an element viewed on the dashboard"""
+        with self.lock:
+            self.recent.pop(id(elt), None)
+            self.recent[id(elt)] = elt
+            while len(self.recent) > self.recent_size:
+                self.recent.popitem(last=False)
+
+    def get_elements(self):
+        """Return the elements to render: the members of the hostgroups
+        with their services, then the recently viewed elements."""
+        elts = []
+        datamgr = getattr(self.module.app, 'datamgr', None)
+        for name in self.hostgroups:
+            hostgroup = None
+            if datamgr is not None:
+                hostgroup = datamgr.get_hostgroup(name)
+            if hostgroup is None:
+                continue
+            for host in hostgroup.get_hosts():
+                elts.append(host)
+                elts.extend(host.services)
+        with self.lock:
+            elts.extend(reversed(self.recent.values()))
+        return elts
+
+    def get_urls(self, now=None):
+        """Return the render URLs to request, within the budget"""
+        if now is None:
+            now = time.time()
+        module = self.module
+        context = module.get_graph_context(now - self.span, now, 'dashboard')
+        urls = []
+        seen = set()
+        for elt in self.get_elements():
+            for graph in module.iter_elt_graph_uris(elt, context):
+                url = graph['img_src']
+                if url not in seen:
+                    seen.add(url)
+                    urls.append(url)
+                    if len(urls) >= self.budget:
+                        return urls
+        return urls
+
+    def fetch(self, url):
+        """Request one URL, through the render proxy if it is ours"""
+        module = self.module
+        if module.render_proxy is not None and \
+                url.startswith(module.render_proxy_path + '?'):
+            query = url.partition('?')[2]
+            index = module.get_backend_index(query)
+            if module.is_degraded(module.backends[index]):
+                # Do not load an already struggling Graphite
+                return
+            status = module.render_proxies[index].fetch(
+                'render/?' + query, self.step)[0]
+        else:
+            for index, uri in enumerate(module.backends):
+                if url.startswith(uri):
+                    break
+            else:
+                return
+            if module.is_degraded(uri):
+                return
+            parsed = urlparse.urlparse(url)
+            status = module.graphite_pools[index].request(
+                parsed.path + '?' + parsed.query)[0]
+        with self.lock:
+            self.requests += 1
+            if status != 200:
+                self.errors += 1
+
+    def run_once(self, now=None):
+        """Request the graphs once. Return the number of URLs requested"""
+        urls = Queue.Queue()
+        for url in self.get_urls(now):
+            urls.put(url)
+        count = urls.qsize()
+
+        def work():
+            """Request URLs until there is none left"""
+            while True:
+                try:
+                    url = urls.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.fetch(url)
+                except Exception, exp:
+                    with self.lock:
+                        self.errors += 1
+                    logger.debug("{prefix}Prewarm of {url} failed: "
+                                 "{err}".format(prefix=DEBUG_PREFIX,
+                                                url=url, err=exp))
+
+        workers = [threading.Thread(target=work)
+                   for _ in range(min(self.concurrency, count))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return count
+
+    def start(self):
+        """Start the background thread, if not already running"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='graphite-ui-prewarm')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        self.stop_event.set()
+
+    def run(self):
+        """Background loop, a run at the start of each step"""
+        while not wait_stop(self.stop_event,
+                            self.step - time.time() % self.step):
+            if getattr(self.module, 'app', None) is None:
+                continue
+            try:
+                self.run_once()
+            except Exception, exp:
+                logger.warning("{prefix}Graphs prewarm failed: {err}".format(
+                    prefix=DEBUG_PREFIX,
+                    err=exp))
+
+    def stats(self):
+        """Return the prewarm counters as a dict"""
+        with self.lock:
+            return {
+                'recent': len(self.recent),
+                'requests': self.requests,
+                'errors': self.errors,
+            }
+
+
+class MetricIndex(object):
+    """Index of the metrics Graphite has, in a compact prefix tree.
+
+    A node of the tree is a (names, children, is_metric) tuple: the
+    sorted tuple of its child names, interned and found with bisect, the
+    tuple of their nodes in the same order, None for the leaves, or None
+    instead of the tuple when all of them are leaves, and whether the
+    node is also a metric. The same few names repeat under every host,
+    so a tree takes about 30 MB per million metrics, a quarter of a tree
+    of dicts.
+
+    The metric names come from Graphite metrics/index.json, or from a
+    walk of the whisper files folder. The whisper walk is incremental:
+    only the folders whose mtime changed are listed again.
+
+    Graphite has no way to tell which branches changed, so metrics/index.json
+    is downloaded whole on each refresh. The tree is built again only when
+    its content changed, the sorted list of the names being kept during
+    the build. For the trees too large for that, MetricFinder asks
+    Graphite only the paths of the graphs.
+    """
+
+    def __init__(self, pool=None, whisper_dir=None, refresh_interval=600):
+        self.pool = pool
+        self.whisper_dir = whisper_dir
+        self.refresh_interval = refresh_interval
+        # Seconds between two runs of the background thread
+        self.interval = refresh_interval
+        self.tree = None
+        self.count = 0
+        # Digest of the last metrics/index.json
+        self.digest = None
+        # folder -> (mtime, metric names, sub folders)
+        self.folders = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def freeze(children, is_metric):
+        """Private function to return the node of a {name: node} dict"""
+        names = sorted(children)
+        nodes = tuple([children[name] for name in names])
+        if not any(nodes):
+            nodes = None
+        return (tuple(names), nodes, is_metric)
+
+    @classmethod
+    def close(cls, path):
+        """Private function to freeze the last open node of path"""
+        name, children = path.pop()
+        parent = path[-1][1]
+        parent[name] = cls.freeze(children, name in parent)
+
+    def build(self, names):
+        """Replace the index with a list of metric names.
+
+        Once sorted, the descendants of a node come in a row: only the
+        nodes of the current path are open, as dicts, and each one is
+        frozen when its row ends. A metric sorts before its descendants,
+        so a node is known to be a metric when it is frozen.
+        """
+        names = sorted([str(name) for name in names if name])
+        # [name, {child name: node}] of the open nodes, the root first
+        path = [[None, {}]]
+        count = 0
+        previous = None
+        for name in names:
+            if name == previous:
+                continue
+            previous = name
+            count += 1
+            parts = name.split('.')
+            depth = 0
+            while depth + 1 < len(path) and depth + 1 < len(parts) and \
+                    path[depth + 1][0] == parts[depth]:
+                depth += 1
+            while len(path) > depth + 1:
+                self.close(path)
+            for part in parts[depth:-1]:
+                path.append([intern(part), {}])
+            path[-1][1].setdefault(intern(parts[-1]), None)
+        while len(path) > 1:
+            self.close(path)
+        self.tree = self.freeze(path[0][1], False)
+        self.count = count
+
+    @staticmethod
+    def get_child(node, name):
+        """Private function to return the (found, child node) couple of
+        a name in a node"""
+        names = node[0]
+        index = bisect.bisect_left(names, name)
+        if index == len(names) or names[index] != name:
+            return False, None
+        if node[1] is None:
+            return True, None
+        return True, node[1][index]
+
+    def contains(self, name):
+        """Return True if name is a metric"""
+        node = self.tree
+        nodes = name.split('.')
+        for part in nodes[:-1]:
+            node = self.get_child(node, part)[1]
+            if node is None:
+                return False
+        found, child = self.get_child(node, nodes[-1])
+        return found and (child is None or child[2])
+
+    def expand(self, pattern):
+        """Return the sorted metric names matching a Graphite glob pattern"""
+        found = []
+        self.expand_node(self.tree, pattern.split('.'), [], found)
+        found.sort()
+        return found
+
+    def expand_node(self, node, parts, prefix, found):
+        """Private function to walk a tree for expand"""
+        part = parts[0]
+        if '*' in part or '?' in part or '[' in part:
+            names = fnmatch.filter(node[0], part)
+        else:
+            names = [part]
+        for name in names:
+            exists, child = self.get_child(node, name)
+            if not exists:
+                continue
+            if len(parts) == 1:
+                if child is None or child[2]:
+                    found.append('.'.join(prefix + [name]))
+            elif child is not None:
+                self.expand_node(child, parts[1:], prefix + [name], found)
+
+    def resolve(self, path):
+        """Return the metric names a target path gives.
+
+        While the index is not loaded, or for the patterns we can't
+        expand, the path itself.
+        """
+        if self.tree is None or '{' in path:
+            return [path]
+        if '*' in path or '?' in path or '[' in path:
+            return self.expand(path)
+        if self.contains(path):
+            return [path]
+        return []
+
+    def get_graphite_names(self):
+        """Private function to get the metric names from Graphite, or
+        None if they did not change since the last call"""
+        status, _, body = self.pool.request(
+            urlparse.urlparse(self.pool.uri).path + 'metrics/index.json')
+        if status != 200:
+            raise httplib.HTTPException(
+                'metrics/index.json gave HTTP %d' % status)
+        digest = hashlib.md5(body).digest()
+        if digest == self.digest and self.tree is not None:
+            return None
+        names = json.loads(body)
+        self.digest = digest
+        return names
+
+    def get_whisper_names(self):
+        """Private function to get the metric names from the whisper
+        files, listing again only the changed folders.
+
+        The folders keep the interned last node of their metrics, shared
+        with the tree, not the full names."""
+        names = []
+        folders = {}
+        pending = ['']
+        while pending:
+            relative = pending.pop()
+            folder = os.path.join(self.whisper_dir, relative)
+            try:
+                mtime = os.stat(folder).st_mtime
+            except OSError:
+                continue
+            cached = self.folders.get(relative)
+            if cached is None or cached[0] != mtime:
+                metrics = []
+                subfolders = []
+                try:
+                    entries = os.listdir(folder)
+                except OSError:
+                    continue
+                for entry in entries:
+                    if entry.endswith('.wsp'):
+                        metrics.append(intern(entry[:-4]))
+                    elif os.path.isdir(os.path.join(folder, entry)):
+                        subfolders.append(os.path.join(relative, entry))
+                cached = (mtime, tuple(metrics), tuple(subfolders))
+            folders[relative] = cached
+            prefix = relative.replace(os.sep, '.')
+            if prefix:
+                prefix += '.'
+            names.extend([prefix + metric for metric in cached[1]])
+            pending.extend(cached[2])
+        self.folders = folders
+        return names
+
+    def refresh(self):
+        """Load the metric names again"""
+        if self.whisper_dir:
+            names = self.get_whisper_names()
+        else:
+            names = self.get_graphite_names()
+            if names is None:
+                return
+        self.build(names)
+        logger.debug("{prefix}Metric index loaded, {count} metrics".format(
+            prefix=DEBUG_PREFIX,
+            count=self.count))
+
+    def start(self):
+        """Start the background refresh thread, if not already running"""
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='graphite-ui-metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background refresh thread"""
+        self.stop_event.set()
+
+    def run(self):
+        """Background refresh loop, loading the index at once"""
+        while True:
+            try:
+                self.refresh()
+            except Exception, exp:
+                logger.warning(
+                    "{prefix}Metric index refresh failed: {err}".format(
+                        prefix=DEBUG_PREFIX,
+                        err=exp))
+            if wait_stop(self.stop_event, self.interval):
+                return
+
+
+class MetricFinder(MetricIndex):
+    """Index of the metrics Graphite has, filled with metrics/find for
+    the paths of the graphs only, for the trees too large to download
+    whole with metrics/index.json.
+
+    An unknown path is given as is and queued for the background thread,
+    which asks it to Graphite. The names found are given for the path
+    until it is asked again, refresh_interval seconds later. Above
+    max_paths, the least recently used paths are dropped.
+    """
+    # Seconds between two looks at the queued paths
+    FIND_INTERVAL = 1
+
+    def __init__(self, pool, refresh_interval=600, max_paths=100000):
+        MetricIndex.__init__(self, pool, None, refresh_interval)
+        self.interval = self.FIND_INTERVAL
+        self.max_paths = max_paths
+        self.lock = threading.Lock()
+        # path -> (time found, tuple of the metric names)
+        self.paths = LRUDict()
+        self.queued = set()
+
+    def resolve(self, path):
+        """Return the metric names a target path gives, the path itself
+        until Graphite was asked"""
+        if '{' in path:
+            return [path]
+        with self.lock:
+            entry = self.paths.pop(path)
+            if entry is None:
+                self.queued.add(path)
+                return [path]
+            self.paths[path] = entry
+            if entry[0] + self.refresh_interval < time.time():
+                self.queued.add(path)
+        return list(entry[1])
+
+    def find(self, path):
+        """Private function to get the metric names matching path from
+        Graphite metrics/find.
+
+        The completer format gives the full path of the nodes, but it
+        also matches the names path is a prefix of: they are filtered
+        out here.
+        """
+        status, _, body = self.pool.request(
+            urlparse.urlparse(self.pool.uri).path + 'metrics/find?' +
+            urllib.urlencode({'query': path, 'format': 'completer'}))
+        if status != 200:
+            raise httplib.HTTPException(
+                'metrics/find gave HTTP %d' % status)
+        parts = path.split('.')
+        names = []
+        for node in json.loads(body).get('metrics', []):
+            if str(node.get('is_leaf')) != '1':
+                continue
+            name = str(node['path'])
+            nodes = name.split('.')
+            if len(nodes) != len(parts):
+                continue
+            for node_part, part in zip(nodes, parts):
+                if not fnmatch.fnmatchcase(node_part, part):
+                    break
+            else:
+                names.append(name)
+        names.sort()
+        return tuple(names)
+
+    def refresh(self):
+        """Ask Graphite the queued paths"""
+        with self.lock:
+            queued = list(self.queued)
+            self.queued.clear()
+        try:
+            while queued:
+                names = self.find(queued[-1])
+                with self.lock:
+                    self.paths[queued.pop()] = (time.time(), names)
+                    while len(self.paths) > self.max_paths:
+                        self.paths.popitem(last=False)
+                    self.count = len(self.paths)
+        finally:
+            # Ask again the paths left by an error
+            if queued:
+                with self.lock:
+                    self.queued.update(queued)
+
+
+class WhisperReader(object):
+    """Read the series of the whisper files of a co-located carbon, with
+    mmap, without going through graphite-web."""
+    METADATA = struct.Struct('!2LfL')
+    ARCHIVE_INFO = struct.Struct('!3L')
+    POINT = struct.Struct('!Ld')
+
+    def __init__(self, whisper_dir):
+        self.whisper_dir = whisper_dir
+
+    @staticmethod
+    def is_plain(name):
+        """Return True if name is a metric name we can read, and not a
+        pattern or a Graphite function."""
+        if not name:
+            return False
+        for part in name.split('.'):
+            if not part or part == '..' or \
+                    not part.replace('-', '').replace('_', '').isalnum():
+                return False
+        return True
+
+    def get_path(self, name):
+        """Return the whisper file of a metric name"""
+        return os.path.join(self.whisper_dir,
+                            *name.split('.')) + '.wsp'
+
+    def has(self, name):
+        """Return True if name is a plain metric with a whisper file"""
+        return self.is_plain(name) and os.path.isfile(self.get_path(name))
+
+    def fetch(self, name, since, until=None, now=None):
+        """Return (start, end, step, values) of a metric between since and
+        until, from the archive with the best precision for since.
+
+        Missing points are None. Return None without whisper file.
+        """
+        if not self.is_plain(name):
+            return None
+        if now is None:
+            now = int(time.time())
+        try:
+            whisper_file = open(self.get_path(name), 'rb')
+        except IOError:
+            return None
+        try:
+            data = mmap.mmap(whisper_file.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            whisper_file.close()
+            return None
+        try:
+            return self.read(data, int(since), until, int(now))
+        finally:
+            data.close()
+            whisper_file.close()
+
+    def read(self, data, since, until, now):
+        """Private function to read a series from a mapped whisper file,
+        the same way whisper.fetch does"""
+        _, max_retention, _, archive_count = \
+            self.METADATA.unpack_from(data, 0)
+        if until is None or until > now:
+            until = now
+        until = int(until)
+        if since < now - max_retention:
+            since = now - max_retention
+        if since >= until:
+            return None
+
+        archive = None
+        for index in range(archive_count):
+            archive = self.ARCHIVE_INFO.unpack_from(
+                data, self.METADATA.size + index * self.ARCHIVE_INFO.size)
+            if archive[1] * archive[2] >= now - since:
+                break
+        offset, step, points = archive
+
+        from_interval = since - since % step + step
+        until_interval = until - until % step + step
+        if from_interval == until_interval:
+            until_interval += step
+        count = (until_interval - from_interval) // step
+        values = [None] * count
+
+        base_interval = self.POINT.unpack_from(data, offset)[0]
+        if base_interval == 0:
+            return (from_interval, until_interval, step, values)
+
+        size = points * self.POINT.size
+        position = (from_interval - base_interval) // step
+        for index in xrange(count):
+            point_offset = offset + \
+                ((position + index) * self.POINT.size) % size
+            point_time, value = self.POINT.unpack_from(data, point_offset)
+            if point_time == from_interval + index * step:
+                values[index] = value
+        return (from_interval, until_interval, step, values)
+
+    def get_series(self, name, since, until=None, now=None):
+        """Return a Graphite like {'target', 'datapoints'} dict, or None"""
+        result = self.fetch(name, since, until, now)
+        if result is None:
+            return None
+        start, _, step, values = result
+        return {
+            'target': name,
+            'datapoints': [[value, start + index * step]
+                           for index, value in enumerate(values)],
+        }
+
+
+def render_png(series, width, height):
+    """Draw the datapoints of series as lines on a white PNG image.
+
+    A simple graph, without axes nor legend, for the whisper backend.
+    """
+    width = max(2, int(width))
+    height = max(2, int(height))
+    colors = ((0, 0, 255), (0, 160, 0), (255, 0, 0), (255, 128, 0))
+    pixels = [bytearray('\xff' * (width * 3)) for _ in xrange(height)]
+
+    points = [point for serie in series for point in serie['datapoints']
+              if point[0] is not None]
+    if points:
+        min_time = min(point[1] for point in points)
+        max_time = max(point[1] for point in points)
+        min_value = min(0, min(point[0] for point in points))
+        max_value = max(point[0] for point in points)
+        time_scale = float(width - 1) / max(1, max_time - min_time)
+        value_scale = float(height - 1) / ((max_value - min_value) or 1)
+        for index, serie in enumerate(series):
+            color = colors[index % len(colors)]
+            previous = None
+            for value, point_time in serie['datapoints']:
+                if value is None:
+                    previous = None
+                    continue
+                current = (int((point_time - min_time) * time_scale),
+                           height - 1 - int((value - min_value) * value_scale))
+                for x, y in draw_line(previous or current, current):
+                    pixels[y][x * 3:x * 3 + 3] = bytearray(color)
+                previous = current
+
+    raw = ''.join('\x00' + str(row) for row in pixels)
+
+    def chunk(kind, content):
+        """Return a PNG chunk"""
+        return struct.pack('!L', len(content)) + kind + content + \
+            struct.pack('!L', zlib.crc32(kind + content) & 0xffffffff)
+
+    return ''.join([
+        '\x89PNG\r\n\x1a\n',
+        chunk('IHDR', struct.pack('!2L5B', width, height, 8, 2, 0, 0, 0)),
+        chunk('IDAT', zlib.compress(raw)),
+        chunk('IEND', ''),
+    ])
+
+
+def draw_line(start, end):
+    """Return the pixels of a line, with Bresenham algorithm"""
+    x0, y0 = start
+    x1, y1 = end
+    dx = abs(x1 - x0)
+    dy = -abs(y1 - y0)
+    step_x = 1 if x0 < x1 else -1
+    step_y = 1 if y0 < y1 else -1
+    error = dx + dy
+    pixels = []
+    while True:
+        pixels.append((x0, y0))
+        if x0 == x1 and y0 == y1:
+            return pixels
+        double_error = 2 * error
+        if double_error >= dy:
+            error += dy
+            x0 += step_x
+        if double_error <= dx:
+            error += dx
+            y0 += step_y
+
+
+class TemplateIndex(object):
+    """In-memory index of the .graph files available under templates_path.
+
+    The folder is scanned once, so looking for a template that does not
+    exist costs nothing. A background thread scans it again when the
+    folders mtime change (a file was added, removed or renamed).
+
+    With a PlanStore, the store generation is the folders signature, and
+    the index found by the first worker process is used by the others.
+    """
+    def __init__(self, path, refresh_interval=60):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        # Optional PlanStore of the index
+        self.store = None
+        # (source, name) -> path, with None as source for the root folder
+        self.templates = None
+        self.signature = None
+        self.scans = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get_signature(self):
+        """Return the mtime of the templates folder and its sub-folders"""
+        signature = []
+        try:
+            signature.append(('', os.stat(self.path).st_mtime))
+            names = sorted(os.listdir(self.path))
+        except OSError:
+            return tuple(signature)
+        for name in names:
+            full_path = os.path.join(self.path, name)
+            if os.path.isdir(full_path):
+                try:
+                    signature.append((name, os.stat(full_path).st_mtime))
+                except OSError:
+                    pass
+        return tuple(signature)
+
+    def scan(self):
+        """Build the index of the available templates"""
+        with self.lock:
+            signature = self.get_signature()
+            templates = None
+            if self.store is not None:
+                self.store.set_generation(repr((self.path, signature)))
+                templates = self.load()
+            if templates is None:
+                templates = self.find_templates()
+                if self.store is not None:
+                    self.save(templates)
+            self.signature = signature
+            self.templates = templates
+            self.scans += 1
+        logger.debug("{prefix}Found {count} templates in {path}".format(
+            prefix=DEBUG_PREFIX,
+            count=len(templates),
+            path=self.path))
+
+    def find_templates(self):
+        """Return the (source, name) -> path dict of the templates files"""
+        templates = {}
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            names = []
+        for name in names:
+            full_path = os.path.join(self.path, name)
+            if name.endswith('.graph'):
+                if os.path.isfile(full_path):
+                    templates[(None, name[:-6])] = full_path
+            elif os.path.isdir(full_path):
+                try:
+                    sub_names = os.listdir(full_path)
+                except OSError:
+                    continue
+                for sub_name in sub_names:
+                    sub_path = os.path.join(full_path, sub_name)
+                    if sub_name.endswith('.graph') and \
+                            os.path.isfile(sub_path):
+                        templates[(name, sub_name[:-6])] = sub_path
+        return templates
+
+    def load(self):
+        """Return the templates dict written in the store, or None"""
+        value = self.store.get('templates')
+        if value is None:
+            return None
+        templates = {}
+        for line in value.splitlines():
+            source, name, path = line.split('\0')
+            templates[(source or None, name)] = path
+        return templates
+
+    def save(self, templates):
+        """Write the templates dict in the store, a line per template"""
+        self.store.put('templates', '\n'.join(
+            '\0'.join((source or '', name, path))
+            for (source, name), path in templates.iteritems()))
+
+    def refresh(self):
+        """Scan the templates folder again if it changed.
+
+        Return True if the index was rebuilt.
+        """
+        if self.templates is not None and \
+                self.get_signature() == self.signature:
+            return False
+        self.scan()
+        return True
+
+    def lookup(self, source, command, arg=None):
+        """Return the template path for a check command, or None.
+
+        Look for <source>/<command>.graph, then for NRPE like commands
+        <source>/<command>_<arg>.graph, and at last the same file name in
+        the templates_path root folder.
+        """
+        templates = self.templates
+        if templates is None:
+            self.scan()
+            templates = self.templates
+        path = templates.get((source, command))
+        if path is not None:
+            return path
+        name = command
+        if arg is not None:
+            name = "{command}_{arg}".format(command=command, arg=arg)
+            path = templates.get((source, name))
+            if path is not None:
+                return path
+        return templates.get((None, name))
+
+    def start(self):
+        """Start the background refresh thread, if not already running"""
+        if self.refresh_interval <= 0 or \
+                (self.thread is not None and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='graphite-ui-templates')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background refresh thread"""
+        self.stop_event.set()
+
+    def run(self):
+        """Background refresh loop"""
+        while not wait_stop(self.stop_event, self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception, exp:
+                logger.warning(
+                    "{prefix}Templates index refresh failed: {err}".format(
+                        prefix=DEBUG_PREFIX,
+                        err=exp))
+
+
+class PlanStore(object):
+    """The .graph templates index and content shared by the WebUI worker
+    processes, in a memory mapped file.
+
+    The graph plans themselves are not shared: computing one is a few
+    regex substitutions, cheaper than a lookup in the file.
+
+    The file is a header (magic, format, generation, entries count), a
+    table of (offset, length) and the entries: key, a newline and the raw
+    value string. Readers map it and index the keys once per file version,
+    so a lookup is a dict access and a slice, the values are not decoded.
+
+    New entries are kept in memory and merged into the file by flush(),
+    which rewrites it and renames it in place under a lock file. The
+    generation is a digest of what the entries depend on: a file of
+    another generation is ignored, and replaced by the next flush.
+    """
+    MAGIC = 'GUIS'
+    FORMAT = 2
+    HEADER = struct.Struct('!4sH16sI')
+    ENTRY = struct.Struct('!II')
+
+    def __init__(self, path, interval=10):
+        self.path = path
+        self.interval = interval
+        self.generation = '\0' * 16
+        # key -> value, not yet in the file
+        self.pending = {}
+        # (mmap, key -> (value start, value end)), replaced as a whole on
+        # reload
+        self.mapping = (None, {})
+        self.file_id = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def set_generation(self, generation):
+        """Use the entries of a generation, given as a string"""
+        generation = hashlib.md5(generation).digest()
+        if generation == self.generation:
+            return
+        with self.lock:
+            self.generation = generation
+            self.pending = {}
+        self.file_id = None
+        self.reload()
+
+    def reload(self):
+        """Map the store file again if it changed"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.mapping = (None, {})
+            self.file_id = None
+            return
+        file_id = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if file_id == self.file_id:
+            return
+        data = None
+        positions = {}
+        try:
+            with open(self.path, 'rb') as store_file:
+                data = mmap.mmap(store_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError), exp:
+            logger.warning("{prefix}Can't map the plan store {path}: "
+                           "{err}".format(prefix=DEBUG_PREFIX,
+                                          path=self.path, err=exp))
+        if data is not None:
+            positions = self.read_positions(data)
+            if positions is None:
+                data.close()
+                data, positions = None, {}
+        # The previous mmap is closed when no reader uses it anymore
+        self.mapping = (data, positions)
+        self.file_id = file_id
+
+    def check_header(self, data):
+        """Return the entries count of a store file of our generation, or
+        None"""
+        if len(data) < self.HEADER.size:
+            return None
+        magic, file_format, generation, count = \
+            self.HEADER.unpack_from(data, 0)
+        if magic != self.MAGIC or file_format != self.FORMAT or \
+                generation != self.generation or \
+                len(data) < self.HEADER.size + count * self.ENTRY.size:
+            return None
+        return count
+
+    def read_positions(self, data):
+        """Return the key -> (value start, value end) dict of a store file
+        content of our generation, or None"""
+        count = self.check_header(data)
+        if count is None:
+            return None
+        positions = {}
+        for index in xrange(count):
+            offset, length = self.ENTRY.unpack_from(
+                data, self.HEADER.size + index * self.ENTRY.size)
+            end = offset + length
+            newline = data.find('\n', offset, end)
+            if newline < 0:
+                return None
+            positions[data[offset:newline]] = (newline + 1, end)
+        return positions
+
+    def get(self, key):
+        """Return the value of a key, or None"""
+        value = self.pending.get(key)
+        if value is not None:
+            return value
+        data, positions = self.mapping
+        position = positions.get(key)
+        if position is not None:
+            self.hits += 1
+            return data[position[0]:position[1]]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Set the string value of a key, written on the next flush"""
+        with self.lock:
+            self.pending[key] = value
+
+    def read_entries(self, data):
+        """Return the key -> value dict of a store file content of our
+        generation"""
+        positions = self.read_positions(data) or {}
+        return dict((key, data[start:end])
+                    for key, (start, end) in positions.iteritems())
+
+    def flush(self):
+        """Merge the new entries into the store file"""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            generation = self.generation
+        if not pending:
+            return
+        try:
+            with open(self.path + '.lock', 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    with open(self.path, 'rb') as store_file:
+                        entries = self.read_entries(store_file.read())
+                except IOError:
+                    entries = {}
+                entries.update(pending)
+                self.write(entries, generation)
+        except (IOError, OSError), exp:
+            logger.warning("{prefix}Can't write the plan store {path}: "
+                           "{err}".format(prefix=DEBUG_PREFIX,
+                                          path=self.path, err=exp))
+            return
+        self.flushes += 1
+        self.reload()
+
+    def write(self, entries, generation):
+        """Write the store file with entries, a key -> value dict"""
+        table = []
+        blobs = []
+        offset = self.HEADER.size + len(entries) * self.ENTRY.size
+        for key, value in entries.iteritems():
+            blob = key + '\n' + value
+            table.append(self.ENTRY.pack(offset, len(blob)))
+            blobs.append(blob)
+            offset += len(blob)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as store_file:
+            store_file.write(self.HEADER.pack(
+                self.MAGIC, self.FORMAT, generation, len(entries)))
+            store_file.write(''.join(table))
+            store_file.write(''.join(blobs))
+        os.rename(tmp_path, self.path)
+
+    def stats(self):
+        """Return the store counters as a dict"""
+        return {
+            'size': len(self.mapping[1]),
+            'pending': len(self.pending),
+            'hits': self.hits,
+            'misses': self.misses,
+            'flushes': self.flushes,
+        }
+
+    def start(self):
+        """Start the background flush and reload thread, if not already
+        running"""
+        if self.interval <= 0 or \
+                (self.thread is not None and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='graphite-ui-plan-store')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread, and write the new entries"""
+        self.stop_event.set()
+        self.flush()
+
+    def run(self):
+        """Background flush and reload loop"""
+        while not wait_stop(self.stop_event, self.interval):
+            try:
+                self.flush()
+                self.reload()
+            except Exception, exp:
+                logger.warning("{prefix}Plan store update failed: "
+                               "{err}".format(prefix=DEBUG_PREFIX, err=exp))
+
+
+class HotPathStats(object):
+    """Counters of the get_graph_uris calls, for the instrumentation.
+
+    Per source: the calls, the graphs given, and an histogram of the
+    calls latency. Also the template and fallback paths taken, and the
+    perf_data parsings with their time.
+
+    With an export address (statsd://host:port or carbon://host:port), a
+    background thread sends the counters to statsd as gauges, or to
+    carbon with its plaintext protocol.
+    """
+    def __init__(self, export=None, prefix='shinken.webui.graphite',
+                 interval=60):
+        self.prefix = prefix
+        self.interval = interval
+        self.export = None
+        if export:
+            address = urlparse.urlparse(export)
+            if address.scheme in ('statsd', 'carbon') and address.hostname:
+                self.export = (address.scheme, address.hostname,
+                               address.port or EXPORT_PORTS[address.scheme])
+            else:
+                logger.warning("{prefix}Unknown instrumentation_export "
+                               "{export}, not exporting".format(
+                                   prefix=DEBUG_PREFIX, export=export))
+        # source -> [calls, graphs, total time, histogram]
+        self.sources = {}
+        self.paths = {'template': 0, 'fallback': 0}
+        self.parses = 0
+        self.parse_time = 0.0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add_call(self, source, elapsed, graphs):
+        """Count a get_graph_uris call that took elapsed seconds"""
+        elapsed_ms = elapsed * 1000
+        bucket = len(LATENCY_BUCKETS)
+        for index, limit in enumerate(LATENCY_BUCKETS):
+            if elapsed_ms <= limit:
+                bucket = index
+                break
+        with self.lock:
+            counters = self.sources.get(source)
+            if counters is None:
+                counters = self.sources[source] = \
+                    [0, 0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+            counters[0] += 1
+            counters[1] += graphs
+            counters[2] += elapsed
+            counters[3][bucket] += 1
+
+    def add_path(self, path):
+        """Count a template or fallback path taken for an element"""
+        with self.lock:
+            self.paths[path] += 1
+
+    def add_parse(self, elapsed):
+        """Count a perf_data parsing that took elapsed seconds"""
+        with self.lock:
+            self.parses += 1
+            self.parse_time += elapsed
+
+    def stats(self):
+        """Return the counters as a dict"""
+        buckets = ['le_%d' % limit for limit in LATENCY_BUCKETS] + ['inf']
+        with self.lock:
+            sources = {}
+            for source, counters in self.sources.iteritems():
+                sources[source] = {
+                    'calls': counters[0],
+                    'graphs': counters[1],
+                    'time': counters[2],
+                    'latency_ms': dict(zip(buckets, counters[3])),
+                }
+            return {
+                'sources': sources,
+                'paths': dict(self.paths),
+                'perf_data': {'parses': self.parses,
+                              'time': self.parse_time},
+            }
+
+    @classmethod
+    def flatten(cls, stats, prefix=''):
+        """Return the (path, value) couples of the numbers of a dict"""
+        res = []
+        for key in sorted(stats):
+            value = stats[key]
+            path = prefix + re.sub(r'[^\w-]', '_', str(key))
+            if isinstance(value, dict):
+                res.extend(cls.flatten(value, path + '.'))
+            else:
+                res.append((path, value))
+        return res
+
+    def get_lines(self, stats, now=None):
+        """Return the export protocol lines of stats"""
+        if now is None:
+            now = time.time()
+        kind = self.export[0]
+        lines = []
+        for path, value in self.flatten(stats, self.prefix + '.'):
+            if kind == 'statsd':
+                lines.append('%s:%s|g' % (path, value))
+            else:
+                lines.append('%s %s %d' % (path, value, now))
+        return lines
+
+    def send(self, stats):
+        """Send stats to the export address"""
+        kind, host, port = self.export
+        lines = self.get_lines(stats)
+        if kind == 'statsd':
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                # One datagram per metric, to stay under the MTU
+                for line in lines:
+                    sock.sendto(line, (host, port))
+            finally:
+                sock.close()
+        else:
+            sock = socket.create_connection((host, port), 5)
+            try:
+                sock.sendall('\n'.join(lines) + '\n')
+            finally:
+                sock.close()
+
+    def start(self, get_stats):
+        """Start the background export thread of the stats given by the
+        get_stats function, if there is an export address"""
+        if self.export is None or self.interval <= 0 or \
+                (self.thread is not None and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(get_stats,),
+            name='graphite-ui-stats')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background export thread"""
+        self.stop_event.set()
+
+    def run(self, get_stats):
+        """Background export loop"""
+        while not wait_stop(self.stop_event, self.interval):
+            try:
+                self.send(get_stats())
+            except (socket.error, IOError), exp:
+                logger.warning("{prefix}Stats export failed: {err}".format(
+                    prefix=DEBUG_PREFIX, err=exp))
+
+
+class BackendRing(object):
+    """Consistent hash ring of the Graphite backends.
+
+    Each backend has BACKEND_REPLICAS points on the ring, and a key goes
+    to the backend of the next point, so adding a backend only moves the
+    keys of the ring parts it takes.
+    """
+    def __init__(self, uris, replicas=BACKEND_REPLICAS):
+        self.uris = list(uris)
+        points = sorted(
+            (self.hash('%s#%d' % (uri, replica)), uri)
+            for uri in self.uris for replica in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    @staticmethod
+    def hash(key):
+        """Return the ring position of a key"""
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get(self, key):
+        """Return the backend uri of a key"""
+        if len(self.uris) == 1:
+            return self.uris[0]
+        index = bisect.bisect(self.hashes, self.hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+
+class BackendHealth(object):
+    """Background probe of a Graphite server, with a circuit breaker.
+
+    A probe is a cheap render request. It fails on an error, an HTTP
+    status other than 200, or when slower than max_latency seconds.
+
+    The circuit is closed while Graphite is healthy. After failures
+    failed probes in a row it opens: the graphs are degraded. After
+    cooldown seconds it is half-open: a failed probe opens it again,
+    and recoveries successful probes in a row close it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    PROBE_PATH = 'render/?target=constantLine(1)&from=-5min&format=json'
+
+    def __init__(self, pool, interval=10, max_latency=2, failures=3,
+                 cooldown=30, recoveries=2, window=20):
+        self.pool = pool
+        self.path = urlparse.urlparse(pool.uri).path + self.PROBE_PATH
+        self.interval = interval
+        self.max_latency = max_latency
+        self.failures = failures
+        self.cooldown = cooldown
+        self.recoveries = recoveries
+        self.state = self.CLOSED
+        self.opened = 0
+        # Failed or successful probes in a row
+        self.streak = 0
+        # Results of the last probes, True for the failed ones
+        self.results = deque(maxlen=window)
+        self.latency = None
+        self.probes = 0
+        self.transitions = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def is_healthy(self):
+        """Return True if the graphs do not have to be degraded"""
+        return self.state == self.CLOSED
+
+    def probe(self, now=None):
+        """Request Graphite once and record the result, return the state"""
+        start = time.time()
+        try:
+            status, _, _ = self.pool.request(self.path)
+            success = status == 200
+        except (httplib.HTTPException, socket.error):
+            success = False
+        latency = time.time() - start
+        return self.record(success and latency <= self.max_latency,
+                           latency, now)
+
+    def record(self, success, latency, now=None):
+        """Record a probe result and return the new state"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.probes += 1
+            self.results.append(not success)
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+            state = self.state
+            if state == self.OPEN and now - self.opened >= self.cooldown:
+                state = self.HALF_OPEN
+                self.streak = 0
+            if state == self.CLOSED:
+                self.streak = 0 if success else self.streak + 1
+                if self.streak >= self.failures:
+                    state = self.OPEN
+                    self.opened = now
+                    self.streak = 0
+            elif state == self.HALF_OPEN:
+                if not success:
+                    state = self.OPEN
+                    self.opened = now
+                    self.streak = 0
+                else:
+                    self.streak += 1
+                    if self.streak >= self.recoveries:
+                        state = self.CLOSED
+                        self.streak = 0
+
+            if state != self.state:
+                self.transitions += 1
+                logger.warning("{prefix}Graphite {uri} is now {state} "
+                               "(latency {latency:.3f}s)".format(
+                                   prefix=DEBUG_PREFIX, uri=self.pool.uri,
+                                   state=state, latency=latency))
+                self.state = state
+            return state
+
+    def stats(self):
+        """Return the health counters as a dict"""
+        results = list(self.results)
+        return {
+            'uri': self.pool.uri,
+            'state': self.state,
+            'latency': self.latency,
+            'error_rate': float(sum(results)) / len(results) if results
+                          else 0.0,
+            'probes': self.probes,
+            'transitions': self.transitions,
+        }
+
+    def start(self):
+        """Start the background probe thread, if not already running"""
+        if self.interval <= 0 or \
+                (self.thread is not None and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='graphite-ui-health')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background probe thread"""
+        self.stop_event.set()
+
+    def run(self):
+        """Background probe loop"""
+        while not wait_stop(self.stop_event, self.interval):
+            try:
+                self.probe()
+            except Exception, exp:
+                logger.warning("{prefix}Graphite health probe failed: "
+                               "{err}".format(prefix=DEBUG_PREFIX, err=exp))
+
+
 class GraphiteWebui(BaseModule):
     """Main module class"""
     def __init__(self, modconf):
@@ -64,36 +2419,461 @@ class GraphiteWebui(BaseModule):
         self.uri = getattr(modconf, 'uri', None)
         self.templates_path = getattr(modconf, 'templates_path', '/tmp')
 
-        if not self.uri:
+        if not self.uri or not self.uri.strip(' ,'):
             raise Exception(
                 'The WebUI Graphite module is missing uri parameter.')
 
-        self.uri = self.uri.strip()
-        if not self.uri.endswith('/'):
-            self.uri += '/'
-
-        # Change YOURSERVERNAME by our server name if we got it
-        if 'YOURSERVERNAME' in self.uri:
-            my_name = socket.gethostname()
-            self.uri = self.uri.replace('YOURSERVERNAME', my_name)
+        # Several Graphite backends can be given, separated by commas. The
+        # hosts are spread on them, self.uri is the first one.
+        self.backends = []
+        for uri in self.uri.split(','):
+            uri = uri.strip()
+            if uri:
+                self.backends.append(self.normalize_uri(uri))
+        self.uri = self.backends[0]
+        self.backend_ring = BackendRing(self.backends)
 
         # optional "sub-folder" in graphite to hold the data of a specific host
         self.graphite_data_source = self.illegal_char.sub(
             '_',
             getattr(modconf, 'graphite_data_source', ''))
 
+        # Parsed .graph templates, so we do not read them on each call
+        self.template_cache = TemplateCache(
+            int(getattr(modconf, 'template_cache_size', 256)),
+            float(getattr(modconf, 'template_check_interval', 0)))
+
+        # How the graphs time range is written in the URLs
+        self.time_format = getattr(modconf, 'time_format', 'legacy')
+        if self.time_format not in TIME_FORMATS:
+            logger.warning("{prefix}Unknown time_format {time_format}, using "
+                           "legacy".format(prefix=DEBUG_PREFIX,
+                                           time_format=self.time_format))
+            self.time_format = 'legacy'
+        self.quantize_time_range = \
+            getattr(modconf, 'quantize_time_range', '0') == '1'
+
+        # Without template, one graph per metric, or one per service
+        self.graph_mode = getattr(modconf, 'graph_mode', 'metric')
+        if self.graph_mode not in GRAPH_MODES:
+            logger.warning("{prefix}Unknown graph_mode {mode}, using "
+                           "metric".format(prefix=DEBUG_PREFIX,
+                                           mode=self.graph_mode))
+            self.graph_mode = 'metric'
+
+        # Points asked to Graphite, and their consolidation
+        self.max_data_points = getattr(modconf, 'max_data_points', '1') == '1'
+        self.consolidation = getattr(modconf, 'consolidation', 'none')
+        if self.consolidation not in CONSOLIDATIONS:
+            logger.warning("{prefix}Unknown consolidation {consolidation}, "
+                           "using none".format(
+                               prefix=DEBUG_PREFIX,
+                               consolidation=self.consolidation))
+            self.consolidation = 'none'
+        self.consolidation_function = getattr(
+            modconf, 'consolidation_function', 'avg')
+        if self.consolidation_function not in CONSOLIDATION_FUNCTIONS:
+            logger.warning("{prefix}Unknown consolidation_function "
+                           "{function}, using avg".format(
+                               prefix=DEBUG_PREFIX,
+                               function=self.consolidation_function))
+            self.consolidation_function = 'avg'
+        self.template_consolidation = \
+            getattr(modconf, 'template_consolidation', '0') == '1'
+
+        # Draw the perf_data thresholds as constant lines
+        self.threshold_lines = \
+            getattr(modconf, 'threshold_lines', '0') == '1'
+
+        # Add to the host graphs the metrics of its services, grouped by
+        # unit in a few renders
+        self.host_overview = getattr(modconf, 'host_overview', '0') == '1'
+        self.host_overview_max_targets = int(
+            getattr(modconf, 'host_overview_max_targets', 10))
+
+        # Optional caching proxy for the graph images
+        # One per backend, with a shared cache
+        self.render_proxy = None
+        self.render_proxies = []
+        self.render_proxy_path = getattr(
+            modconf, 'render_proxy_path', '/graphite/render')
+        if getattr(modconf, 'render_proxy', '0') == '1':
+            cache = RenderCache(
+                int(getattr(modconf, 'render_proxy_cache_size',
+                            64 * 1024 * 1024)),
+                getattr(modconf, 'render_proxy_cache_dir', None),
+                int(getattr(modconf, 'render_proxy_cache_dir_size',
+                            512 * 1024 * 1024)))
+            for uri in self.backends:
+                self.render_proxies.append(RenderProxy(
+                    uri,
+                    cache,
+                    float(getattr(modconf, 'render_proxy_timeout', 30)),
+                    int(getattr(modconf, 'render_proxy_min_ttl', 10)),
+                    int(getattr(modconf, 'render_proxy_max_ttl', 3600))))
+            self.render_proxy = self.render_proxies[0]
+
+        # Optional background requests of the dashboard graphs
+        self.app = None
+        self.prewarmer = None
+        if getattr(modconf, 'prewarm', '0') == '1':
+            self.prewarmer = GraphPrewarmer(
+                self,
+                float(getattr(modconf, 'prewarm_interval', 300)),
+                int(getattr(modconf, 'prewarm_concurrency', 2)),
+                int(getattr(modconf, 'prewarm_budget', 100)),
+                [name.strip() for name in
+                 getattr(modconf, 'prewarm_hostgroups', '').split(',')
+                 if name.strip()],
+                int(getattr(modconf, 'prewarm_recent', 100)),
+                int(getattr(modconf, 'prewarm_span', 14400)))
+
+        # Optional JSON data endpoint for the graphs
+        self.graph_data = getattr(modconf, 'graph_data', '0') == '1'
+        self.data_path = getattr(modconf, 'data_path', '/graphite/data')
+
+        # Keep-alive connections to Graphite, for our own requests
+        self.graphite_pools = [ConnectionPool(uri) for uri in self.backends]
+        self.graphite_pool = self.graphite_pools[0]
+
+        # Optional health probe of each Graphite backend: while one is slow
+        # or failing, the graphs of its elements are reduced, or replaced
+        # by a placeholder image
+        self.health = None
+        self.healths = []
+        self.health_mode = getattr(modconf, 'health_mode', 'reduce')
+        if self.health_mode not in HEALTH_MODES:
+            logger.warning("{prefix}Unknown health_mode {mode}, using "
+                           "reduce".format(prefix=DEBUG_PREFIX,
+                                           mode=self.health_mode))
+            self.health_mode = 'reduce'
+        self.health_max_graphs = int(getattr(modconf, 'health_max_graphs', 2))
+        self.health_max_targets = int(
+            getattr(modconf, 'health_max_targets', 4))
+        self.placeholder_path = getattr(
+            modconf, 'placeholder_path', '/graphite/unavailable')
+        self.placeholder_uri = getattr(modconf, 'placeholder_uri', None)
+        if getattr(modconf, 'health_check', '0') == '1':
+            for uri in self.backends:
+                self.healths.append(BackendHealth(
+                    ConnectionPool(
+                        uri,
+                        float(getattr(modconf, 'health_timeout', 5)),
+                        1),
+                    float(getattr(modconf, 'health_interval', 10)),
+                    float(getattr(modconf, 'health_max_latency', 2)),
+                    int(getattr(modconf, 'health_failures', 3)),
+                    float(getattr(modconf, 'health_cooldown', 30)),
+                    int(getattr(modconf, 'health_recoveries', 2))))
+            self.health = self.healths[0]
+
+        # Optional index of the metrics Graphite has, one per backend.
+        # The whisper files folder is the one of the first backend. With
+        # metric_index_find, only the paths of the graphs are asked.
+        self.metric_index = None
+        self.metric_indexes = []
+        if getattr(modconf, 'metric_index', '0') == '1':
+            refresh = float(getattr(modconf, 'metric_index_refresh', 600))
+            for index, pool in enumerate(self.graphite_pools):
+                if getattr(modconf, 'metric_index_find', '0') == '1':
+                    self.metric_indexes.append(MetricFinder(
+                        pool, refresh,
+                        int(getattr(modconf, 'metric_index_max_paths',
+                                    100000))))
+                    continue
+                self.metric_indexes.append(MetricIndex(
+                    pool,
+                    None if index else
+                    getattr(modconf, 'metric_index_whisper_dir', None),
+                    refresh))
+            self.metric_index = self.metric_indexes[0]
+
+        # Optional direct read of the whisper files of a local carbon
+        self.whisper_reader = None
+        self.whisper_path = getattr(modconf, 'whisper_path', '/graphite/whisper')
+        if getattr(modconf, 'whisper_backend', '0') == '1':
+            self.whisper_reader = WhisperReader(
+                getattr(modconf, 'whisper_dir',
+                        '/opt/graphite/storage/whisper'))
+
+        # Parsed perf_data of the elements
+        self.perf_data_cache = KeyedCache(
+            int(getattr(modconf, 'perf_data_cache_size', 50000)))
+
+        # Graphite paths and templates of the elements
+        self.graph_plan_cache = KeyedCache(
+            int(getattr(modconf, 'graph_plan_cache_size', 50000)))
+
+        # Known .graph templates, so we do not probe the file system
+        self.template_index = TemplateIndex(
+            self.templates_path,
+            float(getattr(modconf, 'templates_refresh_interval', 60)))
+
+        # Optional store of the templates index and content, shared by the
+        # WebUI worker processes
+        self.plan_store = None
+        if getattr(modconf, 'plan_store', '0') == '1':
+            self.plan_store = PlanStore(
+                getattr(modconf, 'plan_store_path',
+                        '/var/lib/shinken/graphite-ui.plans'),
+                float(getattr(modconf, 'plan_store_interval', 10)))
+            self.template_index.store = self.plan_store
+            self.template_cache.store = self.plan_store
+
+        # Optional instrumentation of get_graph_uris
+        self.hot_path_stats = None
+        self.stats_path = getattr(modconf, 'stats_path', '/graphite/stats')
+        if getattr(modconf, 'instrumentation', '0') == '1':
+            self.hot_path_stats = HotPathStats(
+                getattr(modconf, 'instrumentation_export', None),
+                getattr(modconf, 'instrumentation_prefix',
+                        'shinken.webui.graphite'),
+                float(getattr(modconf, 'instrumentation_interval', 60)))
+
+    @staticmethod
+    def normalize_uri(uri):
+        """Private function to give a Graphite uri ending with a /, with
+        YOURSERVERNAME replaced by our server name"""
+        uri = uri.strip()
+        if not uri.endswith('/'):
+            uri += '/'
+
+        # Change YOURSERVERNAME by our server name if we got it
+        if 'YOURSERVERNAME' in uri:
+            my_name = socket.gethostname()
+            uri = uri.replace('YOURSERVERNAME', my_name)
+        return uri
+
     def init(self):
         """Try to connect if we got true parameter"""
-        pass
+        self.template_index.scan()
+        self.template_index.start()
+        if self.prewarmer is not None:
+            self.prewarmer.start()
+        for metric_index in self.metric_indexes:
+            metric_index.start()
+        if self.hot_path_stats is not None:
+            self.hot_path_stats.start(self.get_stats)
+        if self.plan_store is not None:
+            self.plan_store.start()
+        for health in self.healths:
+            health.start()
 
     def load(self, app):
         """To load the webui application"""
         self.app = app
+        self.template_index.refresh()
+        self.template_index.start()
+        if self.render_proxy is not None:
+            self.add_route(self.render_proxy_path, self.render_proxy_view)
+        if self.graph_data:
+            self.add_route(self.data_path, self.data_view)
+        if self.whisper_reader is not None:
+            self.add_route(self.whisper_path, self.whisper_view)
+        if self.hot_path_stats is not None:
+            self.add_route(self.stats_path, self.stats_view)
+            self.hot_path_stats.start(self.get_stats)
+        if self.plan_store is not None:
+            self.plan_store.start()
+        if self.healths and self.placeholder_uri is None:
+            self.add_route(self.placeholder_path, self.placeholder_view)
+        for health in self.healths:
+            health.start()
+
+    def do_stop(self):
+        """Stop our background threads"""
+        self.template_index.stop()
+        if self.prewarmer is not None:
+            self.prewarmer.stop()
+        for metric_index in self.metric_indexes:
+            metric_index.stop()
+        for render_proxy in self.render_proxies:
+            render_proxy.close()
+        if self.hot_path_stats is not None:
+            self.hot_path_stats.stop()
+        if self.plan_store is not None:
+            self.plan_store.stop()
+        for health in self.healths:
+            health.stop()
+            health.pool.close()
+        for graphite_pool in self.graphite_pools:
+            graphite_pool.close()
+
+    def add_route(self, path, callback):
+        """Private function to add a GET route to the WebUI application"""
+        if bottle is None:
+            logger.warning("{prefix}No bottle module, can't add the {path} "
+                           "route".format(prefix=DEBUG_PREFIX, path=path))
+            return
+        # Bottle wraps the callbacks with functools, which does not work
+        # with bound methods, so give it a plain function
+        def view(*args, **kwargs):
+            """Call the module view"""
+            return callback(*args, **kwargs)
+        route = getattr(self.app, 'route', bottle.route)
+        route(path, callback=view)
+
+    def render_proxy_view(self):
+        """Bottle view of the render proxy: give the Graphite render of
+        the query string, from the proxy cache if possible."""
+        query = bottle.request.query_string
+        render_proxy = self.render_proxies[self.get_backend_index(query)]
+        status, content_type, body, ttl = render_proxy.fetch(
+            'render/?' + query)
+        bottle.response.status = status
+        bottle.response.content_type = content_type
+        if ttl > 0:
+            bottle.response.set_header('Cache-Control', 'max-age=%d' % ttl)
+        return body
+
+    def placeholder_view(self):
+        """Bottle view of the placeholder graph given while Graphite is
+        unhealthy: an empty PNG image of the graph size"""
+        spec = GraphSpec.from_url('?' + bottle.request.query_string)
+        try:
+            width = min(int(spec.get('width', 586)), 4096)
+            height = min(int(spec.get('height', 308)), 4096)
+        except ValueError:
+            width, height = 586, 308
+        bottle.response.content_type = 'image/png'
+        bottle.response.set_header('Cache-Control', 'max-age=3600')
+        return render_png([], width, height)
+
+    def stats_view(self):
+        """Bottle view of the instrumentation counters, as JSON"""
+        bottle.response.content_type = 'application/json'
+        return json.dumps(self.get_stats())
+
+    def get_stats(self):
+        """Return the instrumentation counters and the caches counters
+        as a dict"""
+        stats = self.hot_path_stats.stats()
+        template_cache = self.template_cache.stats()
+        stats['fs_probes'] = {
+            'template_stats': template_cache['probes'],
+            'template_scans': self.template_index.scans,
+        }
+        stats['template_cache'] = template_cache
+        stats['perf_data_cache'] = self.perf_data_cache.stats()
+        if self.plan_store is not None:
+            stats['plan_store'] = self.plan_store.stats()
+        if self.healths:
+            stats['health'] = [health.stats() for health in self.healths]
+        return stats
 
     def get_external_ui_link(self):
         """Give the link for the GRAPHITE UI, with a Name
+
+        With several backends, 'backends' lists the link of each one.
+        """
+        link = {'label': 'Graphite', 'uri': self.uri}
+        if len(self.backends) > 1:
+            link['backends'] = [
+                {'label': 'Graphite %d' % (index + 1), 'uri': uri}
+                for index, uri in enumerate(self.backends)]
+        return link
+
+    def get_backend(self, host_name, backend=None):
+        """Return the Graphite uri of an host, from its sanitized name or
+        from its _GRAPHITE_BACKEND custom: a backend number (from 1) or an
+        uri.
+
+        Only the backends of the uri parameter are used, as the proxy, the
+        data endpoint and the metric index know only them. Other values
+        give the backend of the host name, with a warning."""
+        if backend:
+            backend = backend.strip()
+            if backend.isdigit():
+                index = int(backend) - 1
+                if 0 <= index < len(self.backends):
+                    return self.backends[index]
+            else:
+                uri = self.normalize_uri(backend)
+                if uri in self.backends:
+                    return uri
+            logger.warning("{prefix}No Graphite backend {backend} for "
+                           "{host}".format(prefix=DEBUG_PREFIX,
+                                           backend=backend,
+                                           host=host_name))
+        return self.backend_ring.get(host_name)
+
+    def get_backend_index(self, query):
+        """Private function to give the backend of a proxy or data
+        endpoint query string, from its backend parameter"""
+        if 'backend=' not in query:
+            return 0
+        try:
+            index = int(GraphSpec.from_url('?' + query).get('backend'))
+        except (TypeError, ValueError):
+            return 0
+        if 0 <= index < len(self.backends):
+            return index
+        return 0
+
+    def parse_perf_data(self, perf_data):
+        """Parse a perf_data string into a tuple of PerfMetric, with
+        the metric names ready to be used in Graphite paths."""
+        fields = parse_perf_data_fields(perf_data)
+        if fields is None:
+            fields = [(e.name, e.value, e.uom, e.warning, e.critical)
+                      for e in PerfDatas(perf_data)]
+
+        # The shinken logger keeps even the filtered out logs before its
+        # log file is set, so only call it when debug is on
+        debug = logger.isEnabledFor(logging.DEBUG)
+        res = []
+        for name, value, uom, warn, crit in fields:
+            if debug:
+                logger.debug("{prefix}groking: {name}={value}{uom}".format(
+                    prefix=DEBUG_PREFIX, name=name, value=value, uom=uom))
+
+            name = self.illegal_char.sub('_', name)
+            name = self.multival.sub(r'.*', name)
+
+            if debug:
+                logger.debug("{prefix}Got in the end: {name}, {value}".format(
+                    prefix=DEBUG_PREFIX, name=name, value=value))
+            res.append(PerfMetric(name, value, uom, warn, crit))
+        return tuple(res)
+
+    def parse_perf_data_batch(self, perf_datas):
+        """Parse a list of perf_data strings, each one only once.
+
+        Return the list of the tuples of PerfMetric, in the same order.
         """
-        return {'label': 'Graphite', 'uri': self.uri}
+        parsed = {}
+        res = []
+        for perf_data in perf_datas:
+            metrics = parsed.get(perf_data)
+            if metrics is None:
+                metrics = parsed[perf_data] = self.parse_perf_data(perf_data)
+            res.append(metrics)
+        return res
+
+    def get_perf_metrics(self, elt, context=None):
+        """Return the parsed perf_data of an element, as a tuple of
+        PerfMetric.
+
+        The result is kept until the element perf_data changes. In a
+        get_graph_context context, elements with the same perf_data
+        share its parsing.
+        """
+        perf_data = elt.perf_data
+        metrics = self.perf_data_cache.get(id(elt), perf_data)
+        if metrics is None:
+            if context is not None:
+                metrics = context.metrics.get(perf_data)
+            if metrics is None:
+                if self.hot_path_stats is not None:
+                    start = time.time()
+                    metrics = self.parse_perf_data(perf_data)
+                    self.hot_path_stats.add_parse(time.time() - start)
+                else:
+                    metrics = self.parse_perf_data(perf_data)
+                if context is not None:
+                    context.metrics[perf_data] = metrics
+            self.perf_data_cache.set(id(elt), perf_data, metrics)
+        return metrics
 
     def get_metric_and_value(self, perf_data):
         """For a perf_data like
@@ -104,81 +2884,29 @@ class GraphiteWebui(BaseModule):
           return ('/', '30'), ('/var', '50')
         """
         res = []
-        metrics = PerfDatas(perf_data)
-
-        for e in metrics:
-            try:
-                logger.debug("{prefix}groking: {metric}".format(
-                    prefix=DEBUG_PREFIX,
-                    metric=str(e)))
-            except UnicodeEncodeError:
-                pass
-
-            name = self.illegal_char.sub('_', e.name)
-            name = self.multival.sub(r'.*', name)
-
-            # get metric value and its thresholds values if they exist
-            name_value = {name: (e.value, e.uom)}
-            if e.warning and e.critical:
-                name_value[name + '_warn'] = e.warning
-                name_value[name + '_crit'] = e.critical
-            # bailout if need
-            if name_value[name] == '':
-                continue
-            try:
-                logger.debug("{prefix}Got in the end: {name}, {value}".format(
-                    prefix=DEBUG_PREFIX,
-                    name=name,
-                    value=e.value))
-            except UnicodeEncodeError:
-                pass
-            for key, value in name_value.items():
-                res.append((key, value))
+        for metric in self.parse_perf_data(perf_data):
+            res.append((metric.name, (metric.value, metric.uom)))
+            # get thresholds values if they exist
+            if metric.warn and metric.crit:
+                res.append((metric.name + '_warn', metric.warn))
+                res.append((metric.name + '_crit', metric.crit))
         return res
 
     @staticmethod
     def replace_font_size(url, newsize):
         """Private function to replace the fontsize uri parameter by the correct
         value or add it if not present."""
-
-        # Do we have fontSize in the url already, or not ?
-        if re.search('fontSize=', url) is None:
-            url = url + '&fontSize=' + newsize
-        else:
-            url = re.sub(
-                r'(fontSize=)[^\&]+',
-                r'\g<1>' + newsize,
-                url)
-        return url
+        spec = GraphSpec.from_url(url)
+        spec.set_font_size(newsize)
+        return spec.to_url()
 
     @staticmethod
     def replace_graph_size(url, width, height):
         """Private function to replace the graph size by the specified
         value."""
-
-        # Replace width
-        if re.search('width=', url) is None:
-            url = "{url}&width={width}".format(
-                url=url,
-                width=width)
-        else:
-            url = re.sub(
-                r'width=[^\&]+',
-                'width={width}'.format(width=width),
-                url)
-
-        # Replace Height
-        if re.search('height=', url) is None:
-            url = "{url}&height={height}".format(
-                url=url,
-                height=height)
-        else:
-            url = re.sub(
-                r'height=[^\&]+',
-                'height={height}'.format(height=height),
-                url)
-
-        return url
+        spec = GraphSpec.from_url(url)
+        spec.set_size(width, height)
+        return spec.to_url()
 
     def get_graphite_variables(self, elt):
         """return the good graphite pre and post string regarding
@@ -186,18 +2914,211 @@ class GraphiteWebui(BaseModule):
 
         Return a tuple (graphite_pre,graphite_post)
         """
-        graphite_pre = ""
-        graphite_post = ""
-        if elt.__class__.my_type == 'host':
-            if "_GRAPHITE_PRE" in elt.customs:
-                graphite_pre = "%s." % self.illegal_char.sub("_", elt.customs["_GRAPHITE_PRE"])
-        elif elt.__class__.my_type == 'service':
-            if "_GRAPHITE_PRE" in elt.host.customs:
-                graphite_pre = "%s." % self.illegal_char.sub("_", elt.host.customs["_GRAPHITE_PRE"])
-            if "_GRAPHITE_POST" in elt.customs:
-                graphite_post = ".%s" % self.illegal_char.sub("_", elt.customs["_GRAPHITE_POST"])
-        return (graphite_pre, graphite_post)
+        plan = self.get_graph_plan(elt)
+        if plan is None:
+            return ("", "")
+        return (plan.graphite_pre, plan.graphite_post)
+
+    @staticmethod
+    def get_plan_signature(elt):
+        """Private function to give the raw values the graph plan of an
+        element is computed from"""
+        my_type = elt.__class__.my_type
+        if my_type == 'host':
+            return (my_type, elt.host_name,
+                    elt.customs.get('_GRAPHITE_PRE'), None, None,
+                    elt.check_command.get_name(),
+                    elt.customs.get('_GRAPHITE_BACKEND'))
+        if my_type == 'service':
+            host = elt.host
+            return (my_type, host.host_name,
+                    host.customs.get('_GRAPHITE_PRE'),
+                    elt.service_description,
+                    elt.customs.get('_GRAPHITE_POST'),
+                    elt.check_command.get_name(),
+                    host.customs.get('_GRAPHITE_BACKEND'))
+        return None
 
+    def get_graph_plan(self, elt):
+        """Return the GraphPlan of an host or a service, or None for other
+        elements.
+
+        A plan is computed once and kept until the element names, customs
+        or check command change. The elements of a new configuration are
+        new objects, so they get new plans, and the old ones are evicted
+        as the least recently used.
+        """
+        signature = self.get_plan_signature(elt)
+        if signature is None:
+            return None
+        plan = self.graph_plan_cache.get(id(elt), signature)
+        if plan is not None:
+            return plan
+
+        my_type, host_name, pre, desc, post, command, backend = signature
+        plan = GraphPlan()
+        plan.signature = signature
+        plan.graphite_pre = ""
+        if pre is not None:
+            plan.graphite_pre = "%s." % self.illegal_char.sub("_", pre)
+        plan.graphite_post = ""
+        if post is not None:
+            plan.graphite_post = ".%s" % self.illegal_char.sub("_", post)
+        data_source = ""
+        if self.graphite_data_source:
+            data_source = ".%s" % self.graphite_data_source
+        host_name = self.illegal_char.sub("_", host_name)
+        plan.host_path = "{graphite_pre}{hostname}{datasource}".format(
+            graphite_pre=plan.graphite_pre,
+            hostname=host_name,
+            datasource=data_source)
+        plan.backend = self.get_backend(host_name, backend)
+        if my_type == 'host':
+            plan.service = '__HOST__'
+        else:
+            # Remove all non alpha numeric character
+            plan.service = self.illegal_char.sub('_', desc)
+        plan.elt_path = plan.host_path + '.' + plan.service
+
+        # In case of CHECK_NRPE, the check_name is in second place
+        command = command.split('!', 2)
+        plan.command = command[0]
+        plan.arg = command[1] if len(command) > 1 else None
+        plan.templates = {}
+        plan.generation = None
+        self.graph_plan_cache.set(id(elt), signature, plan)
+        return plan
+
+    def get_plan_template(self, plan, source):
+        """Private function to give the template path of a graph plan for
+        a source, or None. The plan templates are looked for again when
+        the templates index changed."""
+        generation = self.template_index.scans
+        if plan.generation != generation:
+            plan.templates = {}
+            plan.generation = generation
+        try:
+            return plan.templates[source]
+        except KeyError:
+            path = self.template_index.lookup(source, plan.command, plan.arg)
+            plan.templates[source] = path
+            return path
+
+    def get_graph_context(self, graphstart, graphend,
+                          source='detail', params={}):
+        """Compute what does not depend on the element for a
+        get_graph_uris call."""
+        context = GraphContext()
+        context.source = source
+        context.fontsize = FONT_SIZES.get(source, FONT_SIZES['detail'])
+        context.height = params.get('height', 308)
+        context.width = params.get('width', 586)
+
+        # The dashboard URLs are the ones of the prewarm runs
+        min_step = 0
+        if self.prewarmer is not None and source == 'dashboard':
+            min_step = self.prewarmer.step
+        context.start_date, context.end_date = self.format_time_range(
+            graphstart, graphend, min_step=min_step)
+        context.metrics = {}
+        context.consolidate = self.get_consolidate(
+            graphend - graphstart, context.width)
+        context.reduced = None
+        if self.health_mode == 'reduce':
+            for health in self.healths:
+                if not health.is_healthy():
+                    context.reduced = self.get_reduced_context(
+                        context, graphend - graphstart)
+                    break
+        return context
+
+    def get_reduced_context(self, context, span):
+        """Private function to give the context of the graphs of the
+        unhealthy backends: smaller graphs, with coarser summarize() steps"""
+        reduced = GraphContext()
+        for name in GraphContext.__slots__:
+            setattr(reduced, name, getattr(context, name))
+        try:
+            reduced.width = int(context.width) // 2
+            reduced.height = int(context.height) // 2
+        except ValueError:
+            reduced.width, reduced.height = 293, 154
+        reduced.consolidate = self.get_consolidate(
+            span, reduced.width // HEALTH_PIXELS_PER_POINT, 'summarize')
+        reduced.reduced = None
+        return reduced
+
+    def is_degraded(self, backend):
+        """Private function to tell if the graphs of a backend uri have to
+        be degraded, while its Graphite is unhealthy"""
+        if not self.healths:
+            return False
+        try:
+            health = self.healths[self.backends.index(backend or self.uri)]
+        except ValueError:
+            return False
+        return not health.is_healthy()
+
+    def get_consolidate(self, span, width, consolidation=None):
+        """Private function to give the function wrapping a target in the
+        consolidation for a time span and a graph width, or None.
+        consolidation overrides the configured one."""
+        if consolidation is None:
+            consolidation = self.consolidation
+        if consolidation == 'consolidateBy':
+            pattern = "consolidateBy(%%s,'%s')" % \
+                CONSOLIDATION_FUNCTIONS[self.consolidation_function]
+        elif consolidation == 'summarize':
+            try:
+                interval = get_summarize_interval(span, int(width))
+            except ValueError:
+                interval = None
+            if interval is None:
+                return None
+            pattern = "summarize(%%s,'%s','%s')" % (
+                interval, self.consolidation_function)
+        else:
+            return None
+
+        def consolidate(target):
+            """Wrap a target, inside its OUTER_FUNCTIONS if any"""
+            outer = split_outer_function(target)
+            if outer is None:
+                return pattern % target
+            return '%s(%s%s)' % (outer[0], consolidate(outer[1]), outer[2])
+        return consolidate
+
+    def format_time_range(self, graphstart, graphend, now=None,
+                          min_step=0):
+        """Return the Graphite from and until values of a time range.
+
+        With quantize_time_range, or a min_step, the end and the span of
+        the range are rounded to a step that depends on the span, at least
+        min_step, so that the URLs do not change on each reload. The
+        relative format is used only for a range ending now.
+        """
+        if self.quantize_time_range or min_step:
+            span = graphend - graphstart
+            step = max(get_quantize_step(span), min_step)
+            graphend = -(-int(graphend) // step) * step
+            graphstart = graphend - max(
+                step, int(round(float(span) / step)) * step)
+        else:
+            step = 60
+
+        if self.time_format == 'relative':
+            if now is None:
+                now = time.time()
+            if graphend >= now - step:
+                return (format_graphite_span(graphend - graphstart), 'now')
+        if self.time_format in ('epoch', 'relative'):
+            return (str(int(graphstart)), str(int(graphend)))
+
+        # Format the start & end time (and not only the date)
+        start_date = datetime.fromtimestamp(graphstart)
+        end_date = datetime.fromtimestamp(graphend)
+        return (start_date.strftime('%H:%M_%Y%m%d'),
+                end_date.strftime('%H:%M_%Y%m%d'))
 
     def get_graph_uris(self, elt, graphstart, graphend,
                        source='detail', params={}):
@@ -209,159 +3130,572 @@ class GraphiteWebui(BaseModule):
             * width: graph width (default 586)
             * height: graph height (default 308)
         """
-        # Ugly to hard-code such values. But where else should I put them ?
-        fontsize = {'detail':'8', 'dashboard':'18'}
-        height = params.get('height', 308)
-        width = params.get('width', 586)
+        start = time.time()
+        ret = list(self.iter_graph_uris(
+            elt, graphstart, graphend, source, params))
+        if self.hot_path_stats is not None and elt:
+            self.hot_path_stats.add_call(source, time.time() - start, len(ret))
+        return ret
+
+    def iter_graph_uris(self, elt, graphstart, graphend,
+                        source='detail', params={}, offset=0, limit=None):
+        """Same as get_graph_uris, as an iterator: each graph is built
+        when it is asked for.
+
+        For paginated graph tabs, the first offset graphs are skipped
+        without being built, and at most limit graphs are given.
+        """
+        if not elt or limit == 0:
+            return iter(())
+
+        if self.prewarmer is not None and source == 'dashboard':
+            self.prewarmer.note(elt)
+        context = self.get_graph_context(graphstart, graphend, source, params)
+        graphs = self.iter_elt_graph_uris(elt, context, offset)
+        if limit is not None:
+            graphs = itertools.islice(graphs, limit)
+        return graphs
+
+    def get_graph_uris_bulk(self, elts, graphstart, graphend,
+                            source='detail', params={}):
+        """Same as get_graph_uris, for a list of hosts or services.
+
+        The time range, sizes and consolidation are computed once for all
+        the elements, and a same perf_data is parsed only once. The graphs
+        themselves are still built one by one, which is most of the work:
+        with a distinct perf_data per service, a bulk call takes about 80%
+        of the time of one get_graph_uris call per element (see
+        test/benchmark.py --bulk). It is not a large speedup.
+
+        Return a dict element -> list of graphs
+        """
+        start = time.time()
+        context = self.get_graph_context(graphstart, graphend, source, params)
+        ret = {}
+        for elt in elts:
+            if elt:
+                if self.prewarmer is not None and source == 'dashboard':
+                    self.prewarmer.note(elt)
+                ret[elt] = list(self.iter_elt_graph_uris(elt, context))
+        if self.hot_path_stats is not None:
+            self.hot_path_stats.add_call(
+                source, time.time() - start,
+                sum(len(graphs) for graphs in ret.itervalues()))
+        return ret
+
+    def get_graph_uris_ranges(self, elt, ranges, sources=('detail',),
+                              params={}):
+        """Same as get_graph_uris, for several time ranges and sources at
+        once, like the time range tabs of the graph panel.
+
+        The template, perf_data and Graphite paths of the element are
+        handled once per source, only the time range and the render
+        parameters are applied for each range.
+
+        Parameters
+        * ranges : list of (graphstart, graphend)
+        * sources : list of sources
+
+        Return a dict source -> list of the graphs lists of each range
+        """
+        ret = {}
         if not elt:
-            return []
+            return ret
+        for source in sources:
+            start = time.time()
+            contexts = [self.get_graph_context(graphstart, graphend,
+                                               source, params)
+                        for graphstart, graphend in ranges]
+            ret[source] = [[] for _ in contexts]
+            if not contexts:
+                continue
+            count = 0
+            for spec, metrics, consolidate, backend in \
+                    self.iter_elt_graph_specs(elt, contexts[0]):
+                for index, context in enumerate(contexts):
+                    graph_spec = spec.copy()
+                    graph_spec.set_time_range(
+                        context.start_date, context.end_date)
+                    ret[source][index].append(self.get_graph(
+                        graph_spec, context, metrics, consolidate, backend))
+                    count += 1
+            if self.hot_path_stats is not None:
+                self.hot_path_stats.add_call(
+                    source, time.time() - start, count)
+        return ret
 
-        ret = []
+    def iter_elt_graph_uris(self, elt, context, offset=0):
+        """Private generator of the graphs of an element, for a context
+        given by get_graph_context. The first offset graphs are skipped."""
+        for spec, metrics, consolidate, backend in \
+                self.iter_elt_graph_specs(elt, context, offset):
+            yield self.get_graph(spec, context, metrics, consolidate, backend)
 
-        # Hanling Graphite variables
-        data_source = ""
-        if self.graphite_data_source:
-            data_source = ".%s" % self.graphite_data_source
+    def iter_elt_graph_specs(self, elt, context, offset=0):
+        """Private generator of the graphs of an element before the render
+        parameters are applied: (GraphSpec, metrics, consolidate, backend)
+        tuples, the arguments of get_graph. The first offset graphs are
+        skipped.
 
-        graphite_pre, graphite_post = self.get_graphite_variables(elt)
+        While the Graphite backend of the element is unhealthy, its graphs
+        are reduced, or replaced by a placeholder.
+        """
+        if self.host_overview and elt.__class__.my_type == 'host':
+            specs = itertools.islice(
+                itertools.chain(self.iter_plan_graph_specs(elt, context),
+                                self.iter_overview_specs(elt, context)),
+                offset, None)
+        else:
+            specs = self.iter_plan_graph_specs(elt, context, offset)
+        if not self.healths:
+            return specs
+        plan = self.get_graph_plan(elt)
+        if plan is None or not self.is_degraded(plan.backend):
+            return specs
+        if self.health_mode == 'placeholder':
+            return self.iter_placeholder_specs(specs, offset)
+        return self.iter_reduced_specs(specs, offset)
 
-        # Format the start & end time (and not only the date)
-        start_date = datetime.fromtimestamp(graphstart)
-        start_date = start_date.strftime('%H:%M_%Y%m%d')
-        end_date = datetime.fromtimestamp(graphend)
-        end_date = end_date.strftime('%H:%M_%Y%m%d')
-
-        filename = elt.check_command.get_name().split('!')[0] + '.graph'
-
-        # Do we have a template for the given source?
-        thefile = os.path.join(self.templates_path, source, filename)
-
-        # If not try to use the one for the parent folder
-        if not os.path.isfile(thefile):
-            # In case of CHECK_NRPE, the check_name is in second place
-            if len(elt.check_command.get_name().split('!')) > 1:
-                filename = "{first_part}_{second_part}.graph".format(
-                    first_part=elt.check_command.get_name().split('!')[0],
-                    second_part=elt.check_command.get_name().split('!')[1])
-                thefile = os.path.join(self.templates_path, source, filename)
-            if not os.path.isfile(thefile):
-                thefile = os.path.join(self.templates_path, filename)
-
-        if os.path.isfile(thefile):
-            template_html = ''
-            with open(thefile, 'r') as template_file:
-                template_html += template_file.read()
-            # Read the template file, as template string python object
-
-            html = Template(template_html)
+    def iter_reduced_specs(self, specs, offset=0):
+        """Private generator of the first health_max_graphs specs, with
+        at most health_max_targets targets, always consolidated"""
+        count = self.health_max_targets
+        specs = itertools.islice(specs,
+                                 max(0, self.health_max_graphs - offset))
+        for spec, metrics, _, backend in specs:
+            spec.keep_targets(count)
+            if metrics is not None:
+                metrics = metrics[:count]
+            yield (spec, metrics, True, backend)
+
+    def iter_placeholder_specs(self, specs, offset=0):
+        """Private generator of a single placeholder graph in place of
+        the specs, if there are any"""
+        if offset:
+            return
+        for _, _, _, backend in specs:
+            if self.placeholder_uri is not None:
+                spec = GraphSpec.from_url(self.placeholder_uri)
+            else:
+                spec = GraphSpec(self.placeholder_path)
+            yield (spec, None, False, backend)
+            return
+
+    def iter_plan_graph_specs(self, elt, context, offset=0):
+        """Private generator of the graphs of an element, for
+        iter_elt_graph_specs"""
+        plan = self.get_graph_plan(elt)
+        # Oups, bad type?
+        if plan is None:
+            return
+        graphite_post = plan.graphite_post
+
+        # Do we have a template for the given source, or in the parent
+        # folder?
+        thefile = self.get_plan_template(plan, context.source)
+        html = None
+        if thefile is not None:
+            html = self.template_cache.get(thefile)
+
+        if self.hot_path_stats is not None:
+            self.hot_path_stats.add_path(
+                'fallback' if html is None else 'template')
+
+        if html is not None:
             # Build the dict to instantiate the template string
             values = {}
+            values['host'] = plan.host_path
             if elt.__class__.my_type == 'host':
-                values['host'] = "{graphite_pre}{hostname}{datasource}".format(
-                    graphite_pre=graphite_pre,
-                    hostname=self.illegal_char.sub("_", elt.host_name),
-                    datasource=data_source)
                 values['service'] = '__HOST__'
-            elif elt.__class__.my_type == 'service':
-                values['host'] = "{graphite_pre}{hostname}{datasource}".format(
-                    graphite_pre=graphite_pre,
-                    hostname=self.illegal_char.sub("_", elt.host.host_name),
-                    datasource=data_source)
-                values['service'] = "{srvdesc}{graphite_post}".format(
-                    srvdesc=self.illegal_char.sub("_", elt.service_description),
-                    graphite_post=graphite_post)
-            values['uri'] = self.uri
-            # Split, we may have several images.
-            for img in html.substitute(values).split('\n'):
-                if not img == "":
-                    graph = {}
-                    graph['link'] = self.uri
-                    graph['img_src'] = "{img}&from={since}&until={to}".format(
-                        img=img.replace('"', "'"),
-                        since=start_date,
-                        to=end_date)
-                    graph['img_src'] = self.replace_font_size(
-                        graph['img_src'],
-                        fontsize[source])
-                    graph['img_src'] = self.replace_graph_size(
-                        graph['img_src'],
-                        width,
-                        height)
-                    ret.append(graph)
+            else:
+                values['service'] = plan.service + graphite_post
+            values['uri'] = plan.backend
+            # One image per line, we may have several images.
+            for line in TEMPLATE_LINE.finditer(html.substitute(values)):
+                if offset:
+                    offset -= 1
+                    continue
+                spec = GraphSpec.from_url(line.group().replace('"', "'"))
+                spec.set_time_range(context.start_date, context.end_date)
+                yield (spec, None, self.template_consolidation, plan.backend)
             # No need to continue, we have the images already.
-            return ret
+            return
 
         # If no template is present, then the usual way
-        if elt.__class__.my_type == 'host':
-            couples = self.get_metric_and_value(elt.perf_data)
-
-            # If no values, we can exit now
-            if len(couples) == 0:
-                return []
+        metrics = self.get_perf_metrics(elt, context)
 
-            # Remove all non alpha numeric character
-            host_name = self.illegal_char.sub('_', elt.host_name)
+        # If no values, we can exit now
+        if len(metrics) == 0:
+            return
 
+        groups = self.iter_metric_paths(plan, metrics)
+        if self.graph_mode == 'service':
             # Send a bulk of all metrics at once
-            for (metric, _) in couples:
-                uri = self.uri + 'render/?lineMode=connected&from=' + start_date + "&until=" + end_date
-                if re.search(r'_warn|_crit', metric):
+            groups = list(groups)
+            if groups and not offset:
+                spec = self.get_service_spec(groups, context, plan.backend)
+                yield (spec,
+                       [metric for metric, paths in groups for _ in paths],
+                       True, plan.backend)
+        else:
+            for metric, paths in groups:
+                if offset:
+                    offset -= 1
                     continue
-                target = "&target=%s%s%s.__HOST__.%s" % (graphite_pre,
-                                                         host_name,
-                                                         data_source,
-                                                         metric)
-                uri += target + target + "?????"
-                graph = {}
-                graph['link'] = self.uri
-                graph['img_src'] = uri
-                graph['img_src'] = self.replace_font_size(
-                    graph['img_src'],
-                    fontsize[source])
-                graph['img_src'] = self.replace_graph_size(
-                    graph['img_src'],
-                    width,
-                    height)
-                ret.append(graph)
-        elif elt.__class__.my_type == 'service':
-            couples = self.get_metric_and_value(elt.perf_data)
-
-            # If no values, we can exit now
-            if len(couples) == 0:
-                return []
+                spec = self.new_render_spec(context, plan.backend)
+                if elt.__class__.my_type == 'service' and metric.uom == '%':
+                    spec.add('yMin', '0')
+                    spec.add('yMax', '100')
+                for path in paths:
+                    spec.add_target(path)
+                yield (spec, (metric,) * len(paths), True, plan.backend)
 
-            # Remove all non alpha numeric character
-            desc = self.illegal_char.sub('_', elt.service_description)
-            host_name = self.illegal_char.sub('_', elt.host.host_name)
+    def iter_overview_specs(self, elt, context):
+        """Private generator of the host overview graphs: the metrics of
+        the host services, one graph per unit of OVERVIEW_GRAPHS.
 
-            # Send a bulk of all metrics at once
-            for (metric, value) in couples:
-                uri = self.uri + 'render/?lineMode=connected&from=' + start_date + "&until=" + end_date
-                if re.search(r'_warn|_crit', metric):
+        The services with the same metrics share a target, with brace
+        wildcards, like host.{disk_1,disk_2}.{used,free}. The targets are
+        scaled to the graph unit and named service.metric by
+        aliasByNode(). A graph with more than host_overview_max_targets
+        targets is split into several renders.
+        """
+        host_plan = self.get_graph_plan(elt)
+        if host_plan is None:
+            return
+        # graph -> (host path, graphite_post, scale, metric names)
+        #          -> services
+        graphs = dict((graph, {}) for graph in OVERVIEW_GRAPHS)
+        for service in getattr(elt, 'services', ()):
+            plan = self.get_graph_plan(service)
+            if plan is None:
+                continue
+            names = {}
+            for metric in self.get_perf_metrics(service, context):
+                unit = OVERVIEW_UNITS.get(metric.uom or '')
+                if unit is not None:
+                    names.setdefault(unit, set()).add(metric.name)
+            for (graph, scale), metric_names in names.iteritems():
+                # Multival metrics like if.* are several nodes, so they
+                # can not go in braces
+                plain = tuple(sorted(name for name in metric_names
+                                     if '.' not in name))
+                keys = [plain] if plain else []
+                keys.extend((name,) for name in sorted(metric_names)
+                            if '.' in name)
+                for key in keys:
+                    key = (plan.host_path, plan.graphite_post, scale, key)
+                    graphs[graph].setdefault(key, []).append(plan.service)
+
+        def brace(nodes):
+            """Return a Graphite node matching all the nodes"""
+            if len(nodes) == 1:
+                return nodes[0]
+            return '{%s}' % ','.join(nodes)
+
+        for graph in OVERVIEW_GRAPHS:
+            targets = []
+            for key in sorted(graphs[graph]):
+                host_path, graphite_post, scale, metric_names = key
+                target = '%s.%s.%s%s' % (
+                    host_path, brace(sorted(set(graphs[graph][key]))),
+                    brace(metric_names), graphite_post)
+                if isinstance(scale, float):
+                    # Not in exponent notation, like 1e-06
+                    target = 'scale(%s,%s)' % (
+                        target, ('%.15f' % scale).rstrip('0'))
+                elif scale != 1:
+                    target = 'scale(%s,%d)' % (target, scale)
+                node = host_path.count('.') + 1
+                nodes = range(node, node + 2 + metric_names[0].count('.'))
+                targets.append('aliasByNode(%s,%s)' % (
+                    target, ','.join(str(node) for node in nodes)))
+
+            step = max(1, self.host_overview_max_targets)
+            for start in range(0, len(targets), step):
+                spec = self.new_render_spec(context, host_plan.backend)
+                spec.add('title', graph)
+                if graph == 'percent':
+                    spec.add('yMin', '0')
+                    spec.add('yMax', '100')
+                for target in targets[start:start + step]:
+                    spec.add_target(target)
+                yield (spec, None, True, host_plan.backend)
+
+    def iter_metric_paths(self, plan, metrics):
+        """Private generator of the (PerfMetric, Graphite paths) couples of
+        an element metrics.
+
+        With the metric index of the plan backend, the missing ones are
+        dropped and the wildcards expanded. Several multival metrics give
+        the same wildcard path, graphed once.
+        """
+        metric_index = None
+        if self.metric_indexes:
+            try:
+                metric_index = self.metric_indexes[
+                    self.backends.index(plan.backend)]
+            except ValueError:
+                pass
+        seen = set()
+        for metric in metrics:
+            path = "%s.%s%s" % (plan.elt_path, metric.name, plan.graphite_post)
+            if path in seen:
+                continue
+            seen.add(path)
+            if metric_index is None:
+                paths = [path]
+            else:
+                paths = metric_index.resolve(path)
+            if paths:
+                yield metric, paths
+
+    def get_graph(self, spec, context, metrics=None, consolidate=True,
+                  backend=None):
+        """Private function to apply the context render parameters to a
+        GraphSpec and return the graph dict given to the UI.
+
+        metrics are the PerfMetric of the spec targets, in the same order,
+        for their thresholds in the data endpoint. With consolidate, the
+        Graphite render gets the maxDataPoints and consolidation options.
+        backend is the Graphite uri of the element, the first one if None.
+        """
+        if backend is None:
+            backend = self.uri
+        try:
+            backend_index = self.backends.index(backend)
+        except ValueError:
+            backend_index = None
+        if context.reduced is not None and self.is_degraded(backend):
+            context = context.reduced
+        spec.set_font_size(context.fontsize)
+        spec.set_size(context.width, context.height)
+        graph = {}
+        graph['link'] = backend
+        if self.graph_data and spec.targets:
+            graph['data_src'] = self.get_data_src(
+                spec, metrics, backend_index or 0)
+        targets = spec.targets
+        if self.whisper_reader is not None and metrics is not None and \
+                backend_index == 0 and len(targets) == 1 and \
+                not self.threshold_lines and spec.get('yMin') is None and \
+                self.whisper_reader.has(targets[0]):
+            # Simple single series graph of the local carbon, the first
+            # backend, read from its whisper file
+            whisper = GraphSpec(self.whisper_path)
+            whisper.add_target(targets[0])
+            whisper.set_time_range(spec.get('from'), spec.get('until'))
+            whisper.set_size(context.width, context.height)
+            graph['img_src'] = whisper.to_url()
+            return graph
+        if consolidate:
+            if self.max_data_points:
+                spec.set('maxDataPoints', context.width)
+            if context.consolidate is not None:
+                spec.map_targets(context.consolidate)
+        if self.threshold_lines and metrics is not None:
+            self.add_threshold_lines(spec, metrics)
+        if self.render_proxy is not None and backend_index is not None and \
+                spec.base.startswith(backend) and \
+                spec.base[len(backend):].strip('/') == 'render':
+            spec.base = self.render_proxy_path
+            if backend_index:
+                spec.set('backend', backend_index)
+        graph['img_src'] = spec.to_url()
+        return graph
+
+    @staticmethod
+    def add_threshold_lines(spec, metrics):
+        """Private function to add the warn and crit thresholds of the
+        metrics of a GraphSpec targets as constantLine() targets, on the
+        axis of their metric."""
+        seen = set()
+        lines = []
+        for target, metric in zip(spec.targets, metrics):
+            if metric.name in seen:
+                continue
+            seen.add(metric.name)
+            for level, value, color in (('warn', metric.warn, 'orange'),
+                                        ('crit', metric.crit, 'red')):
+                if value is None:
                     continue
-                elif value[1] == '%':
-                    uri += "&yMin=0&yMax=100"
-                target = "&target=%s%s%s.%s.%s%s" % (
-                    graphite_pre,
-                    host_name,
-                    data_source,
-                    desc,
-                    metric,
-                    graphite_post)
-                uri += target + target + "?????"
-                graph = {}
-                graph['link'] = self.uri
-                graph['img_src'] = uri
-                graph['img_src'] = self.replace_font_size(
-                    graph['img_src'],
-                    fontsize[source])
-                graph['img_src'] = self.replace_graph_size(
-                    graph['img_src'],
-                    width,
-                    height)
-                ret.append(graph)
-        # Oups, bad type?
-        else:
-            return []
-        return ret
+                line = "alias(color(constantLine(%s),'%s'),'%s_%s')" % (
+                    value, color, metric.name, level)
+                if target.startswith('secondYAxis('):
+                    line = "secondYAxis(%s)" % line
+                lines.append(line)
+        for line in lines:
+            spec.add_target(line)
+
+    def get_data_src(self, spec, metrics=None, backend_index=0):
+        """Private function to give the data endpoint URL of a GraphSpec.
+
+        The warn and crit parameters follow each target, empty when the
+        thresholds are not known.
+        """
+        data = GraphSpec(self.data_path)
+        for index, target in enumerate(spec.targets):
+            data.add_target(target)
+            if metrics is not None and index < len(metrics) and \
+                    metrics[index].warn is not None and \
+                    metrics[index].crit is not None:
+                data.add('warn', metrics[index].warn)
+                data.add('crit', metrics[index].crit)
+            else:
+                data.add('warn', '')
+                data.add('crit', '')
+        data.set_time_range(spec.get('from'), spec.get('until'))
+        data.set('width', spec.get('width'))
+        if backend_index:
+            data.set('backend', backend_index)
+        return data.to_url()
+
+    def whisper_view(self):
+        """Bottle view of the whisper backend: a simple PNG graph, or the
+        series as JSON with format=json."""
+        spec = GraphSpec.from_url('?' + bottle.request.query_string)
+        now = time.time()
+        since = parse_graphite_time(spec.get('from') or '-1d', now)
+        until = parse_graphite_time(spec.get('until') or 'now', now)
+        if since is None or until is None:
+            bottle.response.status = 400
+            return 'Bad from or until'
+        series = []
+        for target in spec.targets:
+            serie = self.whisper_reader.get_series(target, since, until, now)
+            if serie is not None:
+                series.append(serie)
+
+        try:
+            width = int(spec.get('width', 586))
+            height = int(spec.get('height', 308))
+        except ValueError:
+            width, height = 586, 308
+        if spec.get('format') == 'json':
+            bottle.response.content_type = 'application/json'
+            for serie in series:
+                serie['datapoints'] = downsample(serie['datapoints'], width)
+            return json.dumps(series)
+        bottle.response.content_type = 'image/png'
+        return render_png(series, width, height)
+
+    def data_view(self):
+        """Bottle view of the data endpoint: the series of the targets,
+        downsampled to the graph width, as JSON."""
+        bottle.response.content_type = 'application/json'
+        status, series = self.get_graph_data(bottle.request.query_string)
+        bottle.response.status = status
+        return json.dumps(series)
+
+    def get_graph_data(self, query):
+        """Return (status, data) for a data endpoint query string.
+
+        data is a list of {'target': ..., 'datapoints': [[value, time]..]}
+        dicts, with a 'thresholds' dict for the targets we got them for.
+        """
+        spec = GraphSpec.from_url('?' + query)
+        thresholds = {}
+        target = None
+        render = GraphSpec('render/')
+        for key, value in spec.params:
+            if key == 'target':
+                target = value
+                render.add_target(target)
+            elif key in ('warn', 'crit') and target is not None and value:
+                try:
+                    value = to_best_int_float(value)
+                except ValueError:
+                    # Not a number, drop the threshold
+                    continue
+                thresholds.setdefault(target, {})[key] = value
+        render.set_time_range(spec.get('from'), spec.get('until') or 'now')
+        render.set('format', 'json')
+        try:
+            width = max(3, int(spec.get('width', 586)))
+        except ValueError:
+            width = 586
+
+        targets = render.targets
+        backend_index = self.get_backend_index(query)
+        if self.whisper_reader is not None and backend_index == 0 and \
+                all(self.whisper_reader.has(target) for target in targets):
+            now = time.time()
+            since = parse_graphite_time(render.get('from'), now)
+            until = parse_graphite_time(render.get('until'), now)
+            if since is not None and until is not None:
+                series = []
+                for target in targets:
+                    serie = self.whisper_reader.get_series(
+                        target, since, until, now)
+                    if serie is not None:
+                        series.append(serie)
+                return 200, self.reduce_series(series, width, thresholds)
+
+        if backend_index:
+            render.set('backend', backend_index)
+        path = render.to_url()
+        try:
+            if self.render_proxy is not None:
+                status, _, body, _ = \
+                    self.render_proxies[backend_index].fetch(path)
+            else:
+                status, _, body = self.graphite_pools[backend_index].request(
+                    urlparse.urlparse(self.backends[backend_index]).path +
+                    path)
+        except (httplib.HTTPException, socket.error), exp:
+            logger.warning("{prefix}Graphite data request failed: "
+                           "{err}".format(prefix=DEBUG_PREFIX, err=exp))
+            return 502, []
+        if status != 200:
+            return status, []
+
+        try:
+            series = json.loads(body)
+        except ValueError:
+            return 502, []
+        return 200, self.reduce_series(series, width, thresholds)
+
+    @staticmethod
+    def reduce_series(series, width, thresholds):
+        """Private function to downsample the series to width points and
+        add their thresholds"""
+        for serie in series:
+            serie['datapoints'] = downsample(serie['datapoints'], width)
+            if serie.get('target') in thresholds:
+                serie['thresholds'] = thresholds[serie['target']]
+        return series
+
+    def new_render_spec(self, context, backend=None):
+        """Private function to start a render GraphSpec for a context, on
+        a backend uri (the first one if None)"""
+        spec = GraphSpec((backend or self.uri) + 'render/')
+        spec.add('lineMode', 'connected')
+        spec.set_time_range(context.start_date, context.end_date)
+        return spec
+
+    def get_service_spec(self, groups, context, backend=None):
+        """Private function to build one GraphSpec with all the metrics of
+        an element, given as (PerfMetric, Graphite paths) couples.
+
+        Percent metrics go on the left axis, with a 0-100 scale. Without
+        percent metrics, the left axis is for the unit of the first metric.
+        Metrics with other units go on the second Y axis.
+        """
+        units = [metric.uom for metric, _ in groups]
+        left_unit = '%' if '%' in units else units[0]
+        has_right_axis = any(unit != left_unit for unit in units)
 
+        spec = self.new_render_spec(context, backend)
+        if left_unit == '%':
+            if has_right_axis:
+                spec.add('yMinLeft', '0')
+                spec.add('yMaxLeft', '100')
+            else:
+                spec.add('yMin', '0')
+                spec.add('yMax', '100')
+        for metric, paths in groups:
+            for path in paths:
+                if metric.uom != left_unit:
+                    path = "secondYAxis(%s)" % path
+                spec.add_target(path)
+        return spec
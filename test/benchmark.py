@@ -0,0 +1,435 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks of the GraphiteWebui module hot path.
+
+Run them from the repository root:
+    python -m test.benchmark [--only get_graph_uris] [--save FILE]
+    python -m test.benchmark --compare FILE [--threshold 10]
+    python -m test.benchmark --bulk [--services 10000] [--max-bulk 90]
+    python -m test.benchmark --workers
+
+Each benchmark reports its calls per second and the allocations per call.
+The allocations are the objects still alive after a call, its result
+included: the objects tracked by the garbage collector, and the strings,
+numbers and untracked dicts they reference. The collector is disabled
+during the measure. The temporary objects freed within a call are not
+counted.
+
+With --compare, the results are compared to the ones saved with --save,
+and the run fails if a benchmark got slower, or allocates more objects
+per call, than the threshold percent.
+
+With --bulk, the run fails if get_graph_uris_bulk takes more than max-bulk
+percent of the time of one get_graph_uris call per service.
+
+With --workers, the run fails if a worker using the plan store written by
+another one is not faster than a worker with an empty store.
+"""
+from __future__ import absolute_import
+
+import argparse
+import array
+import bisect
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from module import module as graphite_module
+from test.test import init_module, init_service, write_template, \
+    GRAPHSTART, GRAPHEND
+
+
+# Minimum time of a measure, in seconds
+MEASURE_TIME = 0.2
+# Number of measures of a benchmark, the best one is kept
+REPEAT = 3
+
+TEMPLATE = """$uri/render/?width=586&height=308&fontSize=8&target=$host.$service.used&lineMode=connected
+$uri/render/?width=586&height=308&fontSize=8&target=$host.$service.free&target=$host.$service.total
+"""
+
+
+def build_perf_data(count, seed=0):
+    """Return a perf_data with count metrics"""
+    metrics = []
+    for i in range(count):
+        if i % 3 == 0:
+            metrics.append("'/mnt/disk %d'=%d%%;80;90;0;100" % (i, (i + seed) % 100))
+        elif i % 3 == 1:
+            metrics.append('if_%d=%dB;;;0' % (i, 1000 * (i + seed)))
+        else:
+            metrics.append('time%d=0.%03ds;1;2' % (i, (i + seed) % 1000))
+    return ' '.join(metrics)
+
+
+def build_service(perf_count=1, command='check_dummy!1', graphite_pre=None,
+                  seed=0):
+    """Return a service with perf_count metrics"""
+    service = init_service({
+        'command_name': command.split('!')[0],
+        'command_line': command,
+        'host_name': 'host-%d' % seed,
+        'service_description': 'service %d' % seed,
+        'perf_data': build_perf_data(perf_count, seed),
+    })
+    if graphite_pre:
+        service.host.customs = {'_GRAPHITE_PRE': graphite_pre}
+    return service
+
+
+def build_services(count):
+    """Build count services, spread on count / 10 hosts, each one with its
+    own perf_data like the checks results of a real configuration"""
+    services = []
+    hosts = {}
+    for i in range(count):
+        service = init_service({
+            'host_name': 'host-%d' % (i / 10),
+            'service_description': 'service %d' % i,
+            'perf_data': 'load=%d.%02d;10;20 used=%d%%;80;90' % (
+                i % 30, i % 97, i),
+        })
+        # Services of a same host share the same Host object
+        host_name = service.host.host_name
+        service.host = hosts.setdefault(host_name, service.host)
+        services.append(service)
+    return services
+
+
+def get_benchmarks(templates_path):
+    """Return the list of (name, function) benchmarks"""
+    write_template(
+        os.path.join(templates_path, 'detail', 'check_tpl.graph'), TEMPLATE)
+    write_template(
+        os.path.join(templates_path, 'check_nrpe_disk.graph'), TEMPLATE)
+    module = init_module({'templates_path': templates_path})
+
+    benchmarks = []
+
+    def add_graph_uris(name, service):
+        """Add a get_graph_uris benchmark for a service"""
+        benchmarks.append((
+            'get_graph_uris[%s]' % name,
+            lambda: module.get_graph_uris(service, GRAPHSTART, GRAPHEND)))
+
+    for count in (1, 10, 100):
+        add_graph_uris('%d metrics' % count, build_service(count))
+    add_graph_uris('template', build_service(10, 'check_tpl!1'))
+    add_graph_uris('nrpe template', build_service(10, 'check_nrpe!disk'))
+    add_graph_uris('graphite_pre', build_service(10, graphite_pre='dc1.rack2'))
+
+    for count in (1, 10, 100):
+        perf_data = build_perf_data(count)
+        benchmarks.append((
+            'get_metric_and_value[%d metrics]' % count,
+            lambda perf_data=perf_data: module.get_metric_and_value(perf_data)))
+
+    # Minutes reduced to the graph width, a quarter with and without numpy
+    for name, days in (('week', 7), ('quarter', 91)):
+        datapoints = [[None if i % 50 == 0 else (i * 7) % 101,
+                       1400000000 + 60 * i] for i in xrange(days * 1440)]
+        benchmarks.append((
+            'downsample[%s]' % name,
+            lambda datapoints=datapoints:
+            graphite_module.downsample(datapoints, 586)))
+    benchmarks.append((
+        'downsample[quarter, python]',
+        lambda: downsample_python(datapoints, 586)))
+
+    url = ('http://graphite/render/?width=586&height=308&fontSize=8'
+           '&target=host.service.metric&lineMode=connected')
+    benchmarks.append((
+        'replace_font_size',
+        lambda: module.replace_font_size(url, '18')))
+    benchmarks.append((
+        'replace_graph_size',
+        lambda: module.replace_graph_size(url, 1024, 768)))
+    return benchmarks
+
+
+def downsample_python(datapoints, threshold):
+    """Call downsample without numpy"""
+    numpy = graphite_module.numpy
+    graphite_module.numpy = None
+    try:
+        return graphite_module.downsample(datapoints, threshold)
+    finally:
+        graphite_module.numpy = numpy
+
+
+def measure(function):
+    """Return (calls per second, allocations per call) of a function"""
+    # Calibrate the number of calls of a measure
+    calls = 1
+    while True:
+        start = time.time()
+        for _ in xrange(calls):
+            function()
+        elapsed = time.time() - start
+        if elapsed >= MEASURE_TIME / 10:
+            break
+        calls *= 10
+    calls = max(1, int(calls * MEASURE_TIME / max(elapsed, 1e-6)))
+
+    best = None
+    for _ in range(REPEAT):
+        start = time.time()
+        for _ in xrange(calls):
+            function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return calls / max(best, 1e-9), count_allocations(function)
+
+
+def get_live_objects():
+    """Return the live objects: the ones tracked by the garbage collector,
+    and the strings, numbers and untracked containers they reference"""
+    objects = gc.get_objects()
+    seen = set(id(obj) for obj in objects)
+    # Not our own lists and set, and the ints they hold
+    seen.update((id(objects), id(seen)))
+    pending = objects
+    while pending:
+        found = []
+        seen.add(id(found))
+        for obj in gc.get_referents(*pending):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                found.append(obj)
+        objects.extend(found)
+        pending = found
+    # Drop the ids now, they would else be counted as new objects
+    seen.clear()
+    return objects
+
+
+def count_allocations(function, calls=100):
+    """Return the objects allocated by one call of a function, and still
+    alive after it"""
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        # The old objects are kept alive, so their ids are not reused
+        before = get_live_objects()
+        known = array.array('L', sorted(id(obj) for obj in before))
+        results = [function() for _ in xrange(calls)]
+        after = get_live_objects()
+    finally:
+        if enabled:
+            gc.enable()
+    ignored = set([id(before), id(known), id(results)])
+    count = 0
+    for obj in after:
+        key = id(obj)
+        position = bisect.bisect_left(known, key)
+        if (position == len(known) or known[position] != key) and \
+                key not in ignored:
+            count += 1
+    return float(count) / calls
+
+
+def run(only=None):
+    """Run the benchmarks and return {name: {'ops': ..., 'allocs': ...}}"""
+    templates_path = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name, function in get_benchmarks(templates_path):
+            if only and only not in name:
+                continue
+            ops, allocs = measure(function)
+            results[name] = {'ops': ops, 'allocs': allocs}
+            print "%-45s %12.0f ops/s %10.1f allocs/call" % (name, ops, allocs)
+        return results
+    finally:
+        shutil.rmtree(templates_path)
+
+
+def compare(results, baseline, threshold):
+    """Print the changes against a baseline and return the names of the
+    benchmarks slower, or allocating more, than threshold percent"""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        change = 100 * (results[name]['ops'] / baseline[name]['ops'] - 1)
+        allocs = results[name]['allocs']
+        baseline_allocs = baseline[name]['allocs']
+        allocs_change = 100 * (allocs - baseline_allocs) / \
+            max(baseline_allocs, 1)
+        status = ''
+        if change < -threshold or allocs_change > threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        print "%-45s %+8.1f%% ops/s %+8.1f%% allocs %s" % (
+            name, change, allocs_change, status)
+    return regressions
+
+
+def bench_bulk(module, services):
+    """Compare get_graph_uris_bulk with one get_graph_uris per service.
+
+    Return the best (individual time, bulk time) of REPEAT measures, in
+    seconds. The garbage collector is disabled during the measures, its
+    runs depend on the allocations before them.
+    """
+    individuals = []
+    bulks = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(REPEAT):
+            gc.collect()
+            module.perf_data_cache.clear()
+            start = time.time()
+            for service in services:
+                module.get_graph_uris(service, GRAPHSTART, GRAPHEND,
+                                      'dashboard')
+            individuals.append(time.time() - start)
+
+            gc.collect()
+            module.perf_data_cache.clear()
+            start = time.time()
+            module.get_graph_uris_bulk(services, GRAPHSTART, GRAPHEND,
+                                       'dashboard')
+            bulks.append(time.time() - start)
+    finally:
+        if enabled:
+            gc.enable()
+    return min(individuals), min(bulks)
+
+
+def bench_workers(folder, templates=200):
+    """Compare the first get_graph_uris calls of a worker process with an
+    empty plan store (cold) and with the store written by another worker
+    (warm), for services of templates different templates.
+
+    Return the best (cold time, warm time) of REPEAT measures, in seconds
+    """
+    templates_path = os.path.join(folder, 'templates')
+    for i in range(templates):
+        write_template(os.path.join(
+            templates_path, 'detail', 'check_%d.graph' % i), TEMPLATE)
+    services = [build_service(1, 'check_%d!1' % i, seed=i)
+                for i in range(templates)]
+    store_path = os.path.join(folder, 'plans')
+
+    def first_calls():
+        """Return a new worker and the time of its first calls"""
+        module = init_module({
+            'templates_path': templates_path,
+            'plan_store': '1',
+            'plan_store_path': store_path,
+            'plan_store_interval': '0',
+        })
+        start = time.time()
+        for service in services:
+            module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        return module, time.time() - start
+
+    colds = []
+    warms = []
+    for _ in range(REPEAT):
+        if os.path.exists(store_path):
+            os.remove(store_path)
+        module, elapsed = first_calls()
+        colds.append(elapsed)
+        module.plan_store.flush()
+        warms.append(first_calls()[1])
+    return min(colds), min(warms)
+
+
+def main():
+    """Run the benchmarks and print the results"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only',
+                        help='run only the benchmarks with this in the name')
+    parser.add_argument('--save', help='save the results in this file')
+    parser.add_argument('--compare',
+                        help='compare with the results saved in this file')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='slowdown percent failing the comparison')
+    parser.add_argument('--bulk', action='store_true',
+                        help='compare get_graph_uris_bulk with get_graph_uris')
+    parser.add_argument('--services', type=int, default=10000,
+                        help='number of services of the --bulk benchmark')
+    parser.add_argument('--max-bulk', type=float, default=90,
+                        help='bulk time percent of the individual calls '
+                             'failing the --bulk benchmark')
+    parser.add_argument('--workers', action='store_true',
+                        help='compare a warm and a cold plan store worker')
+    args = parser.parse_args()
+
+    if args.workers:
+        folder = tempfile.mkdtemp()
+        try:
+            cold, warm = bench_workers(folder)
+        finally:
+            shutil.rmtree(folder)
+        print "cold worker: %.4fs" % cold
+        print "warm worker: %.4fs (%.1f%% of the cold one)" % (
+            warm, 100 * warm / cold)
+        if warm >= cold:
+            print "FAILED: the warm worker is not faster"
+            return 1
+        return 0
+
+    if args.bulk:
+        module = init_module()
+        services = build_services(args.services)
+        individual, bulk = bench_bulk(module, services)
+        print "get_graph_uris x %d: %.3fs" % (len(services), individual)
+        percent = 100 * bulk / individual
+        print "get_graph_uris_bulk: %.3fs (%.1f%% of the individual calls)" % (
+            bulk, percent)
+        if percent > args.max_bulk:
+            print "FAILED: more than %.0f%%" % args.max_bulk
+            return 1
+        return 0
+
+    results = run(args.only)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
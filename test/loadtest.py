@@ -0,0 +1,535 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2009-2012:
+#    Gabes Jean, naparuba@gmail.com
+#    Gerhard Lausser, Gerhard.Lausser@consol.de
+#    Gregory Starck, g.starck@gmail.com
+#    Hartmut Goebel, h.goebel@goebel-consult.de
+#
+# This file is part of Shinken.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Shinken.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load test of the GraphiteWebui module against a local fake Graphite.
+
+Run it from the repository root:
+    python -m test.loadtest [--hosts 1000] [--services 10]
+    python -m test.loadtest --option render_proxy=1 --save FILE
+    python -m test.loadtest --compare FILE
+    python -m test.loadtest --bulk
+
+A synthetic configuration is built: hosts with services of several check
+commands and perf_data, some of them with .graph templates. The graphs
+of the dashboard, problems and detail views are asked to the module like
+the WebUI does, with a get_graph_uris call per element and time range,
+then their URLs are requested concurrently to a local fake Graphite,
+through the render proxy when it is enabled. With --bulk, the dashboard
+and detail views use get_graph_uris_bulk and get_graph_uris_ranges
+instead, which the WebUI does not call.
+
+Only get_instance and get_graph_uris of the module are used by default,
+so the same file can be run from a checkout of an older version of the
+module, and its saved report compared with --compare.
+
+The fake Graphite counts the requests, the distinct URLs and a render
+cost: the datapoints of the targets, with maxDataPoints if any. With
+--render-delay, each render also sleeps for its cost.
+
+The report gives, for each view, the module time and the graphs, and for
+the replay, the Graphite requests, distinct URLs, bytes and render cost.
+With --compare, the counters are compared to the ones saved with --save.
+"""
+from __future__ import absolute_import
+
+import argparse
+import BaseHTTPServer
+import httplib
+import json
+import os
+import re
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import Queue
+
+from shinken.objects import Module, Service, Host, Command
+
+from module.module import get_instance
+
+
+# Check commands of the services, with their perf_data pattern
+COMMANDS = (
+    ('check_load!5!10', 'load1=%(a)d.%(b)02d;5;10;0 load5=%(b)d.%(a)02d;5;10;0'
+     ' load15=0.%(a)02d;5;10;0'),
+    ('check_disk!/', "'/'=%(a)dMB;800;900;0;1000 '/var'=%(b)dMB;800;900;0;1000"),
+    ('check_nrpe!disk', "'/data'=%(a)d%%;80;90;0;100"),
+    ('check_http', 'time=0.%(a)03ds;1;2;0 size=%(b)dB;;;0'),
+    ('check_ping', 'rta=%(a)d.%(b)dms;100;500;0 pl=%(b)d%%;20;60;0'),
+    ('check_snmp_if', 'if_1_in=%(a)dc if_1_out=%(b)dc if_2_in=%(b)dc'
+     ' if_2_out=%(a)dc'),
+    ('check_dummy!0', ''),
+)
+
+# Templates of the commands with one
+TEMPLATES = {
+    os.path.join('detail', 'check_load.graph'):
+        '$uri/render/?width=586&height=308&fontSize=8'
+        '&target=$host.$service.load1&target=$host.$service.load5'
+        '&target=$host.$service.load15\n',
+    os.path.join('dashboard', 'check_load.graph'):
+        '$uri/render/?width=586&height=308&fontSize=8'
+        '&target=$host.$service.load1\n',
+    'check_nrpe_disk.graph':
+        '$uri/render/?width=586&height=308&fontSize=8'
+        '&target=$host.$service._data&yMin=0&yMax=100\n',
+}
+
+# Time ranges of the detail view tabs, in seconds
+DETAIL_RANGES = (4 * 3600, 86400, 7 * 86400, 31 * 86400, 365 * 86400)
+# Time range of the dashboard and problems graphs
+DASHBOARD_RANGE = 4 * 3600
+# Seconds per point of the fake Graphite series
+RENDER_STEP = 60
+
+# Counters of the report, compared with --compare
+COUNTERS = ('graphs', 'requests', 'distinct_urls', 'bytes', 'cost',
+            'errors')
+# Relative Graphite times, like -4h
+RELATIVE_TIME = re.compile(r'^-(\d+)([a-z]+)$')
+TIME_UNITS = (('min', 60), ('s', 1), ('h', 3600), ('d', 86400),
+              ('w', 7 * 86400), ('mon', 30 * 86400), ('y', 365 * 86400))
+
+
+class LoadGraphiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Fake render, which records its cost and sleeps for it"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Record the request and its cost, and send the fake render"""
+        cost = get_render_cost(self.path)
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            self.server.cost += cost
+        if self.server.render_delay:
+            time.sleep(self.server.render_delay * cost / 1000.0)
+        if self.path.startswith('/metrics/'):
+            content_type = 'application/json'
+            body = '[]'
+        else:
+            content_type = 'image/png'
+            body = 'PNG ' + self.path
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep the report clean"""
+        pass
+
+
+class LoadGraphite(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server standing in for graphite-web"""
+    daemon_threads = True
+
+    def __init__(self, render_delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           LoadGraphiteHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.cost = 0
+        self.render_delay = render_delay
+        self.uri = 'http://127.0.0.1:%d/' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stop the server"""
+        self.shutdown()
+        self.server_close()
+
+
+def parse_time(value, now):
+    """Return the epoch of a Graphite from/until value, or None"""
+    if value == 'now':
+        return now
+    if value.isdigit():
+        return int(value)
+    match = RELATIVE_TIME.match(value)
+    if match:
+        for unit, seconds in TIME_UNITS:
+            if match.group(2).startswith(unit):
+                return now - int(match.group(1)) * seconds
+        return None
+    # %H:%M_%Y%m%d, parsed by hand as time.strptime is not thread safe
+    if len(value) != 14 or value[2] != ':' or value[5] != '_':
+        return None
+    try:
+        return time.mktime((int(value[6:10]), int(value[10:12]),
+                            int(value[12:14]), int(value[0:2]),
+                            int(value[3:5]), 0, 0, 0, -1))
+    except ValueError:
+        return None
+
+
+def init_module(options):
+    """Return the module with the standard and given options"""
+    params = {
+        'module_name': 'ui-graphite',
+        'module_type': 'graphite-webui',
+    }
+    params.update(options)
+    return get_instance(Module(params))
+
+
+def init_service(host, command, description, perf_data):
+    """Return a service of host"""
+    service = Service({
+        'service_description': description,
+        'perf_data': perf_data,
+    })
+    service.host = host
+    service.check_command = Command({
+        'command_name': command.split('!')[0],
+        'command_line': command,
+    })
+    return service
+
+
+def write_template(path, content):
+    """Write a .graph template file, creating its folder if needed"""
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(path, 'w') as template_file:
+        template_file.write(content)
+
+
+def get_render_cost(path):
+    """Return the datapoints a Graphite render of path would read"""
+    query = urlparse.parse_qs(urlparse.urlparse(path).query)
+    targets = len(query.get('target', []))
+    if not targets:
+        return 0
+    now = time.time()
+    since = parse_time(query.get('from', ['-1d'])[0], now)
+    until = parse_time(query.get('until', ['now'])[0], now)
+    if since is None or until is None:
+        return 0
+    points = max(1, int(until - since) // RENDER_STEP)
+    try:
+        points = min(points, int(query['maxDataPoints'][0]))
+    except (KeyError, ValueError):
+        pass
+    return targets * points
+
+
+def build_config(hosts, services):
+    """Return the services of a synthetic configuration, and the
+    problems among them"""
+    elts = []
+    problems = []
+    for i in range(hosts):
+        # The services of a host share the Host object
+        host = Host({'host_name': 'host-%05d' % i})
+        host.customs = {}
+        if i % 5 == 0:
+            host.customs['_GRAPHITE_PRE'] = 'dc%d' % (i % 3)
+        for j in range(services):
+            command, perf_data = COMMANDS[(i + j) % len(COMMANDS)]
+            service = init_service(
+                host, command,
+                'service %s %d' % (command.split('!')[0], j),
+                perf_data % {'a': (i * 7 + j) % 1000,
+                             'b': (i + j * 13) % 100})
+            elts.append(service)
+            if (i * services + j) % 10 == 0:
+                problems.append(service)
+    return elts, problems
+
+
+def get_graph_urls(graphs):
+    """Return the img_src of a list of graphs"""
+    return [graph['img_src'] for graph in graphs]
+
+
+def run_views(module, elts, problems, args):
+    """Ask the graphs of each view like the WebUI does, or with the bulk
+    calls with --bulk.
+
+    Return ({view: report}, [URLs])
+    """
+    now = int(time.time())
+    views = {}
+    urls = []
+
+    def add(view, elapsed, pages, found):
+        """Record the URLs of a view"""
+        views[view] = {'time': elapsed, 'pages': pages, 'graphs': len(found)}
+        urls.extend(found)
+
+    # Dashboard: the graph widgets of the first elements
+    start = time.time()
+    found = []
+    for _ in range(args.pages):
+        if args.bulk:
+            graphs = module.get_graph_uris_bulk(
+                elts[:args.dashboard], now - DASHBOARD_RANGE, now,
+                'dashboard')
+            for elt in elts[:args.dashboard]:
+                found.extend(get_graph_urls(graphs[elt]))
+            continue
+        for elt in elts[:args.dashboard]:
+            found.extend(get_graph_urls(module.get_graph_uris(
+                elt, now - DASHBOARD_RANGE, now, 'dashboard')))
+    add('dashboard', time.time() - start, args.pages, found)
+
+    # Problems: the small graphs of each problem
+    start = time.time()
+    found = []
+    for _ in range(args.pages):
+        for elt in problems[:args.problems]:
+            found.extend(get_graph_urls(module.get_graph_uris(
+                elt, now - DASHBOARD_RANGE, now, 'dashboard')))
+    add('problems', time.time() - start, args.pages, found)
+
+    # Detail: the time range tabs of elements spread on the configuration
+    start = time.time()
+    found = []
+    step = max(1, len(elts) // max(1, args.details))
+    details = elts[::step][:args.details]
+    ranges = [(now - span, now) for span in DETAIL_RANGES]
+    for elt in details:
+        if args.bulk:
+            for graphs in module.get_graph_uris_ranges(
+                    elt, ranges)['detail']:
+                found.extend(get_graph_urls(graphs))
+            continue
+        for graphstart, graphend in ranges:
+            found.extend(get_graph_urls(module.get_graph_uris(
+                elt, graphstart, graphend)))
+    add('detail', time.time() - start, len(details), found)
+    return views, urls
+
+
+def replay(module, server, urls, concurrency):
+    """Request the URLs to the fake Graphite with concurrency threads.
+
+    Return the replay report
+    """
+    del server.requests[:]
+    server.cost = 0
+    render_proxy = getattr(module, 'render_proxy', None)
+    queue = Queue.Queue()
+    for url in urls:
+        queue.put(url)
+    counters = {'bytes': 0, 'errors': 0, 'local': 0}
+    lock = threading.Lock()
+
+    def fetch(connection, url):
+        """Request an URL, return (status, body)"""
+        if render_proxy is not None and \
+                url.startswith(module.render_proxy_path + '?'):
+            query = url.partition('?')[2]
+            proxy = module.render_proxies[module.get_backend_index(query)]
+            return proxy.fetch('render/?' + query)[::2]
+        if url.startswith(server.uri):
+            parsed = urlparse.urlparse(url)
+            connection.request('GET', parsed.path + '?' + parsed.query)
+            response = connection.getresponse()
+            return response.status, response.read()
+        return None
+
+    def work():
+        """Request URLs until there is none left"""
+        connection = httplib.HTTPConnection(*server.server_address)
+        try:
+            request(connection)
+        finally:
+            connection.close()
+
+    def request(connection):
+        """Request URLs on connection until there is none left"""
+        while True:
+            try:
+                url = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = fetch(connection, url)
+            except Exception:
+                connection.close()
+                result = (0, '')
+            with lock:
+                if result is None:
+                    counters['local'] += 1
+                    continue
+                counters['bytes'] += len(result[1])
+                if result[0] != 200:
+                    counters['errors'] += 1
+
+    start = time.time()
+    workers = [threading.Thread(target=work) for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+
+    report = {
+        'urls': len(urls),
+        'time': elapsed,
+        'requests': len(server.requests),
+        'distinct_urls': len(set(server.requests)),
+        'cost': server.cost,
+    }
+    report.update(counters)
+    return report
+
+
+def run(args):
+    """Build the configuration, run the views and replay their URLs.
+
+    Return the report dict
+    """
+    server = LoadGraphite(args.render_delay)
+    templates_path = tempfile.mkdtemp()
+    try:
+        for path, content in TEMPLATES.iteritems():
+            write_template(os.path.join(templates_path, path), content)
+        options = {'uri': server.uri, 'templates_path': templates_path}
+        for option in args.option:
+            key, _, value = option.partition('=')
+            options[key] = value
+        module = init_module(options)
+        try:
+            elts, problems = build_config(args.hosts, args.services)
+            views, urls = run_views(module, elts, problems, args)
+            report = {
+                'config': {'hosts': args.hosts,
+                           'services': len(elts),
+                           'options': args.option,
+                           'bulk': args.bulk},
+                'views': views,
+                'replay': replay(module, server, urls, args.concurrency),
+            }
+        finally:
+            module.do_stop()
+        return report
+    finally:
+        shutil.rmtree(templates_path)
+        server.close()
+
+
+def print_report(report):
+    """Print a report"""
+    config = report['config']
+    print "%d hosts, %d services, %s calls, options: %s" % (
+        config['hosts'], config['services'],
+        'bulk' if config.get('bulk') else 'per element',
+        ' '.join(config['options']) or 'none')
+    for view in ('dashboard', 'problems', 'detail'):
+        values = report['views'][view]
+        print "%-10s %5d pages %8d graphs %9.3fs %9.0f graphs/s" % (
+            view, values['pages'], values['graphs'], values['time'],
+            values['graphs'] / max(values['time'], 1e-9))
+    replayed = report['replay']
+    print "replay     %8d urls %8d requests %8d distinct %8d local" % (
+        replayed['urls'], replayed['requests'], replayed['distinct_urls'],
+        replayed['local'])
+    print "           %8d bytes %9d points %7d errors %9.3fs" % (
+        replayed['bytes'], replayed['cost'], replayed['errors'],
+        replayed['time'])
+
+
+def compare(report, baseline):
+    """Print the counters changes against a baseline report"""
+    for view in ('dashboard', 'problems', 'detail'):
+        if view not in baseline['views']:
+            continue
+        for key in ('graphs', 'time'):
+            print_change('%s %s' % (view, key), report['views'][view][key],
+                         baseline['views'][view][key])
+    for key in COUNTERS + ('time',):
+        if key in report['replay'] and key in baseline['replay']:
+            print_change('replay %s' % key, report['replay'][key],
+                         baseline['replay'][key])
+
+
+def print_change(name, value, base):
+    """Print the change of a counter"""
+    if base:
+        change = '%+8.1f%%' % (100 * (float(value) / base - 1))
+    else:
+        change = '%9s' % ('=' if value == base else 'new')
+    print "%-25s %14.3f %14.3f %s" % (name, base, value, change)
+
+
+def main():
+    """Run the load test and print the report"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hosts', type=int, default=1000,
+                        help='number of hosts')
+    parser.add_argument('--services', type=int, default=10,
+                        help='number of services per host')
+    parser.add_argument('--dashboard', type=int, default=50,
+                        help='number of elements of the dashboard')
+    parser.add_argument('--problems', type=int, default=200,
+                        help='number of elements of the problems view')
+    parser.add_argument('--details', type=int, default=50,
+                        help='number of elements shown in detail')
+    parser.add_argument('--pages', type=int, default=3,
+                        help='loads of the dashboard and problems views')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of concurrent Graphite requests')
+    parser.add_argument('--render-delay', type=float, default=0,
+                        help='milliseconds of a render per 1000 points')
+    parser.add_argument('--bulk', action='store_true',
+                        help='use get_graph_uris_bulk and '
+                        'get_graph_uris_ranges for the dashboard and detail')
+    parser.add_argument('--option', action='append', default=[],
+                        help='module option key=value, may be repeated')
+    parser.add_argument('--save', help='save the report in this file')
+    parser.add_argument('--compare',
+                        help='compare with the report saved in this file')
+    args = parser.parse_args()
+    args.render_delay /= 1000.0
+
+    report = run(args)
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print
+        compare(report, baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,23 +28,55 @@ Unit test for GraphiteWebui module.
 """
 import unittest
 import time
+import os
+import shutil
+import tempfile
+import threading
+import json
+import random
+import fnmatch
+import urlparse
+import struct
+import BaseHTTPServer
+import SocketServer
+import socket
+from StringIO import StringIO
 
 from shinken.objects import Module, Service, Host, Command
-from module.module import get_instance
+from shinken.misc.perfdata import PerfDatas
+from module import module as graphite_module
+from module.module import get_instance, TemplateCache, TemplateIndex, \
+    KeyedCache, GraphSpec, RenderCache, RenderProxy, MetricIndex, \
+    MetricFinder, WhisperReader, HotPathStats, BackendRing, PlanStore, \
+    BackendHealth, ConnectionPool, LRUDict
 
 
 GRAPHEND = time.time()-3600
 GRAPHSTART = GRAPHEND-3600
 
-def init_module():
-    """Initialize the module with standard configuration"""
-    config_options = Module({
+def init_module(params={}):
+    """Initialize the module with standard configuration
+
+    Parameters
+    * params : A dict of extra module configuration options
+    """
+    options = {
         'module_name': 'ui-graphite',
         'module_type': 'graphite-webui',
         'uri': 'http://YOURSERVERNAME/',
-    })
+    }
+    options.update(params)
+    config_options = Module(options)
     return get_instance(config_options)
 
+def write_template(path, content):
+    """Write a .graph template file, creating its folder if needed"""
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(path, 'w') as template_file:
+        template_file.write(content)
+
 def init_service(params={}):
     """Create a service with specified parameters
 
@@ -82,6 +114,123 @@ def init_service(params={}):
     return srv
 
 
+def write_whisper(path, archives, points):
+    """Write a whisper file
+
+    Parameters
+    * archives : list of (seconds per point, points count)
+    * points : list of (timestamp, value), written in every archive
+    """
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    header_size = 16 + 12 * len(archives)
+    max_retention = max(step * count for step, count in archives)
+    data = [struct.pack('!2LfL', 1, max_retention, 0.5, len(archives))]
+    offset = header_size
+    for step, count in archives:
+        data.append(struct.pack('!3L', offset, step, count))
+        offset += count * 12
+    for step, count in archives:
+        archive = [struct.pack('!Ld', 0, 0)] * count
+        base = None
+        for timestamp, value in sorted(points):
+            interval = timestamp - timestamp % step
+            if base is None:
+                base = interval
+            archive[((interval - base) // step) % count] = \
+                struct.pack('!Ld', interval, value)
+        data.extend(archive)
+    with open(path, 'wb') as whisper_file:
+        whisper_file.write(''.join(data))
+
+class FakeGraphiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer to any GET with a fake render, after the server delay"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Record the request and send the fake render"""
+        self.server.requests.append(self.path)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        if self.path == '/metrics/index.json':
+            content_type = 'application/json'
+            body = json.dumps(self.server.metrics)
+        elif self.path.startswith('/metrics/find?'):
+            content_type = 'application/json'
+            body = json.dumps({'metrics': find_metrics(
+                self.server.metrics, query['query'][0])})
+        elif query.get('format') == ['json']:
+            content_type = 'application/json'
+            body = json.dumps([
+                {
+                    'target': target,
+                    'datapoints': [[i % 7, 1400000000 + 60 * i]
+                                   for i in range(1000)],
+                }
+                for target in query.get('target', [])
+            ])
+        else:
+            content_type = 'image/png'
+            body = 'PNG ' + self.path
+        self.send_response(self.server.status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep the tests output clean"""
+        pass
+
+def find_metrics(metrics, query):
+    """Return the nodes of metrics/find in the completer format, which
+    also matches the names query is a prefix of"""
+    if not query.endswith('*'):
+        query += '*'
+    parts = query.split('.')
+    nodes = {}
+    for metric in metrics:
+        names = metric.split('.')
+        if len(names) < len(parts):
+            continue
+        for name, part in zip(names, parts):
+            if not fnmatch.fnmatchcase(name, part):
+                break
+        else:
+            path = '.'.join(names[:len(parts)])
+            is_leaf = len(names) == len(parts)
+            key = (path, is_leaf)
+            nodes[key] = {
+                'path': path if is_leaf else path + '.',
+                'name': names[len(parts) - 1],
+                'is_leaf': str(int(is_leaf)),
+            }
+    return sorted(nodes.values())
+
+class FakeGraphite(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server standing in for graphite-web"""
+    daemon_threads = True
+
+    def __init__(self, handler=FakeGraphiteHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.requests = []
+        self.metrics = []
+        self.delay = 0
+        self.status = 200
+        self.uri = 'http://127.0.0.1:%d/' % self.server_address[1]
+
+def start_fake_graphite(test, handler=FakeGraphiteHandler):
+    """Start a FakeGraphite, stopped at the end of the test"""
+    server = FakeGraphite(handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
 class GetMetricAndValueTest(unittest.TestCase):
     """Test the get_metric_and_value function"""
 
@@ -116,6 +265,134 @@ class GetMetricAndValueTest(unittest.TestCase):
         self.assertIn(('_var_crit', 4568), ret)
         self.assertIn(('_var_warn', 4899), ret)
 
+class ParsePerfDataTest(unittest.TestCase):
+    """Test the fast perf_data parser gives the same metrics as PerfDatas"""
+
+    CASES = [
+        '',
+        'load=1',
+        'load=1 users=2',
+        '/=30MB;4899;4568;1234;0\n/var=50MB;4899;4568;1234;0\n/toto=',
+        '/var=50MB;4899;4568;1234;0',
+        'used=50%;70;80',
+        "'/mnt/disk 1'=42%;80;90;0;100 'C:\\ Used'=10GB;;;0;20",
+        'cpu_1=10 cpu_2=20 cpu_3=30',
+        'a=1;2;3 a=4;5;6',
+        'time=0.005s;1;2;0 size=1e3B;;;0',
+        'rta=0.1ms;@10:20;~:30;; pl=0%;20;60;;',
+        'load=U users=3',
+        'a= b=1',
+        'a=x=1',
+        'junk a=1',
+        '  =1 b=2',
+        'a=1e999 b=-- c=.',
+        'a=12abc!!;3 b=4',
+    ]
+
+    @staticmethod
+    def get_reference(perf_data):
+        """Return the metrics PerfDatas gives, sorted"""
+        return sorted((e.name, e.value, e.uom, e.warning, e.critical)
+                      for e in PerfDatas(perf_data))
+
+    def check(self, perf_data):
+        """Check the fast parser, or its fallback, on a perf_data"""
+        fields = graphite_module.parse_perf_data_fields(perf_data)
+        reference = self.get_reference(perf_data)
+        if fields is not None:
+            self.assertEquals(sorted(fields), reference, perf_data)
+        module = self.module
+        expected = []
+        for field in reference:
+            name = module.multival.sub(
+                r'.*', module.illegal_char.sub('_', field[0]))
+            expected.append((name,) + field[1:])
+        self.assertEquals(sorted(module.parse_perf_data(perf_data)),
+                          sorted(expected), perf_data)
+        return fields
+
+    def setUp(self):
+        self.module = init_module()
+
+    def test_cases(self):
+        """Test the known perf_data"""
+        for perf_data in self.CASES:
+            self.check(perf_data)
+        for perf_data in ('load=1 users=2', "'/mnt/disk 1'=42%;80;90"):
+            self.assertIsNotNone(
+                graphite_module.parse_perf_data_fields(perf_data))
+        self.assertIsNone(
+            graphite_module.parse_perf_data_fields('load=U users=3'))
+
+    def test_fuzz(self):
+        """Test random perf_data"""
+        rand = random.Random(42)
+        alphabet = "ab_'/=;.-+eE:~@%MB0123456789  \t"
+        fast = 0
+        for _ in range(3000):
+            perf_data = ''.join(rand.choice(alphabet)
+                                for _ in range(rand.randint(0, 30)))
+            if self.check(perf_data) is not None:
+                fast += 1
+        for _ in range(1000):
+            perf_data = ' '.join(
+                '%s=%s%s;%s;%s' % (
+                    rand.choice(['load', "'disk C'", 'cpu_1', 'a.b']),
+                    rand.choice(['1', '0.5', '-2', '1e3', 'U', '']),
+                    rand.choice(['', '%', 'MB', 's']),
+                    rand.choice(['', '10', '~:5', '@1:2']),
+                    rand.choice(['', '20', '.']))
+                for _ in range(rand.randint(1, 5)))
+            if self.check(perf_data) is not None:
+                fast += 1
+        # Most inputs take the fast path
+        self.assertGreater(fast, 2000)
+
+    def test_batch(self):
+        """Test a batch gives the metrics of each perf_data"""
+        metrics = self.module.parse_perf_data_batch(
+            ['load=1', 'users=2', 'load=1'])
+        self.assertEquals(metrics[0], (('load', 1, '', None, None),))
+        self.assertEquals(metrics[1][0].name, 'users')
+        self.assertIs(metrics[2], metrics[0])
+
+class GetPerfMetricsTest(unittest.TestCase):
+    """Test the get_perf_metrics function"""
+
+    def test_cached_until_changed(self):
+        """Test the perf_data is parsed again only when it changed"""
+        module = init_module()
+        service = init_service({
+            'perf_data': '/var=50MB;4899;4568;1234;0',
+        })
+
+        metrics = module.get_perf_metrics(service)
+        self.assertEquals(metrics, (('_var', 50, 'MB', 4899, 4568),))
+        self.assertIs(module.get_perf_metrics(service), metrics)
+
+        service.perf_data = '/var=60MB;4899;4568;1234;0'
+        metrics = module.get_perf_metrics(service)
+        self.assertEquals(metrics[0].value, 60)
+
+        stats = module.perf_data_cache.stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 2)
+
+class KeyedCacheTest(unittest.TestCase):
+    """Test the KeyedCache class"""
+
+    def test_lru_eviction(self):
+        """Test the least recently used element is evicted"""
+        cache = KeyedCache(max_size=2)
+        cache.set('a', 'a=1', ())
+        cache.set('b', 'b=1', ())
+        cache.get('a', 'a=1')
+        cache.set('c', 'c=1', ())
+
+        self.assertEquals(cache.get('a', 'a=1'), ())
+        self.assertIsNone(cache.get('b', 'b=1'))
+        self.assertIsNone(cache.get('a', 'a=2'))
+
 class ReplaceFontSizeTest(unittest.TestCase):
     """Test the replace_font_size function"""
 
@@ -201,6 +478,93 @@ class ReplaceGraphSizeTest(unittest.TestCase):
         self.assertIn('before=1', new_url)
         self.assertIn('after=2', new_url)
 
+class GraphSpecTest(unittest.TestCase):
+    """Test the GraphSpec class"""
+
+    def test_round_trip(self):
+        """Test an URL is kept as is"""
+        url = 'http://graphite/render/?target=a.b&lineMode&target=c?d'
+        spec = GraphSpec.from_url(url)
+
+        self.assertEquals(spec.to_url(), url)
+        self.assertEquals(spec.targets, ['a.b', 'c?d'])
+
+    def test_set(self):
+        """Test set replaces the parameter in place or adds it"""
+        spec = GraphSpec.from_url(
+            'http://graphite/render/?lineWidth=2&width=42&target=a')
+        spec.set_size(586, 308)
+        spec.set_time_range('-1d', 'now')
+
+        self.assertEquals(
+            spec.to_url(),
+            'http://graphite/render/?lineWidth=2&width=586&target=a'
+            '&height=308&from=-1d&until=now')
+        self.assertEquals(spec.get('width'), 586)
+        self.assertIsNone(spec.get('fontSize'))
+
+class FormatTimeRangeTest(unittest.TestCase):
+    """Test the format_time_range function"""
+
+    def test_legacy(self):
+        """Test the default format"""
+        module = init_module()
+        start = time.mktime((2014, 3, 1, 10, 20, 30, 0, 0, -1))
+
+        self.assertEquals(
+            module.format_time_range(start, start + 4 * 3600),
+            ('10:20_20140301', '14:20_20140301'))
+
+    def test_quantized_epoch(self):
+        """Test the quantized ranges give the same URLs in a step"""
+        module = init_module({
+            'time_format': 'epoch',
+            'quantize_time_range': '1',
+        })
+        end = 1400000000
+
+        self.assertEquals(
+            module.format_time_range(end - 4 * 3600 + 10, end + 10),
+            ('1399985640', '1400000040'))
+        self.assertEquals(
+            module.format_time_range(end - 4 * 3600 + 30, end + 30),
+            ('1399985640', '1400000040'))
+        self.assertEquals(
+            module.format_time_range(end - 365 * 86400, end),
+            ('1368464400', '1400000400'))
+
+    def test_relative(self):
+        """Test the relative format for a range ending now"""
+        module = init_module({
+            'time_format': 'relative',
+            'quantize_time_range': '1',
+        })
+        now = 1400000000
+
+        self.assertEquals(
+            module.format_time_range(now - 4 * 3600 - 5, now - 5, now),
+            ('-4h', 'now'))
+        self.assertEquals(
+            module.format_time_range(now - 7 * 86400, now, now),
+            ('-7d', 'now'))
+        self.assertEquals(
+            module.format_time_range(now - 86400, now - 3600, now),
+            ('1399913700', '1399996500'))
+
+    def test_int_span(self):
+        """Test int and float times give the same range"""
+        module = init_module({
+            'time_format': 'relative',
+            'quantize_time_range': '1',
+        })
+        now = 1400000000
+        self.assertEquals(
+            module.format_time_range(now - 14399, now, now),
+            ('-4h', 'now'))
+        self.assertEquals(
+            module.format_time_range(now - 14399.0, now, now),
+            ('-4h', 'now'))
+
 class GetGraphUrisTest(unittest.TestCase):
     """Test the get_graph_uris function"""
 
@@ -273,5 +637,1670 @@ class GetGraphUrisTest(unittest.TestCase):
         self.assertIn('width=42', img_src)
         self.assertIn('height=4242', img_src)
 
+    def test_service_with_template(self):
+        """Get graph for service with a .graph template"""
+        templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_path)
+        write_template(
+            os.path.join(templates_path, 'detail', 'dummy_cmd.graph'),
+            '$uri/render/?width=42&target=$host.$service.load\n')
+        module = init_module({'templates_path': templates_path})
+        service = init_service({
+            'perf_data': 'load=1',
+        })
+
+        uris = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+
+        self.assertEquals(len(uris), 1)
+        img_src = uris[0]['img_src']
+        self.assertIn('target=Dummy_host.Dummy_service.load', img_src)
+        self.assertIn('fontSize=8', img_src)
+        self.assertIn('width=586', img_src)
+        self.assertIn('height=308', img_src)
+
+        module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        stats = module.template_cache.stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 1)
+
+    def test_service_one_target(self):
+        """Test each metric graph has its target only once"""
+        module = init_module()
+        service = init_service({
+            'perf_data': 'dummy_service=50%;70;80',
+        })
+
+        img_src = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]['img_src']
+
+        self.assertEquals(
+            img_src.count('target=Dummy_host.Dummy_service.dummy_service'), 1)
+        self.assertNotIn('?????', img_src)
+
+    def test_service_graph_mode(self):
+        """Test the service graph_mode draws all metrics at once"""
+        module = init_module({'graph_mode': 'service'})
+        service = init_service({
+            'perf_data': 'used=50%;70;80 free=500MB;300;400 pct=10%',
+        })
+
+        uris = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+
+        self.assertEquals(len(uris), 1)
+        img_src = uris[0]['img_src']
+        self.assertIn('target=Dummy_host.Dummy_service.used&', img_src)
+        self.assertIn('target=Dummy_host.Dummy_service.pct&', img_src)
+        self.assertIn(
+            'target=secondYAxis(Dummy_host.Dummy_service.free)', img_src)
+        self.assertIn('yMinLeft=0', img_src)
+        self.assertIn('yMaxLeft=100', img_src)
+        self.assertIn('fontSize=8', img_src)
+
+    def test_bulk(self):
+        """Test the bulk call gives the same graphs as individual calls"""
+        module = init_module()
+        services = [
+            init_service({
+                'service_description': 'Service %d' % i,
+                'perf_data': 'dummy_service=%d%%;70;80' % (i % 2),
+            })
+            for i in range(4)
+        ]
+        services.append(init_service())
+
+        uris = module.get_graph_uris_bulk(services, GRAPHSTART, GRAPHEND)
+
+        self.assertEquals(len(uris), 5)
+        for service in services:
+            self.assertEquals(
+                uris[service],
+                module.get_graph_uris(service, GRAPHSTART, GRAPHEND))
+        self.assertEquals(uris[services[-1]], [])
+
+class GraphPlanTest(unittest.TestCase):
+    """Test the graph plans of the elements"""
+
+    def test_customs_change(self):
+        """Test a plan is computed again when the customs change"""
+        module = init_module()
+        service = init_service({'perf_data': 'load=1'})
+        service.host.customs = {'_GRAPHITE_PRE': 'dc 1'}
+        service.customs = {}
+
+        self.assertEquals(module.get_graphite_variables(service),
+                          ('dc_1.', ''))
+        plan = module.get_graph_plan(service)
+        self.assertEquals(plan.elt_path, 'dc_1.Dummy_host.Dummy_service')
+        self.assertIs(module.get_graph_plan(service), plan)
+
+        service.customs['_GRAPHITE_POST'] = 'raw'
+        self.assertEquals(module.get_graphite_variables(service),
+                          ('dc_1.', '.raw'))
+        uris = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        self.assertIn('target=dc_1.Dummy_host.Dummy_service.load.raw',
+                      uris[0]['img_src'])
+        self.assertIsNot(module.get_graph_plan(service), plan)
+
+    def test_new_template(self):
+        """Test the plan templates follow the templates index"""
+        templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_path)
+        module = init_module({'templates_path': templates_path})
+        service = init_service({'perf_data': 'load=1'})
+        self.assertIn('load', module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src'])
+
+        write_template(
+            os.path.join(templates_path, 'dummy_cmd.graph'),
+            '$uri/render/?target=$host.$service.users\n')
+        module.template_index.scan()
+
+        self.assertIn('users', module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src'])
+
+class ConsolidationTest(unittest.TestCase):
+    """Test the maxDataPoints and consolidation of the graphs"""
+
+    def test_max_data_points(self):
+        """Test the graphs ask for one point per pixel"""
+        module = init_module()
+        service = init_service({'perf_data': 'load=1'})
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND, params={'width': 300})[0]['img_src']
+        self.assertIn('maxDataPoints=300', img_src)
+        self.assertIn('target=Dummy_host.Dummy_service.load&', img_src)
+
+    def test_summarize(self):
+        """Test summarize() follows the time span"""
+        self.assertIsNone(graphite_module.get_summarize_interval(3600, 586))
+        self.assertEquals(
+            graphite_module.get_summarize_interval(86400 * 7, 586), '30min')
+        self.assertEquals(
+            graphite_module.get_summarize_interval(86400 * 365, 586), '1d')
+
+        module = init_module({'consolidation': 'summarize',
+                              'consolidation_function': 'max'})
+        service = init_service({'perf_data': 'load=1'})
+        img_src = module.get_graph_uris(
+            service, GRAPHEND - 86400 * 365, GRAPHEND)[0]['img_src']
+        self.assertIn(
+            "target=summarize(Dummy_host.Dummy_service.load,'1d','max')",
+            img_src)
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src']
+        self.assertIn('target=Dummy_host.Dummy_service.load&', img_src)
+
+    def test_consolidate_by(self):
+        """Test consolidateBy() goes inside secondYAxis()"""
+        module = init_module({'consolidation': 'consolidateBy',
+                              'graph_mode': 'service'})
+        service = init_service({'perf_data': 'used=50% time=2s'})
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src']
+        self.assertIn("target=consolidateBy("
+                      "Dummy_host.Dummy_service.used,'average')", img_src)
+        self.assertIn("target=secondYAxis(consolidateBy("
+                      "Dummy_host.Dummy_service.time,'average'))", img_src)
+
+    def test_template(self):
+        """Test the templates are consolidated only when asked"""
+        templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_path)
+        write_template(
+            os.path.join(templates_path, 'dummy_cmd.graph'),
+            '$uri/render/?target=$host.$service.load\n')
+        service = init_service({'perf_data': 'load=1'})
+
+        module = init_module({'templates_path': templates_path,
+                              'consolidation': 'consolidateBy'})
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src']
+        self.assertNotIn('maxDataPoints', img_src)
+        self.assertNotIn('consolidateBy', img_src)
+
+        module = init_module({'templates_path': templates_path,
+                              'consolidation': 'consolidateBy',
+                              'template_consolidation': '1'})
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src']
+        self.assertIn('maxDataPoints=586', img_src)
+        self.assertIn("target=consolidateBy(", img_src)
+
+class BackendsTest(unittest.TestCase):
+    """Test the hosts are spread on several Graphite backends"""
+
+    def test_ring(self):
+        """Test adding a backend moves only a part of the hosts"""
+        names = ['host-%d' % i for i in range(1000)]
+        ring = BackendRing(['http://a/', 'http://b/', 'http://c/'])
+        before = dict((name, ring.get(name)) for name in names)
+        counts = [before.values().count(uri) for uri in ring.uris]
+        self.assertGreater(min(counts), 200)
+
+        ring = BackendRing(['http://a/', 'http://b/', 'http://c/',
+                            'http://d/'])
+        moved = [name for name in names if ring.get(name) != before[name]]
+        self.assertLess(len(moved), 400)
+        self.assertTrue(all(ring.get(name) == 'http://d/' for name in moved))
+
+    def test_graph_uris(self):
+        """Test img_src and link go to the backend of the host"""
+        module = init_module({'uri': 'http://a, http://b/'})
+        self.assertEquals(module.backends, ['http://a/', 'http://b/'])
+        self.assertEquals(module.get_external_ui_link()['backends'], [
+            {'label': 'Graphite 1', 'uri': 'http://a/'},
+            {'label': 'Graphite 2', 'uri': 'http://b/'}])
+
+        for i in range(20):
+            service = init_service({'host_name': 'host %d' % i,
+                                    'perf_data': 'load=1'})
+            graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+            backend = module.backend_ring.get('host_%d' % i)
+            self.assertEquals(graph['link'], backend)
+            self.assertTrue(graph['img_src'].startswith(backend + 'render/'))
+
+        service.host.customs = {'_GRAPHITE_BACKEND': '2'}
+        graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+        self.assertEquals(graph['link'], 'http://b/')
+        service.host.customs = {'_GRAPHITE_BACKEND': 'http://b'}
+        graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+        self.assertTrue(graph['img_src'].startswith('http://b/render/'))
+
+        # Not a backend of the uri parameter: the one of the host name
+        service.host.customs = {'_GRAPHITE_BACKEND': 'http://c'}
+        graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+        self.assertEquals(graph['link'], module.backend_ring.get('host_19'))
+        service.host.customs = {'_GRAPHITE_BACKEND': '3'}
+        graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+        self.assertEquals(graph['link'], module.backend_ring.get('host_19'))
+
+    def test_data_src(self):
+        """Test the data endpoint requests the backend of the host"""
+        module = init_module({'uri': 'http://a, http://b/',
+                              'graph_data': '1'})
+        service = init_service({'perf_data': 'load=1'})
+        service.host.customs = {'_GRAPHITE_BACKEND': 'http://b'}
+        graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+        self.assertIn('backend=1', graph['data_src'])
+
+    def test_render_proxy(self):
+        """Test the proxy requests the backend of the graph"""
+        graphites = [start_fake_graphite(self), start_fake_graphite(self)]
+        module = init_module({
+            'uri': ','.join(graphite.uri for graphite in graphites),
+            'render_proxy': '1',
+        })
+        self.addCleanup(module.do_stop)
+        service = init_service({'perf_data': 'load=1'})
+        service.host.customs = {'_GRAPHITE_BACKEND': '2'}
+
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src']
+        self.assertTrue(img_src.startswith('/graphite/render?'))
+        self.assertIn('backend=1', img_src)
+
+        query = img_src.partition('?')[2]
+        module.render_proxies[module.get_backend_index(query)].fetch(
+            'render/?' + query)
+        self.assertEquals(len(graphites[0].requests), 0)
+        self.assertEquals(len(graphites[1].requests), 1)
+
+class IterGraphUrisTest(unittest.TestCase):
+    """Test the iter_graph_uris generator"""
+
+    def test_offset_limit(self):
+        """Test a page of the graphs is the same part of the full list"""
+        module = init_module()
+        service = init_service({
+            'perf_data': ' '.join('m%d=%d' % (i, i) for i in range(10))})
+        graphs = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        self.assertEquals(len(graphs), 10)
+
+        self.assertEquals(list(module.iter_graph_uris(
+            service, GRAPHSTART, GRAPHEND, offset=2, limit=3)), graphs[2:5])
+        self.assertEquals(list(module.iter_graph_uris(
+            service, GRAPHSTART, GRAPHEND, offset=8)), graphs[8:])
+        self.assertEquals(list(module.iter_graph_uris(
+            service, GRAPHSTART, GRAPHEND, limit=0)), [])
+
+    def test_lazy(self):
+        """Test the graphs are built only when asked for"""
+        module = init_module()
+        service = init_service({
+            'perf_data': ' '.join('m%d=%d' % (i, i) for i in range(100))})
+        built = []
+        get_graph = module.get_graph
+        module.get_graph = lambda *args, **kwargs: built.append(1) or \
+            get_graph(*args, **kwargs)
+
+        graphs = module.iter_graph_uris(
+            service, GRAPHSTART, GRAPHEND, offset=10, limit=5)
+        self.assertEquals(len(built), 0)
+        self.assertEquals(len(list(graphs)), 5)
+        self.assertEquals(len(built), 5)
+
+    def test_template(self):
+        """Test the template lines are paginated too"""
+        templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_path)
+        write_template(
+            os.path.join(templates_path, 'dummy_cmd.graph'),
+            ''.join('$uri/render/?target=$host.$service.m%d\n\n' % i
+                    for i in range(4)))
+        module = init_module({'templates_path': templates_path})
+        service = init_service({'perf_data': 'load=1'})
+
+        graphs = list(module.iter_graph_uris(
+            service, GRAPHSTART, GRAPHEND, offset=1, limit=2))
+        self.assertEquals(len(graphs), 2)
+        self.assertIn('.m1&', graphs[0]['img_src'])
+        self.assertIn('.m2&', graphs[1]['img_src'])
+
+class ThresholdLinesTest(unittest.TestCase):
+    """Test the thresholds drawn as constant lines"""
+
+    def test_metric_mode(self):
+        """Test each graph gets the thresholds of its metric"""
+        module = init_module({'threshold_lines': '1'})
+        service = init_service({'perf_data': 'used=50%;70;80 load=1'})
+        graphs = dict((graph['img_src'].split('target=')[1].split('&')[0],
+                       graph['img_src'])
+                      for graph in module.get_graph_uris(
+                          service, GRAPHSTART, GRAPHEND))
+
+        img_src = graphs['Dummy_host.Dummy_service.used']
+        self.assertEquals(img_src.count('target='), 3)
+        self.assertIn("target=alias(color(constantLine(70),'orange'),"
+                      "'used_warn')", img_src)
+        self.assertIn("target=alias(color(constantLine(80),'red'),"
+                      "'used_crit')", img_src)
+        self.assertEquals(
+            graphs['Dummy_host.Dummy_service.load'].count('target='), 1)
+
+    def test_service_mode(self):
+        """Test the thresholds follow the axis of their metric"""
+        module = init_module({'threshold_lines': '1',
+                              'graph_mode': 'service'})
+        service = init_service({'perf_data': 'used=50%;70;80 time=2s;5'})
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src']
+        self.assertEquals(img_src.count('target='), 5)
+        self.assertIn("target=secondYAxis(alias(color(constantLine(5),"
+                      "'orange'),'time_warn'))", img_src)
+
+    def test_off(self):
+        """Test no constant line by default"""
+        module = init_module()
+        service = init_service({'perf_data': 'used=50%;70;80'})
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src']
+        self.assertNotIn('constantLine', img_src)
+
+class GetGraphUrisRangesTest(unittest.TestCase):
+    """Test the graphs of several time ranges in one call"""
+
+    RANGES = [(GRAPHEND - 4 * 3600, GRAPHEND),
+              (GRAPHEND - 86400, GRAPHEND),
+              (GRAPHEND - 7 * 86400, GRAPHEND)]
+
+    def test_same_graphs(self):
+        """Test each range gets the graphs of a get_graph_uris call"""
+        module = init_module({'consolidation': 'summarize'})
+        service = init_service({'perf_data': 'used=50%;70;80 load=1'})
+
+        ret = module.get_graph_uris_ranges(
+            service, self.RANGES, ('detail', 'dashboard'))
+
+        self.assertEquals(sorted(ret), ['dashboard', 'detail'])
+        for source in ret:
+            self.assertEquals(len(ret[source]), 3)
+            for (graphstart, graphend), graphs in zip(self.RANGES,
+                                                      ret[source]):
+                self.assertEquals(graphs, module.get_graph_uris(
+                    service, graphstart, graphend, source))
+
+    def test_shared_steps(self):
+        """Test the template is read and the perf_data parsed once"""
+        templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_path)
+        write_template(
+            os.path.join(templates_path, 'dummy_cmd.graph'),
+            '$uri/render/?target=$host.$service.load\n')
+        module = init_module({'templates_path': templates_path,
+                              'instrumentation': '1'})
+        service = init_service({'perf_data': 'load=1'})
+
+        ret = module.get_graph_uris_ranges(service, self.RANGES)
+
+        self.assertEquals([len(graphs) for graphs in ret['detail']],
+                          [1, 1, 1])
+        self.assertNotEquals(ret['detail'][0], ret['detail'][1])
+        self.assertEquals(module.template_cache.stats()['misses'], 1)
+        self.assertEquals(module.template_cache.stats()['hits'], 0)
+        self.assertEquals(module.get_stats()['paths']['template'], 1)
+
+class PlanStoreTest(unittest.TestCase):
+    """Test the plan store shared by the worker processes"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.templates_path = os.path.join(self.folder, 'templates')
+        write_template(
+            os.path.join(self.templates_path, 'detail', 'dummy_cmd.graph'),
+            '$uri/render/?target=$host.$service.load\n')
+
+    def init_worker(self):
+        """Return a module using the shared store"""
+        module = init_module({
+            'templates_path': self.templates_path,
+            'plan_store': '1',
+            'plan_store_path': os.path.join(self.folder, 'plans'),
+            'plan_store_interval': '0',
+        })
+        self.addCleanup(module.do_stop)
+        return module
+
+    def test_store(self):
+        """Test the entries go through the file"""
+        store = PlanStore(os.path.join(self.folder, 'store'))
+        store.set_generation('1')
+        store.put('a', 'b\nc')
+        self.assertEquals(store.get('a'), 'b\nc')
+        store.flush()
+        self.assertEquals(store.stats()['size'], 1)
+        self.assertEquals(store.get('a'), 'b\nc')
+        self.assertIsNone(store.get('c'))
+
+        other = PlanStore(os.path.join(self.folder, 'store'))
+        other.set_generation('1')
+        other.put('c', 'd')
+        other.flush()
+        self.assertEquals(other.get('a'), 'b\nc')
+        store.reload()
+        self.assertEquals(store.get('c'), 'd')
+
+        other.set_generation('2')
+        self.assertIsNone(other.get('a'))
+
+    def test_workers(self):
+        """Test a worker uses the templates index and content of another
+        one"""
+        service = init_service({'perf_data': 'load=1'})
+        first = self.init_worker()
+        graphs = first.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        first.plan_store.flush()
+
+        second = self.init_worker()
+        self.assertEquals(
+            second.get_graph_uris(service, GRAPHSTART, GRAPHEND), graphs)
+        stats = second.plan_store.stats()
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['pending'], 0)
+
+    def test_new_template(self):
+        """Test the store is not used after the templates changed"""
+        service = init_service({'perf_data': 'load=1'})
+        first = self.init_worker()
+        first.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        first.plan_store.flush()
+
+        write_template(
+            os.path.join(self.templates_path, 'dashboard', 'dummy_cmd.graph'),
+            '$uri/render/?target=$host.$service.users\n')
+        second = self.init_worker()
+        second.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        self.assertEquals(second.plan_store.stats()['hits'], 0)
+
+class BackendHealthTest(unittest.TestCase):
+    """Test the Graphite health probe and the degraded graphs"""
+
+    def init_module(self, server, params={}):
+        """Return a module probing server, without the probe thread"""
+        options = {
+            'uri': server.uri,
+            'health_check': '1',
+            'health_interval': '0',
+            'health_max_latency': '0.2',
+            'health_timeout': '1',
+            'health_failures': '2',
+            'health_cooldown': '30',
+            'health_recoveries': '2',
+        }
+        options.update(params)
+        module = init_module(options)
+        self.addCleanup(module.do_stop)
+        return module
+
+    def test_transitions(self):
+        """Test the circuit opens on failures, and closes after the
+        cooldown and enough successful probes"""
+        server = start_fake_graphite(self)
+        health = self.init_module(server).health
+        self.assertEquals(health.probe(1000), BackendHealth.CLOSED)
+        self.assertIn('format=json', server.requests[-1])
+
+        server.status = 500
+        self.assertEquals(health.probe(1001), BackendHealth.CLOSED)
+        self.assertEquals(health.probe(1002), BackendHealth.OPEN)
+        self.assertFalse(health.is_healthy())
+
+        # Open until the cooldown, even if Graphite is back
+        server.status = 200
+        self.assertEquals(health.probe(1020), BackendHealth.OPEN)
+        self.assertEquals(health.probe(1032), BackendHealth.HALF_OPEN)
+        self.assertFalse(health.is_healthy())
+        self.assertEquals(health.probe(1033), BackendHealth.CLOSED)
+        self.assertTrue(health.is_healthy())
+
+        stats = health.stats()
+        self.assertEquals(stats['probes'], 6)
+        self.assertEquals(stats['transitions'], 3)
+        self.assertAlmostEqual(stats['error_rate'], 2 / 6.0)
+
+    def test_slow(self):
+        """Test a slow Graphite opens the circuit, and a failure when
+        half-open opens it again"""
+        server = start_fake_graphite(self)
+        health = self.init_module(server).health
+        server.delay = 0.3
+        health.probe(1000)
+        self.assertEquals(health.probe(1001), BackendHealth.OPEN)
+        self.assertGreater(health.stats()['latency'], 0.2)
+
+        server.delay = 0
+        self.assertEquals(health.probe(1031), BackendHealth.HALF_OPEN)
+        server.status = 500
+        self.assertEquals(health.probe(1032), BackendHealth.OPEN)
+        server.status = 200
+        self.assertEquals(health.probe(1050), BackendHealth.OPEN)
+        self.assertEquals(health.probe(1062), BackendHealth.HALF_OPEN)
+
+    def test_reduce(self):
+        """Test the graphs are fewer, smaller and summarized while
+        Graphite is unhealthy"""
+        server = start_fake_graphite(self)
+        module = self.init_module(server, {'health_max_targets': '2'})
+        service = init_service({'perf_data': 'a=1 b=2 c=3 d=4'})
+        graphs = module.get_graph_uris(service, GRAPHEND - 86400, GRAPHEND)
+        self.assertEquals(len(graphs), 4)
+
+        server.status = 500
+        module.health.probe()
+        module.health.probe()
+        graphs = module.get_graph_uris(service, GRAPHEND - 86400, GRAPHEND)
+        self.assertEquals(len(graphs), 2)
+        for graph in graphs:
+            self.assertIn('width=293', graph['img_src'])
+            self.assertIn('height=154', graph['img_src'])
+            self.assertIn("summarize(", graph['img_src'])
+            self.assertIn('30min', graph['img_src'])
+
+        module.graph_mode = 'service'
+        graphs = module.get_graph_uris(service, GRAPHEND - 86400, GRAPHEND)
+        self.assertEquals(len(graphs), 1)
+        self.assertEquals(graphs[0]['img_src'].count('target='), 2)
+
+    def test_placeholder(self):
+        """Test a single placeholder graph is given while Graphite is
+        unhealthy"""
+        server = start_fake_graphite(self)
+        module = self.init_module(server, {'health_mode': 'placeholder',
+                                           'graph_data': '1'})
+        service = init_service({'perf_data': 'a=1 b=2 c=3'})
+        server.status = 500
+        module.health.probe()
+        module.health.probe()
+
+        graphs = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        self.assertEquals(len(graphs), 1)
+        self.assertTrue(
+            graphs[0]['img_src'].startswith('/graphite/unavailable?'))
+        self.assertNotIn('data_src', graphs[0])
+        self.assertEquals(list(module.iter_graph_uris(
+            service, GRAPHSTART, GRAPHEND, offset=1)), [])
+        self.assertEquals(module.get_graph_uris(
+            init_service(), GRAPHSTART, GRAPHEND), [])
+
+        module.placeholder_uri = 'http://static/unavailable.png'
+        graphs = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        self.assertTrue(graphs[0]['img_src'].startswith(
+            'http://static/unavailable.png?'))
+
+    def test_backends(self):
+        """Test only the graphs of the hosts of an unhealthy backend are
+        degraded, and the prewarmer does not request it"""
+        servers = [start_fake_graphite(self), start_fake_graphite(self)]
+        module = self.init_module(servers[0], {
+            'uri': '%s, %s' % (servers[0].uri, servers[1].uri),
+            'prewarm': '1',
+            'instrumentation': '1',
+        })
+        self.assertEquals(len(module.healths), 2)
+        services = []
+        for index in (1, 2):
+            service = init_service({'host_name': 'host %d' % index,
+                                    'perf_data': 'a=1 b=2 c=3 d=4'})
+            service.host.customs = {'_GRAPHITE_BACKEND': str(index)}
+            services.append(service)
+
+        servers[1].status = 500
+        module.healths[1].probe()
+        module.healths[1].probe()
+        self.assertTrue(module.healths[0].is_healthy())
+        healthy = module.get_graph_uris(services[0], GRAPHSTART, GRAPHEND)
+        self.assertEquals(len(healthy), 4)
+        self.assertIn('width=586', healthy[0]['img_src'])
+        degraded = module.get_graph_uris(services[1], GRAPHSTART, GRAPHEND)
+        self.assertEquals(len(degraded), 2)
+        self.assertIn('width=293', degraded[0]['img_src'])
+        self.assertTrue(degraded[0]['img_src'].startswith(servers[1].uri))
+
+        for service in services:
+            module.prewarmer.note(service)
+        requests = len(servers[1].requests)
+        module.prewarmer.run_once()
+        self.assertEquals(len(servers[1].requests), requests)
+        self.assertEquals(module.prewarmer.requests, 4)
+        self.assertEquals([stats['uri'] for stats in
+                           module.get_stats()['health']], module.backends)
+
+class HostOverviewTest(unittest.TestCase):
+    """Test the host overview graphs of the services metrics"""
+
+    def init_host(self, perf_datas):
+        """Return a host with a service for each perf_data"""
+        services = [init_service({'service_description': 'svc %d' % i,
+                                  'perf_data': perf_data})
+                    for i, perf_data in enumerate(perf_datas)]
+        host = services[0].host
+        host.customs = {'_GRAPHITE_PRE': 'dc1'}
+        host.check_command = services[0].check_command
+        host.perf_data = ''
+        for service in services:
+            service.host = host
+        host.services = services
+        return host
+
+    def test_off(self):
+        """Test the host graphs are the usual ones by default"""
+        module = init_module()
+        host = self.init_host(['used=10%'])
+        self.assertEquals(
+            module.get_graph_uris(host, GRAPHSTART, GRAPHEND), [])
+
+    def test_overview(self):
+        """Test the metrics are grouped by unit, services with the same
+        metrics sharing a target"""
+        module = init_module({'host_overview': '1', 'max_data_points': '0'})
+        host = self.init_host(
+            ["'/'=10% '/var'=20%", "'/'=30% '/var'=40%", 'used=5MB free=1B',
+             'time=0.1s rta=20ms', 'load=1 if_1=2c if_2=3c', 'other=1Hz',
+             'time=5us size=1TB'])
+        host.perf_data = 'rta=1ms'
+
+        graphs = module.get_graph_uris(host, GRAPHSTART, GRAPHEND)
+        urls = [graph['img_src'] for graph in graphs]
+        self.assertEquals(len(urls), 5)
+        self.assertIn('target=dc1.Dummy_host.__HOST__.rta', urls[0])
+
+        self.assertIn('title=percent', urls[1])
+        self.assertIn('yMax=100', urls[1])
+        self.assertIn(
+            'target=aliasByNode(dc1.Dummy_host.{svc_0,svc_1}.{_,_var},2,3)',
+            urls[1])
+        self.assertEquals(urls[1].count('target='), 1)
+
+        self.assertIn('target=aliasByNode(dc1.Dummy_host.svc_2.free,2,3)',
+                      urls[2])
+        self.assertIn(
+            'target=aliasByNode(scale(dc1.Dummy_host.svc_2.used,1048576)'
+            ',2,3)', urls[2])
+        self.assertIn(
+            'target=aliasByNode(scale(dc1.Dummy_host.svc_3.rta,0.001),2,3)',
+            urls[3])
+        self.assertIn('scale(dc1.Dummy_host.svc_6.time,0.000001)', urls[3])
+        self.assertIn('scale(dc1.Dummy_host.svc_6.size,1099511627776)',
+                      urls[2])
+        self.assertIn('title=counts', urls[4])
+        self.assertNotIn('other', ''.join(urls))
+
+    def test_counts(self):
+        """Test the counts graph, with multival metrics apart"""
+        module = init_module({'host_overview': '1',
+                              'consolidation': 'consolidateBy'})
+        host = self.init_host(['load=1 if_1=2c if_2=3c'])
+        graphs = module.get_graph_uris(host, GRAPHSTART, GRAPHEND)
+        self.assertEquals(len(graphs), 1)
+        img_src = graphs[0]['img_src']
+        self.assertIn('title=counts', img_src)
+        self.assertIn("target=aliasByNode(consolidateBy("
+                      "dc1.Dummy_host.svc_0.load,'average'),2,3)", img_src)
+        self.assertIn("target=aliasByNode(consolidateBy("
+                      "dc1.Dummy_host.svc_0.if.*,'average'),2,3,4)", img_src)
+        self.assertIn('maxDataPoints=586', img_src)
+
+    def test_ranges(self):
+        """Test each time range gets its own summarize() step, inside
+        aliasByNode() and scale()"""
+        module = init_module({'host_overview': '1',
+                              'consolidation': 'summarize'})
+        host = self.init_host(['rta=20ms'])
+        ret = module.get_graph_uris_ranges(
+            host, [(GRAPHEND - 86400, GRAPHEND),
+                   (GRAPHEND - 7 * 86400, GRAPHEND)])
+        day, week = [graphs[0]['img_src'] for graphs in ret['detail']]
+        self.assertIn("target=aliasByNode(scale(summarize("
+                      "dc1.Dummy_host.svc_0.rta,'5min','avg'),0.001),2,3)",
+                      day)
+        self.assertIn("target=aliasByNode(scale(summarize("
+                      "dc1.Dummy_host.svc_0.rta,'30min','avg'),0.001),2,3)",
+                      week)
+
+    def test_degraded(self):
+        """Test the overview graphs are summarized once while Graphite
+        is unhealthy"""
+        server = start_fake_graphite(self)
+        module = init_module({'uri': server.uri, 'host_overview': '1',
+                              'consolidation': 'summarize',
+                              'health_check': '1', 'health_failures': '1'})
+        self.addCleanup(module.do_stop)
+        host = self.init_host(['rta=20ms'])
+        server.status = 500
+        module.health.probe()
+        graphs = module.get_graph_uris(host, GRAPHEND - 86400, GRAPHEND)
+        self.assertEquals(len(graphs), 1)
+        img_src = graphs[0]['img_src']
+        self.assertIn("target=aliasByNode(scale(summarize("
+                      "dc1.Dummy_host.svc_0.rta,'30min','avg'),0.001),2,3)",
+                      img_src)
+        self.assertEquals(img_src.count('summarize('), 1)
+        self.assertIn('width=293', img_src)
+
+    def test_many_services(self):
+        """Test a host with 60 services gets a few renders"""
+        module = init_module({'host_overview': '1',
+                              'host_overview_max_targets': '3'})
+        host = self.init_host(
+            ["'/'=%d%%;80;90 size=%dMB" % (i, i) if i % 2 else
+             'm%d=%ds' % (i % 20, i) for i in range(60)])
+        graphs = module.get_graph_uris(host, GRAPHSTART, GRAPHEND)
+        targets = [graph['img_src'].count('target=') for graph in graphs]
+        # percent and bytes share one target, seconds has 10 metrics
+        self.assertEquals(targets, [1, 1, 3, 3, 3, 1])
+
+        self.assertEquals(
+            list(module.iter_graph_uris(host, GRAPHSTART, GRAPHEND,
+                                        offset=4)),
+            graphs[4:])
+
+class LRUDictTest(unittest.TestCase):
+    """Test the ordered dict of the LRU caches"""
+
+    def test_order(self):
+        """Test the entries are kept in the order they were set"""
+        entries = LRUDict()
+        for key in 'abcd':
+            entries[key] = key.upper()
+        self.assertEquals(len(entries), 4)
+        self.assertEquals(entries.pop('b'), 'B')
+        self.assertIsNone(entries.pop('b'))
+        entries['b'] = 'B'
+        entries['a'] = 'A2'
+        self.assertIn('a', entries)
+        self.assertEquals(entries.values(), ['A2', 'C', 'D', 'B'])
+        self.assertEquals(entries.popitem(last=False), ('a', 'A2'))
+        self.assertEquals(entries.popitem(), ('b', 'B'))
+        entries.clear()
+        self.assertEquals(len(entries), 0)
+        self.assertEquals(entries.values(), [])
+        self.assertRaises(KeyError, entries.popitem)
+
+class TemplateCacheTest(unittest.TestCase):
+    """Test the TemplateCache class"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_reload_on_change(self):
+        """Test a template is read again only when the file changed"""
+        path = os.path.join(self.folder, 'cmd.graph')
+        write_template(path, 'first $host')
+        cache = TemplateCache()
+
+        self.assertEquals(cache.get(path).template, 'first $host')
+        self.assertEquals(cache.get(path).template, 'first $host')
+        write_template(path, 'second version $host')
+        self.assertEquals(cache.get(path).template, 'second version $host')
+
+        stats = cache.stats()
+        self.assertEquals(stats['hits'], 1)
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['reloads'], 1)
+
+    def test_check_interval(self):
+        """Test the file is not checked again before the interval"""
+        path = os.path.join(self.folder, 'cmd.graph')
+        write_template(path, 'first $host')
+        cache = TemplateCache(check_interval=3600)
+
+        cache.get(path)
+        write_template(path, 'second version $host')
+        self.assertEquals(cache.get(path).template, 'first $host')
+
+    def test_missing_file(self):
+        """Test a missing template gives None"""
+        cache = TemplateCache()
+        self.assertIsNone(cache.get(os.path.join(self.folder, 'no.graph')))
+
+    def test_lru_eviction(self):
+        """Test the least recently used template is evicted"""
+        cache = TemplateCache(max_size=2)
+        paths = []
+        for name in ('a', 'b', 'c'):
+            path = os.path.join(self.folder, name + '.graph')
+            write_template(path, name)
+            paths.append(path)
+
+        cache.get(paths[0])
+        cache.get(paths[1])
+        cache.get(paths[0])
+        cache.get(paths[2])
+
+        self.assertIn(paths[0], cache.entries)
+        self.assertNotIn(paths[1], cache.entries)
+        self.assertEquals(cache.stats()['evictions'], 1)
+
+class TemplateIndexTest(unittest.TestCase):
+    """Test the TemplateIndex class"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def test_lookup_order(self):
+        """Test the source folder is used first, then the root one"""
+        write_template(os.path.join(self.folder, 'detail', 'cmd.graph'), '')
+        write_template(
+            os.path.join(self.folder, 'detail', 'nrpe_disk.graph'), '')
+        write_template(os.path.join(self.folder, 'cmd.graph'), '')
+        write_template(os.path.join(self.folder, 'nrpe_load.graph'), '')
+        index = TemplateIndex(self.folder)
+
+        self.assertEquals(
+            index.lookup('detail', 'cmd'),
+            os.path.join(self.folder, 'detail', 'cmd.graph'))
+        self.assertEquals(
+            index.lookup('dashboard', 'cmd'),
+            os.path.join(self.folder, 'cmd.graph'))
+        self.assertEquals(
+            index.lookup('detail', 'nrpe', 'disk'),
+            os.path.join(self.folder, 'detail', 'nrpe_disk.graph'))
+        self.assertEquals(
+            index.lookup('detail', 'nrpe', 'load'),
+            os.path.join(self.folder, 'nrpe_load.graph'))
+        self.assertIsNone(index.lookup('detail', 'nrpe', 'swap'))
+        self.assertIsNone(index.lookup('detail', 'other'))
+
+    def test_refresh(self):
+        """Test added and removed templates are seen after a refresh"""
+        index = TemplateIndex(self.folder)
+        index.scan()
+        self.assertIsNone(index.lookup('detail', 'cmd'))
+        self.assertFalse(index.refresh())
+
+        path = os.path.join(self.folder, 'detail', 'cmd.graph')
+        write_template(path, '')
+        self.assertTrue(index.refresh())
+        self.assertEquals(index.lookup('detail', 'cmd'), path)
+
+    def test_missing_folder(self):
+        """Test a missing templates folder gives an empty index"""
+        index = TemplateIndex(os.path.join(self.folder, 'missing'))
+        self.assertIsNone(index.lookup('detail', 'cmd'))
+
+class FailingConnection(object):
+    """HTTP connection failing all its requests"""
+
+    def __init__(self):
+        self.closed = False
+
+    def request(self, method, path):
+        """Fail the request"""
+        raise socket.error('connection reset')
+
+    def close(self):
+        """Record the close"""
+        self.closed = True
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Test the keep-alive connections to Graphite"""
+
+    def test_failed_retry(self):
+        """Test the connections are closed when the retry fails too"""
+        pool = ConnectionPool('http://127.0.0.1:1/')
+        idle = FailingConnection()
+        pool.idle.append(idle)
+        retries = []
+
+        def new_connection():
+            """Give a failing connection"""
+            retries.append(FailingConnection())
+            return retries[-1]
+        pool.new_connection = new_connection
+
+        self.assertRaises(socket.error, pool.request, '/render/')
+        self.assertTrue(idle.closed)
+        self.assertEquals(len(retries), 1)
+        self.assertTrue(retries[0].closed)
+        self.assertEquals(pool.idle, [])
+
+class RenderProxyTest(unittest.TestCase):
+    """Test the RenderProxy class against a fake Graphite"""
+
+    def setUp(self):
+        self.graphite = start_fake_graphite(self)
+
+    def get_proxy(self, cache=None):
+        """Return a RenderProxy for the fake Graphite"""
+        proxy = RenderProxy(self.graphite.uri, cache or RenderCache())
+        self.addCleanup(proxy.close)
+        return proxy
+
+    def test_cache(self):
+        """Test a render is requested only once to Graphite"""
+        proxy = self.get_proxy()
+        path = 'render/?target=a&from=-4h&width=100'
+
+        first = proxy.fetch(path)
+        second = proxy.fetch(path)
+
+        self.assertEquals(first[:3], (200, 'image/png', 'PNG /' + path))
+        self.assertEquals(second[:3], first[:3])
+        self.assertEquals(first[3], 144)
+        self.assertEquals(len(self.graphite.requests), 1)
+
+    def test_collapse(self):
+        """Test concurrent identical requests make one Graphite request"""
+        self.graphite.delay = 0.3
+        proxy = self.get_proxy()
+        results = []
+
+        def fetch():
+            """Fetch the render in a thread"""
+            results.append(proxy.fetch('render/?target=a'))
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(results), 5)
+        self.assertEquals(set(result[0] for result in results), set([200]))
+        self.assertEquals(len(self.graphite.requests), 1)
+
+    def test_error_not_cached(self):
+        """Test a failed render is not cached"""
+        self.graphite.status = 500
+        proxy = self.get_proxy()
+
+        self.assertEquals(proxy.fetch('render/?target=a')[0], 500)
+        self.assertEquals(proxy.fetch('render/?target=a')[0], 500)
+        self.assertEquals(len(self.graphite.requests), 2)
+
+    def test_disk_cache(self):
+        """Test the renders are kept in the cache folder"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.get_proxy(RenderCache(cache_dir=cache_dir)).fetch(
+            'render/?target=a')
+
+        cached = RenderCache(cache_dir=cache_dir).get('render/?target=a')
+
+        self.assertEquals(cached[:2], ('image/png', 'PNG /render/?target=a'))
+        self.assertEquals(len(self.graphite.requests), 1)
+
+    def test_module_route(self):
+        """Test the module serves the renders on its route"""
+        from shinken.webui import bottlewebui
+        module = init_module({
+            'uri': self.graphite.uri,
+            'render_proxy': '1',
+        })
+        app = bottlewebui.Bottle()
+        module.load(app)
+        self.addCleanup(module.do_stop)
+        service = init_service({'perf_data': 'load=1'})
+
+        img_src = module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND)[0]['img_src']
+        self.assertTrue(img_src.startswith('/graphite/render?'))
+
+        path, _, query = img_src.partition('?')
+        output = []
+        body = app({
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'wsgi.input': StringIO(''),
+            'wsgi.errors': StringIO(),
+        }, lambda status, headers: output.append(status))
+        self.assertEquals(output, ['200 OK'])
+        self.assertEquals(''.join(body), 'PNG /render/?' + query)
+
+class FakeHostgroup(object):
+    """Hostgroup with a list of hosts"""
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+    def get_hosts(self):
+        """Return the hostgroup members"""
+        return self.hosts
+
+class FakeDatamgr(object):
+    """WebUI data manager giving hostgroups by name"""
+    def __init__(self, hostgroups):
+        self.hostgroups = hostgroups
+
+    def get_hostgroup(self, name):
+        """Return a hostgroup or None"""
+        return self.hostgroups.get(name)
+
+class FakeApp(object):
+    """WebUI application with a data manager"""
+    def __init__(self, hostgroups={}):
+        self.datamgr = FakeDatamgr(hostgroups)
+
+class GraphPrewarmerTest(unittest.TestCase):
+    """Test the GraphPrewarmer class against a fake Graphite"""
+
+    def setUp(self):
+        self.graphite = start_fake_graphite(self)
+
+    def get_module(self, params={}):
+        """Return a module with prewarm, for the fake Graphite"""
+        options = {
+            'uri': self.graphite.uri,
+            'prewarm': '1',
+            'prewarm_budget': '3',
+        }
+        options.update(params)
+        module = init_module(options)
+        module.app = FakeApp()
+        self.addCleanup(module.do_stop)
+        return module
+
+    def test_recent(self):
+        """Test the graphs viewed on the dashboard are requested"""
+        module = self.get_module()
+        service = init_service({'perf_data': 'load=1'})
+        module.get_graph_uris(service, GRAPHSTART, GRAPHEND, 'detail')
+        self.assertEquals(module.prewarmer.run_once(), 0)
+
+        module.get_graph_uris(service, GRAPHSTART, GRAPHEND, 'dashboard')
+        self.assertEquals(module.prewarmer.run_once(), 1)
+
+        self.assertEquals(len(self.graphite.requests), 1)
+        self.assertIn('target=Dummy_host.Dummy_service.load',
+                      self.graphite.requests[0])
+        self.assertIn('fontSize=18', self.graphite.requests[0])
+        self.assertEquals(module.prewarmer.stats()['requests'], 1)
+
+    def test_budget(self):
+        """Test a run requests at most the budget URLs"""
+        module = self.get_module({'prewarm_concurrency': '2'})
+        services = [
+            init_service({
+                'service_description': 'Service %d' % i,
+                'perf_data': 'load=1',
+            })
+            for i in range(5)
+        ]
+        module.get_graph_uris_bulk(services, GRAPHSTART, GRAPHEND, 'dashboard')
+
+        self.assertEquals(module.prewarmer.run_once(), 3)
+        self.assertEquals(len(self.graphite.requests), 3)
+        # The most recently viewed first
+        requested = ''.join(self.graphite.requests)
+        for i in (4, 3, 2):
+            self.assertIn('Service_%d' % i, requested)
+
+    def test_hostgroups(self):
+        """Test the hosts of the hostgroups and their services are
+        requested, through the render proxy"""
+        module = self.get_module({
+            'prewarm_hostgroups': 'web, db',
+            'render_proxy': '1',
+        })
+        service = init_service({'perf_data': 'load=1'})
+        service.host.perf_data = 'rta=1ms'
+        service.host.check_command = service.check_command
+        service.host.services = [service]
+        module.app = FakeApp({'web': FakeHostgroup([service.host])})
+
+        self.assertEquals(module.prewarmer.run_once(), 2)
+        self.assertEquals(len(self.graphite.requests), 2)
+        self.assertEquals(module.render_proxy.cache.stats()['entries'], 2)
+
+    def test_cache_hit(self):
+        """Test a dashboard view after a run, until the next run, gets
+        the prewarmed renders from the proxy"""
+        module = self.get_module({'render_proxy': '1'})
+        self.assertEquals(module.prewarmer.step, 300)
+        service = init_service({'perf_data': 'load=1'})
+        run = 1400000000 - 1400000000 % 300 + 10
+        module.get_graph_uris(service, run - 14400, run, 'dashboard')
+        self.assertEquals(module.prewarmer.run_once(run), 1)
+        self.assertEquals(len(self.graphite.requests), 1)
+
+        view = run + 250
+        graph = module.get_graph_uris(service, view - 14400, view,
+                                      'dashboard')[0]
+        query = graph['img_src'].partition('?')[2]
+        ttl = module.render_proxy.fetch('render/?' + query)[3]
+        self.assertEquals(len(self.graphite.requests), 1)
+        self.assertGreater(ttl, 250)
+
+class DownsampleTest(unittest.TestCase):
+    """Test the downsample function"""
+
+    def setUp(self):
+        generator = random.Random(42)
+        self.datapoints = [
+            [None if i % 50 == 0 else generator.uniform(0, 100),
+             1400000000 + 60 * i]
+            for i in range(5000)
+        ]
+
+    def test_downsample(self):
+        """Test the series is reduced to the threshold, nulls dropped"""
+        sampled = graphite_module.downsample(self.datapoints, 100)
+
+        self.assertEquals(len(sampled), 100)
+        self.assertEquals(sampled[0], self.datapoints[1])
+        self.assertEquals(sampled[-1], self.datapoints[-1])
+        self.assertNotIn(None, [point[0] for point in sampled])
+        times = [point[1] for point in sampled]
+        self.assertEquals(times, sorted(times))
+
+    def test_short_series(self):
+        """Test a short series is kept as is"""
+        self.assertEquals(
+            graphite_module.downsample([[1, 1], [None, 2], [3, 3]], 100),
+            [[1, 1], [3, 3]])
+
+    def test_numpy(self):
+        """Test the numpy version gives the same points as the pure
+        python one"""
+        if graphite_module.numpy is None:
+            return
+        numpy = graphite_module.numpy
+        graphite_module.numpy = None
+        try:
+            expected = graphite_module.downsample(self.datapoints, 100)
+        finally:
+            graphite_module.numpy = numpy
+        self.assertEquals(
+            graphite_module.downsample_numpy(self.datapoints, 100), expected)
+        self.assertEquals(
+            graphite_module.downsample_numpy(self.datapoints, 4900),
+            [point for point in self.datapoints if point[0] is not None])
+
+class GraphDataTest(unittest.TestCase):
+    """Test the data endpoint against a fake Graphite"""
+
+    def setUp(self):
+        self.graphite = start_fake_graphite(self)
+        self.module = init_module({
+            'uri': self.graphite.uri,
+            'graph_data': '1',
+        })
+        self.addCleanup(self.module.do_stop)
+
+    def test_data_src(self):
+        """Test the data endpoint gives the downsampled series and the
+        thresholds"""
+        service = init_service({
+            'perf_data': 'used=50%;70;80',
+        })
+        uris = self.module.get_graph_uris(
+            service, GRAPHSTART, GRAPHEND, params={'width': 100})
+        data_src = uris[0]['data_src']
+        self.assertTrue(data_src.startswith('/graphite/data?'))
+        self.assertIn('warn=70&crit=80', data_src)
+
+        status, series = self.module.get_graph_data(data_src.partition('?')[2])
+
+        self.assertEquals(status, 200)
+        self.assertEquals(len(series), 1)
+        self.assertEquals(series[0]['target'], 'Dummy_host.Dummy_service.used')
+        self.assertEquals(len(series[0]['datapoints']), 100)
+        self.assertEquals(series[0]['thresholds'], {'warn': 70, 'crit': 80})
+        self.assertEquals(len(self.graphite.requests), 1)
+        self.assertIn('format=json', self.graphite.requests[0])
+
+    def test_bad_threshold(self):
+        """Test a threshold which is not a number is dropped"""
+        status, series = self.module.get_graph_data(
+            'target=a&warn=x&crit=80&from=-1d&width=100')
+        self.assertEquals(status, 200)
+        self.assertEquals(series[0]['thresholds'], {'crit': 80})
+
+    def test_error(self):
+        """Test a Graphite error gives no series"""
+        self.graphite.status = 500
+        self.assertEquals(
+            self.module.get_graph_data('target=a&from=-1d&width=100'),
+            (500, []))
+
+class MetricIndexTest(unittest.TestCase):
+    """Test the MetricIndex class"""
+
+    def setUp(self):
+        self.index = MetricIndex()
+        self.index.build([
+            'srv1.cpu.cpu.0',
+            'srv1.cpu.cpu.1',
+            'srv1.cpu.cpu',
+            'srv1.disk._var',
+            'srv2.disk._var',
+        ])
+
+    def test_contains(self):
+        """Test the metrics, and only them, are found"""
+        self.assertEquals(self.index.count, 5)
+        self.assertTrue(self.index.contains('srv1.disk._var'))
+        self.assertTrue(self.index.contains('srv1.cpu.cpu'))
+        self.assertTrue(self.index.contains('srv1.cpu.cpu.1'))
+        self.assertFalse(self.index.contains('srv1.disk'))
+        self.assertFalse(self.index.contains('srv1.disk._var.x'))
+        self.assertFalse(self.index.contains('srv3.disk._var'))
+
+    def test_resolve(self):
+        """Test the missing metrics are dropped and wildcards expanded"""
+        self.assertEquals(self.index.resolve('srv1.cpu.cpu.*'),
+                          ['srv1.cpu.cpu.0', 'srv1.cpu.cpu.1'])
+        self.assertEquals(self.index.resolve('srv*.disk._var'),
+                          ['srv1.disk._var', 'srv2.disk._var'])
+        self.assertEquals(self.index.resolve('srv1.disk._var'),
+                          ['srv1.disk._var'])
+        self.assertEquals(self.index.resolve('srv1.disk._tmp'), [])
+        self.assertEquals(self.index.resolve('srv1.{cpu,disk}.x'),
+                          ['srv1.{cpu,disk}.x'])
+
+    def test_order(self):
+        """Test a node is found when names sort between its metric and
+        its children"""
+        index = MetricIndex()
+        index.build(['a.b', 'a-b.c', 'a', 'a.b', 'a.b-c.d', 'a.b.c'])
+        self.assertEquals(index.count, 5)
+        self.assertEquals(index.tree[0], ('a', 'a-b'))
+        self.assertTrue(index.contains('a'))
+        self.assertTrue(index.contains('a.b'))
+        self.assertTrue(index.contains('a.b.c'))
+        self.assertFalse(index.contains('a-b'))
+        self.assertEquals(index.resolve('a.*'), ['a.b'])
+        self.assertEquals(index.resolve('a.*.*'), ['a.b-c.d', 'a.b.c'])
+        self.assertEquals(index.resolve('*'), ['a'])
+
+    def test_not_loaded(self):
+        """Test nothing is dropped before the index is loaded"""
+        self.assertEquals(MetricIndex().resolve('srv1.disk._tmp'),
+                          ['srv1.disk._tmp'])
+
+    def test_whisper(self):
+        """Test the index of a whisper folder"""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        write_template(os.path.join(folder, 'srv1', 'load', 'load1.wsp'), '')
+        index = MetricIndex(whisper_dir=folder)
+        index.refresh()
+        self.assertEquals(index.resolve('srv1.load.*'), ['srv1.load.load1'])
+
+        write_template(os.path.join(folder, 'srv1', 'load', 'load5.wsp'), '')
+        index.refresh()
+        self.assertEquals(index.resolve('srv1.load.*'),
+                          ['srv1.load.load1', 'srv1.load.load5'])
+
+    def test_graph_uris(self):
+        """Test the graphs of the missing metrics are dropped, and the
+        wildcards expanded, with the index of a fake Graphite"""
+        graphite = start_fake_graphite(self)
+        graphite.metrics = [
+            'Dummy_host.Dummy_service.cpu.0',
+            'Dummy_host.Dummy_service.cpu.1',
+            'Dummy_host.Dummy_service.load',
+        ]
+        module = init_module({
+            'uri': graphite.uri,
+            'metric_index': '1',
+        })
+        self.addCleanup(module.do_stop)
+        module.metric_index.refresh()
+        service = init_service({
+            'perf_data': 'load=1 missing=2 cpu_0=10% cpu_1=20%',
+        })
+
+        uris = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+
+        self.assertEquals(len(uris), 2)
+        img_src = ' '.join(uri['img_src'] for uri in uris)
+        self.assertIn('target=Dummy_host.Dummy_service.load&', img_src)
+        self.assertIn('target=Dummy_host.Dummy_service.cpu.0&'
+                      'target=Dummy_host.Dummy_service.cpu.1&', img_src)
+        self.assertNotIn('missing', img_src)
+
+    def test_unchanged(self):
+        """Test the index is built again only when the Graphite metrics
+        changed"""
+        graphite = start_fake_graphite(self)
+        graphite.metrics = ['a.b']
+        index = MetricIndex(ConnectionPool(graphite.uri))
+        index.refresh()
+        tree = index.tree
+        index.refresh()
+        self.assertIs(index.tree, tree)
+        graphite.metrics = ['a.b', 'a.c']
+        index.refresh()
+        self.assertIsNot(index.tree, tree)
+        self.assertEquals(index.resolve('a.*'), ['a.b', 'a.c'])
+        self.assertEquals(len(graphite.requests), 3)
+
+    def test_backends(self):
+        """Test the paths of each host are resolved with the index of
+        its backend"""
+        graphites = [start_fake_graphite(self), start_fake_graphite(self)]
+        graphites[0].metrics = ['host_a.Dummy_service.load']
+        graphites[1].metrics = ['host_b.Dummy_service.load']
+        module = init_module({
+            'uri': ','.join(graphite.uri for graphite in graphites),
+            'metric_index': '1',
+        })
+        self.addCleanup(module.do_stop)
+        for metric_index in module.metric_indexes:
+            metric_index.refresh()
+
+        for name, backend in (('host a', 0), ('host b', 1)):
+            service = init_service({'host_name': name,
+                                    'perf_data': 'load=1 missing=2'})
+            service.host.customs = {'_GRAPHITE_BACKEND': str(backend + 1)}
+            uris = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+            self.assertEquals(len(uris), 1)
+            self.assertTrue(uris[0]['img_src'].startswith(
+                graphites[backend].uri + 'render/'))
+            self.assertIn('.load', uris[0]['img_src'])
+        self.assertEquals(graphites[0].requests, ['/metrics/index.json'])
+        self.assertEquals(graphites[1].requests, ['/metrics/index.json'])
+
+class MetricFinderTest(unittest.TestCase):
+    """Test the MetricFinder class"""
+
+    def setUp(self):
+        self.graphite = start_fake_graphite(self)
+        self.graphite.metrics = [
+            'srv1.load.load1',
+            'srv1.load.load15',
+            'srv1.load.load5',
+            'srv1.load',
+            'srv2.load.load1',
+        ]
+        pool = ConnectionPool(self.graphite.uri)
+        self.addCleanup(pool.close)
+        self.finder = MetricFinder(pool, max_paths=3)
+
+    def test_resolve(self):
+        """Test the paths are given as is until Graphite is asked, and
+        only the metrics matching them after"""
+        paths = ('srv1.load.load1', 'srv*.load.load1', 'srv1.load.*',
+                 'srv1.load', 'srv1.disk')
+        for path in paths:
+            self.assertEquals(self.finder.resolve(path), [path])
+        self.finder.refresh()
+        self.finder.max_paths = 10
+        for path in paths:
+            self.finder.resolve(path)
+        self.finder.refresh()
+        self.assertEquals(len(self.graphite.requests), 7)
+        self.assertEquals(self.finder.resolve('srv1.load.load1'),
+                          ['srv1.load.load1'])
+        self.assertEquals(self.finder.resolve('srv*.load.load1'),
+                          ['srv1.load.load1', 'srv2.load.load1'])
+        self.assertEquals(self.finder.resolve('srv1.load.*'),
+                          ['srv1.load.load1', 'srv1.load.load15',
+                           'srv1.load.load5'])
+        self.assertEquals(self.finder.resolve('srv1.load'), ['srv1.load'])
+        self.assertEquals(self.finder.resolve('srv1.disk'), [])
+        self.assertEquals(len(self.graphite.requests), 7)
+
+    def test_refresh(self):
+        """Test a path is asked again once shown after the refresh
+        interval, and the least recently used are dropped"""
+        self.finder.resolve('srv1.load.load1')
+        self.finder.refresh()
+        self.graphite.metrics = []
+        self.assertEquals(self.finder.resolve('srv1.load.load1'),
+                          ['srv1.load.load1'])
+        self.finder.refresh()
+        self.assertEquals(len(self.graphite.requests), 1)
+        self.finder.refresh_interval = 0
+        self.assertEquals(self.finder.resolve('srv1.load.load1'),
+                          ['srv1.load.load1'])
+        self.finder.refresh()
+        self.assertEquals(self.finder.resolve('srv1.load.load1'), [])
+        self.assertEquals(len(self.graphite.requests), 2)
+
+        for path in ('a', 'b', 'c', 'd'):
+            self.finder.resolve(path)
+        self.finder.refresh()
+        self.assertEquals(self.finder.count, 3)
+
+    def test_error(self):
+        """Test the paths are asked again after a Graphite error"""
+        self.graphite.status = 500
+        self.finder.resolve('srv1.load')
+        self.assertRaises(Exception, self.finder.refresh)
+        self.graphite.status = 200
+        self.finder.refresh()
+        self.assertEquals(self.finder.resolve('srv1.load'), ['srv1.load'])
+        self.assertEquals(len(self.graphite.requests), 2)
+
+    def test_graph_uris(self):
+        """Test the module asks metrics/find with metric_index_find"""
+        self.graphite.metrics = ['Dummy_host.Dummy_service.load']
+        module = init_module({
+            'uri': self.graphite.uri,
+            'metric_index': '1',
+            'metric_index_find': '1',
+        })
+        self.addCleanup(module.do_stop)
+        service = init_service({'perf_data': 'load=1 missing=2'})
+
+        self.assertEquals(
+            len(module.get_graph_uris(service, GRAPHSTART, GRAPHEND)), 2)
+        module.metric_index.refresh()
+        uris = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        self.assertEquals(len(uris), 1)
+        self.assertIn('.load&', uris[0]['img_src'])
+        self.assertTrue(self.graphite.requests[0].startswith(
+            '/metrics/find?'))
+
+class WhisperReaderTest(unittest.TestCase):
+    """Test the WhisperReader class with synthetic whisper files"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.now = 1400000000
+        # One point per minute for the last 2 hours, but a missing one
+        points = [(self.now - 60 * i, float(i)) for i in range(120) if i != 5]
+        write_whisper(
+            os.path.join(self.folder, 'srv1', 'Load', 'load1.wsp'),
+            [(60, 1440), (3600, 24 * 30)],
+            points)
+        self.reader = WhisperReader(self.folder)
+
+    def test_fetch(self):
+        """Test the points of the best archive are read"""
+        start, end, step, values = self.reader.fetch(
+            'srv1.Load.load1', self.now - 600, self.now, self.now)
+
+        self.assertEquals(step, 60)
+        self.assertEquals(start, self.now - 600 - self.now % 60 + 60)
+        self.assertEquals(end, self.now - self.now % 60 + 60)
+        self.assertEquals(len(values), 10)
+        self.assertEquals(values[-2], 1.0)
+        self.assertIsNone(values[-6])
+
+    def test_coarse_archive(self):
+        """Test a long range uses the hourly archive"""
+        _, _, step, _ = self.reader.fetch(
+            'srv1.Load.load1', self.now - 7 * 86400, self.now, self.now)
+        self.assertEquals(step, 3600)
+
+    def test_bad_names(self):
+        """Test names that are not plain metrics are refused"""
+        self.assertIsNone(self.reader.fetch('srv1.Load.missing', 0))
+        self.assertIsNone(self.reader.fetch('srv1.Load.*', 0))
+        self.assertIsNone(self.reader.fetch('srv1...Load', 0))
+        self.assertIsNone(self.reader.fetch('sumSeries(srv1.Load)', 0))
+
+    def test_module(self):
+        """Test the module gives the whisper backend graphs and data"""
+        write_whisper(
+            os.path.join(self.folder, 'Dummy_host', 'Dummy_service',
+                         'load.wsp'),
+            [(60, 1440)],
+            # Beyond GRAPHSTART, the range of the graph
+            [(int(time.time()) - 60 * i, float(i)) for i in range(180)])
+        module = init_module({
+            'whisper_backend': '1',
+            'whisper_dir': self.folder,
+            'graph_data': '1',
+            'time_format': 'epoch',
+        })
+        self.addCleanup(module.do_stop)
+        service = init_service({'perf_data': 'load=1'})
+
+        uris = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+
+        img_src = uris[0]['img_src']
+        self.assertTrue(img_src.startswith(
+            '/graphite/whisper?target=Dummy_host.Dummy_service.load&'))
+        status, series = module.get_graph_data(
+            uris[0]['data_src'].partition('?')[2])
+        self.assertEquals(status, 200)
+        self.assertEquals(series[0]['target'],
+                          'Dummy_host.Dummy_service.load')
+        self.assertEquals(len(series[0]['datapoints']), 60)
+
+    def test_graphite_fallback(self):
+        """Test the graphs the whisper backend can't draw go to Graphite"""
+        write_whisper(
+            os.path.join(self.folder, 'Dummy_host', 'Dummy_service',
+                         'used.wsp'),
+            [(60, 1440)],
+            [(int(time.time()) - 60 * i, float(i)) for i in range(120)])
+        module = init_module({
+            'whisper_backend': '1',
+            'whisper_dir': self.folder,
+            'graph_data': '1',
+        })
+        self.addCleanup(module.do_stop)
+
+        # No local whisper file
+        service = init_service({'perf_data': 'load=1'})
+        graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+        self.assertTrue(graph['img_src'].startswith(module.uri))
+        # A 0-100 scale
+        service = init_service({'perf_data': 'used=10%'})
+        graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+        self.assertTrue(graph['img_src'].startswith(module.uri))
+        self.assertIn('yMax=100', graph['img_src'])
+        # Threshold lines
+        module.threshold_lines = True
+        service = init_service({'perf_data': 'used=10;80;90'})
+        graph = module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0]
+        self.assertTrue(graph['img_src'].startswith(module.uri))
+        self.assertIn('constantLine(80)', graph['img_src'])
+
+    def test_backends(self):
+        """Test the hosts of the other backends keep their Graphite
+        graphs and data"""
+        for host_name in ('host_1', 'host_2'):
+            write_whisper(
+                os.path.join(self.folder, host_name, 'Dummy_service',
+                             'load.wsp'),
+                [(60, 1440)],
+                [(int(time.time()) - 60 * i, float(i)) for i in range(120)])
+        module = init_module({
+            'uri': 'http://a/, http://b/',
+            'whisper_backend': '1',
+            'whisper_dir': self.folder,
+            'graph_data': '1',
+        })
+        self.addCleanup(module.do_stop)
+        graphs = []
+        for index in (1, 2):
+            service = init_service({'host_name': 'host %d' % index,
+                                    'perf_data': 'load=1'})
+            service.host.customs = {'_GRAPHITE_BACKEND': str(index)}
+            graphs.append(
+                module.get_graph_uris(service, GRAPHSTART, GRAPHEND)[0])
+
+        self.assertTrue(graphs[0]['img_src'].startswith(
+            '/graphite/whisper?target=host_1.Dummy_service.load&'))
+        self.assertTrue(graphs[1]['img_src'].startswith('http://b/render/'))
+        self.assertIn('backend=1', graphs[1]['data_src'])
+
+    def test_render_png(self):
+        """Test the PNG image"""
+        series = [self.reader.get_series(
+            'srv1.Load.load1', self.now - 3600, self.now, self.now)]
+        image = graphite_module.render_png(series, 100, 50)
+
+        self.assertTrue(image.startswith('\x89PNG\r\n\x1a\n'))
+        self.assertEquals(struct.unpack('!2L', image[16:24]), (100, 50))
+
+class HotPathStatsTest(unittest.TestCase):
+    """Test the instrumentation of get_graph_uris"""
+
+    def test_counters(self):
+        """Test the calls, paths and parsings are counted"""
+        templates_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_path)
+        write_template(
+            os.path.join(templates_path, 'dashboard', 'dummy_cmd.graph'),
+            '$uri/render/?target=$host.$service.load\n')
+        module = init_module({
+            'templates_path': templates_path,
+            'instrumentation': '1',
+        })
+        self.addCleanup(module.do_stop)
+        service = init_service({'perf_data': 'load=1 users=2'})
+
+        module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        module.get_graph_uris(service, GRAPHSTART, GRAPHEND)
+        module.get_graph_uris(service, GRAPHSTART, GRAPHEND, 'dashboard')
+
+        stats = module.get_stats()
+        self.assertEquals(stats['sources']['detail']['calls'], 2)
+        self.assertEquals(stats['sources']['detail']['graphs'], 4)
+        self.assertEquals(
+            sum(stats['sources']['detail']['latency_ms'].values()), 2)
+        self.assertEquals(stats['sources']['dashboard']['graphs'], 1)
+        self.assertEquals(stats['paths'], {'template': 1, 'fallback': 2})
+        self.assertEquals(stats['perf_data']['parses'], 1)
+        self.assertEquals(stats['fs_probes']['template_stats'], 1)
+
+    def test_route(self):
+        """Test the counters are served as JSON"""
+        from shinken.webui import bottlewebui
+        module = init_module({'instrumentation': '1'})
+        app = bottlewebui.Bottle()
+        module.load(app)
+        self.addCleanup(module.do_stop)
+        module.get_graph_uris(
+            init_service({'perf_data': 'load=1'}), GRAPHSTART, GRAPHEND)
+
+        body = app({
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/graphite/stats',
+            'QUERY_STRING': '',
+            'wsgi.input': StringIO(''),
+            'wsgi.errors': StringIO(),
+        }, lambda status, headers: None)
+        stats = json.loads(''.join(body))
+        self.assertEquals(stats['sources']['detail']['calls'], 1)
+
+    def test_statsd_export(self):
+        """Test the counters are sent to statsd as gauges"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+        self.addCleanup(sock.close)
+        stats = HotPathStats(
+            'statsd://127.0.0.1:%d' % sock.getsockname()[1], 'ui')
+        stats.add_path('template')
+
+        stats.send(stats.stats())
+
+        lines = set()
+        for _ in range(4):
+            lines.add(sock.recv(1024))
+        self.assertIn('ui.paths.template:1|g', lines)
+        self.assertIn('ui.paths.fallback:0|g', lines)
+
+    def test_carbon_lines(self):
+        """Test the carbon plaintext lines"""
+        stats = HotPathStats('carbon://127.0.0.1', 'ui')
+        stats.add_call('detail', 0.003, 2)
+
+        lines = stats.get_lines(stats.stats(), 1000)
+
+        self.assertEquals(stats.export, ('carbon', '127.0.0.1', 2003))
+        self.assertIn('ui.sources.detail.graphs 2 1000', lines)
+        self.assertIn('ui.sources.detail.latency_ms.le_5 1 1000', lines)
+        self.assertIn('ui.sources.detail.latency_ms.le_2 0 1000', lines)
+
 if __name__ == '__main__':
     unittest.main()